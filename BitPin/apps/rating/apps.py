@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class RatingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'BitPin.apps.rating'
+
+    def ready(self):
+        from . import signals, metrics  # noqa: F401
@@ -0,0 +1,322 @@
+"""
+Async versions of RatingView and ArticleListView for ASGI deployments.
+
+They share the Redis keys, Lua scripts and response format of the sync views,
+but use ``redis.asyncio`` and the async ORM, so a request never holds a worker
+thread while it waits on Redis or Postgres. The Redis connection pool is bound
+to the event loop, so these views are meant to be served by an ASGI server
+(``BitPin.asgi``), not through WSGI.
+"""
+import asyncio
+import json
+import math
+import time
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.core.paginator import InvalidPage, Paginator
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
+from django.utils import timezone
+from django.views import View
+from rest_framework.request import Request
+
+from . import metrics
+from .etags import list_version, membership_version, page_version, list_etag, etag_matches
+from .classes import ArticlePagination, ArticleCursorPagination, CachedArticleList
+from .local_cache import article_titles
+from .models import Article, Rating
+from .renderers import FastJSONRenderer
+from .redis_client import r, ar, article_key, article_version_key, user_ratings_key, user_ratings_lock_key, \
+    ahmget_many
+from .routers import replica_reads
+from .scripts import INDEX_ARTICLE, UPDATE_ARTICLE_EMA, UPDATE_ARTICLE_INDEXES, PAGE_ARTICLES, LIMIT_RATING
+from .views import RatingView, ArticleListView, USER_RATINGS_LOADED_FIELD, USER_RATINGS_LOAD_LOCK_TTL
+from BitPin.settings import RATING_WRITE_MODE, ARTICLE_INDEX_KEY, ARTICLE_MEMBERSHIP_VERSION_KEY, REDIS_CLUSTER
+
+index_article = ar.register_script(INDEX_ARTICLE)
+update_article_ema = ar.register_script(UPDATE_ARTICLE_EMA)
+update_article_indexes = ar.register_script(UPDATE_ARTICLE_INDEXES)
+page_articles = ar.register_script(PAGE_ARTICLES)
+limit_rating = ar.register_script(LIMIT_RATING)
+
+
+async def load_from_database(articles, article_ids):
+    """CachedArticleList.load_from_database with the async ORM and client."""
+    queryset = Article.objects.filter(id__in=article_ids).values(*articles.db_fields)
+    rows = [row async for row in queryset]
+    if not rows:
+        return {}
+    async with ar.pipeline(transaction=False) as pipe:
+        for article in rows:
+            await index_article(
+                keys=articles.index_article_keys(article['id']),
+                args=articles.index_article_args(article),
+                client=pipe
+            )
+        indexed = await pipe.execute()
+    if REDIS_CLUSTER:
+        async with ar.pipeline(transaction=False) as pipe:
+            for update in articles.index_updates(rows, indexed):
+                await update_article_indexes(
+                    keys=articles.index_update_keys, args=articles.index_update_args(*update), client=pipe
+                )
+            await pipe.execute()
+    return articles.merge_indexed_articles(rows, indexed)
+
+
+class AsyncRatingView(View):
+
+    async def apply_rating(self, article_id, score, created, _time, previous_score=''):
+        keys, args = RatingView.ema_script_input(article_id, score, created, _time, previous_score)
+
+        result = await update_article_ema(keys=keys, args=args + [0])
+        if result is None:
+            # Cold cache: load the hash from the database, which has the EMA
+            # state of the last sync, then fold the rating in
+            if not await load_from_database(CachedArticleList(ar), [article_id]):
+                return None
+            result = await update_article_ema(keys=keys, args=args + [1])
+
+        if REDIS_CLUSTER:
+            await update_article_indexes(
+                keys=CachedArticleList.index_update_keys,
+                args=CachedArticleList.index_update_args(article_id, *result, [_time.timestamp()])
+            )
+        return RatingView.decode_ema_result(article_id, result)
+
+    async def check_rate_limit(self, article_id, user_id, score):
+        outcome, retry_after = 'accepted', 0.0
+        for keys, args in RatingView.limit_script_calls(article_id, user_id, score):
+            outcome, retry_after = RatingView.decode_limit_result(await limit_rating(keys=keys, args=args))
+            if outcome != 'accepted':
+                break
+        metrics.record_rating_limit(outcome)
+        return outcome, retry_after
+
+    async def post(self, request, article_id):
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+
+        user_id = data.get('user_id')
+        score = data.get('score')
+
+        if not RatingView.valid_user_id(user_id):
+            return JsonResponse({'error': 'user_id must be an integer'}, status=400)
+        if not RatingView.valid_score(score):
+            return JsonResponse({'error': 'Score must be between 0 and 5'}, status=400)
+
+        outcome, retry_after = await self.check_rate_limit(article_id, user_id, score)
+        if outcome == 'duplicate':
+            return JsonResponse({'detail': 'Rating submitted successfully'}, status=200)
+        if outcome != 'accepted':
+            wait = math.ceil(retry_after)
+            return JsonResponse({'detail': f'Request was throttled. Expected available in {wait} seconds.'},
+                                status=429, headers={'Retry-After': str(wait)})
+
+        _time = timezone.now()
+
+        if RATING_WRITE_MODE == 'write_behind':
+            created, previous_score = False, ''
+        else:
+            # Reading the replaced score needs a row lock, i.e. a transaction
+            previous_score = await sync_to_async(RatingView.save_rating)(article_id, user_id, score)
+            created = previous_score == -1
+
+        article_data = await self.apply_rating(article_id, score, created, _time, previous_score)
+        if not article_data:
+            return JsonResponse({'error': 'Article not found'}, status=404)
+
+        async with ar.pipeline(transaction=False) as pipe:
+            RatingView.queue_rating_writes(pipe, article_id, user_id, score, _time)
+            RatingView.queue_rating_log(pipe, article_id, user_id, score, _time, article_data['avg_rating'])
+            await pipe.execute()
+
+        return JsonResponse({'detail': 'Rating submitted successfully'}, status=200)
+
+
+class AsyncArticleListView(View):
+    pagination_class = ArticlePagination
+    cursor_pagination_class = ArticleCursorPagination
+
+    async def get(self, request):
+        # DRF's paginators only need query params and absolute URIs from the request
+        request = Request(request)
+        user_id = request.query_params.get('user_id')
+
+        fresh = bool(user_id)
+        version = await self.recent_page_version(request, fresh) or await list_version.aget(ar, fresh=fresh)
+        etag = list_etag(version, request.build_absolute_uri(), FastJSONRenderer.media_type)
+        if etag_matches(request, etag):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+        articles = CachedArticleList(ar)
+
+        if ArticleListView.use_cursor_pagination(request.query_params):
+            paginator = self.cursor_pagination_class()
+            article_ids = await self.cursor_page(paginator, articles, request)
+        else:
+            paginator = self.pagination_class()
+            try:
+                article_ids = await self.numbered_page(paginator, request)
+            except InvalidPage:
+                return JsonResponse({'detail': 'Invalid page.'}, status=404)
+
+        # The article hashes and the user's ratings are independent reads
+        if user_id:
+            paginated_articles, user_ratings = await asyncio.gather(
+                self.fetch_articles(articles, article_ids),
+                self.get_user_ratings(user_id, article_ids)
+            )
+            for article_data in paginated_articles:
+                article_data['user_rating'] = user_ratings.get(article_data['id'], None)
+        else:
+            paginated_articles = await self.fetch_articles(articles, article_ids)
+
+        # A rebuild scheduled by a miss may have bumped the version before the page was read
+        if paginator.rebuild_version is not None:
+            etag = list_etag(paginator.rebuild_version, request.build_absolute_uri(), FastJSONRenderer.media_type)
+        return HttpResponse(FastJSONRenderer().render(paginator.get_paginated_response(paginated_articles).data),
+                            content_type=FastJSONRenderer.media_type, headers={'ETag': etag})
+
+    async def recent_page_version(self, request, fresh):
+        """ArticleListView.recent_page_version on the async client."""
+        membership = membership_version.cached(fresh)
+        async with ar.pipeline(transaction=False) as pipe:
+            if membership is None:
+                pipe.get(ARTICLE_MEMBERSHIP_VERSION_KEY)
+            paginator = None
+            if ArticleListView.use_cursor_pagination(request.query_params):
+                paginator = self.cursor_pagination_class()
+                index_key, field, cursor, page_size = paginator.prepare(request)
+                if paginator.ordering != 'recent':
+                    return None
+                await page_articles(keys=[index_key], args=paginator.index_args(cursor, page_size), client=pipe)
+            else:
+                bounds = self.pagination_class().page_bounds(request)
+                if bounds is None:
+                    return None
+                pipe.zrange(ARTICLE_INDEX_KEY, bounds[0], bounds[1] - 1)
+            *read, page = await pipe.execute()
+        if read:
+            membership = membership_version.store(read[0])
+
+        article_ids = ArticleListView.recent_page_ids(paginator, page)
+        if not article_ids:
+            return None
+        async with ar.pipeline(transaction=False) as pipe:
+            for article_id in article_ids:
+                pipe.get(article_version_key(article_id))
+            return page_version(membership, article_ids, await pipe.execute())
+
+    async def numbered_page(self, paginator, request):
+        from_database = False
+        database_page = None
+        count = await ar.zcard(ARTICLE_INDEX_KEY)
+        if count:
+            metrics.record_cache('article_list', hits=1)
+        else:
+            metrics.record_cache('article_list', misses=1)
+            # The sets are rebuilt by a Celery worker; page through the database until it is done
+            rebuilder = CachedArticleList(r, read_version=partial(ArticleListView().etag_version, request))
+            await sync_to_async(rebuilder.schedule_rebuild)()
+            paginator.rebuild_version = rebuilder.rebuild_version
+            from_database = True
+            bounds = paginator.page_bounds(request)
+            with replica_reads():
+                rows = [] if bounds is None else [row async for row in
+                                                  CachedArticleList(ar).database_page_queryset(*bounds)]
+                if rows:
+                    database_page = [article_id for article_id, _ in rows]
+                    count = rows[0][1]
+                else:
+                    count = await Article.objects.acount()
+
+        # Paginating a range gives the page's ranks in the sorted set
+        page_size = paginator.get_page_size(request)
+        page_number = request.query_params.get(paginator.page_query_param) or 1
+        paginator.page = Paginator(range(count), page_size).page(page_number)
+        paginator.request = request
+
+        ranks = paginator.page.object_list
+        if not ranks:
+            return []
+        if database_page is not None:
+            return database_page[:len(ranks)]
+        if from_database:
+            queryset = Article.objects.order_by('id').values_list('id', flat=True)[ranks.start:ranks.stop]
+            with replica_reads():
+                return [article_id async for article_id in queryset]
+        return [int(article_id) for article_id in await ar.zrange(ARTICLE_INDEX_KEY, ranks.start, ranks.stop - 1)]
+
+    async def cursor_page(self, paginator, articles, request):
+        index_key, field, cursor, page_size = paginator.prepare(request)
+
+        if await ar.exists(index_key):
+            metrics.record_cache('article_list', hits=1)
+            result = await page_articles(keys=[index_key], args=paginator.index_args(cursor, page_size))
+            page, has_more = paginator.parse_index_result(result)
+        else:
+            metrics.record_cache('article_list', misses=1)
+            rebuilder = CachedArticleList(r, read_version=partial(ArticleListView().etag_version, request))
+            await sync_to_async(rebuilder.schedule_rebuild)()
+            paginator.rebuild_version = rebuilder.rebuild_version
+            queryset, direction = paginator.keyset_queryset(field, cursor, page_size)
+            with replica_reads():
+                rows = [row async for row in queryset]
+            page, has_more = paginator.parse_db_rows(rows, direction, page_size)
+
+        paginator.set_cursors(page, has_more, cursor)
+        return paginator.page_ids(page)
+
+    async def fetch_articles(self, articles, article_ids):
+        titles = article_titles.get_many(article_ids)
+        async with ar.pipeline(transaction=False) as pipe:
+            articles.queue_article_reads(pipe, article_ids, titles)
+            version, *results = await pipe.execute()
+
+        if not article_titles.check_version(version) and titles:
+            # An article was edited since the titles were cached
+            titles = {}
+            results = await ahmget_many([article_key(article_id) for article_id in article_ids], *articles.fields)
+        found, missing_ids = articles.decode_articles(article_ids, results, titles)
+
+        if missing_ids:
+            found.update(await load_from_database(articles, missing_ids))
+
+        return [found[article_id] for article_id in article_ids if article_id in found]
+
+    async def get_user_ratings(self, user_id, article_ids):
+        user_rating_key = user_ratings_key(user_id)
+        async with ar.pipeline(transaction=False) as pipe:
+            ArticleListView.queue_user_ratings_reads(pipe, user_id, article_ids)
+            cached, ttl, pinned = await pipe.execute()
+
+        with replica_reads(not pinned):
+            if cached[0] is None:
+                metrics.record_cache('user_ratings', misses=1)
+                if not await ar.set(user_ratings_lock_key(user_id), 1, nx=True, ex=USER_RATINGS_LOAD_LOCK_TTL):
+                    queryset = Rating.objects.filter(user_id=user_id, article_id__in=article_ids).values_list(
+                        'article_id', 'score'
+                    )
+                    return {article_id: score async for article_id, score in queryset}
+                await self.load_user_ratings(user_id)
+                cached = await ar.hmget(user_rating_key, USER_RATINGS_LOADED_FIELD, *article_ids)
+            else:
+                metrics.record_cache('user_ratings', hits=1)
+                if ArticleListView.refresh_early(cached[0], ttl) and await ar.set(
+                        user_ratings_lock_key(user_id), 1, nx=True, ex=USER_RATINGS_LOAD_LOCK_TTL):
+                    await self.load_user_ratings(user_id)
+
+        return ArticleListView.decode_user_ratings(article_ids, cached)
+
+    async def load_user_ratings(self, user_id):
+        started = time.perf_counter()
+        queryset = Rating.objects.filter(user_id=user_id).values_list('article_id', 'score')
+        ratings = [row async for row in queryset]
+        async with ar.pipeline() as pipe:
+            ArticleListView.queue_user_ratings_load(pipe, user_id, ratings, time.perf_counter() - started)
+            await pipe.execute()
@@ -1,6 +1,724 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import binascii
+import math
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.db.models import Count, Q, Window
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination, LimitOffsetPagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from . import metrics
+from .etags import list_version
+from .local_cache import article_titles
+from .models import Article, Rating, SCORE_COUNT_FIELDS
+from .redis_client import r, article_key, article_shard, hmget_many
+from .routers import replica_reads
+from .scripts import INDEX_ARTICLE, LOAD_ARTICLES, PAGE_ARTICLES, UPDATE_ARTICLE_INDEXES, SWAP_SORTED_SETS, \
+    index_member
+from BitPin.settings import ARTICLE_INDEX_KEY, ARTICLE_RATING_INDEX_KEY, ARTICLE_COUNT_INDEX_KEY, \
+    ARTICLE_TOP_RATED_KEY, ARTICLE_TRENDING_KEY, ARTICLE_META_VERSION_KEY, ARTICLE_LIST_VERSION_KEY, \
+    ARTICLE_MEMBERSHIP_VERSION_KEY, NUM_RATING_THRESHOLD, TRENDING_HALF_LIFE, REDIS_CLUSTER
+
+# ordering -> (sorted set, Article field), all read in descending order.
+# Ids grow with created_at, so the id index doubles as the recency ordering.
+ARTICLE_ORDERINGS = {
+    'recent': (ARTICLE_INDEX_KEY, 'id'),
+    'rating': (ARTICLE_RATING_INDEX_KEY, 'avg_rating'),
+    'count': (ARTICLE_COUNT_INDEX_KEY, 'num_ratings'),
+}
+
+# board -> sorted set, read in descending order
+LEADERBOARDS = {
+    'top-rated': ARTICLE_TOP_RATED_KEY,
+    'most-rated': ARTICLE_COUNT_INDEX_KEY,
+    'trending': ARTICLE_TRENDING_KEY,
+}
+
+# Index field of each sorted set, for reading it from the database instead
+INDEX_FIELDS = {index_key: field for index_key, field in ARTICLE_ORDERINGS.values()}
+
+# Held by the one worker that rebuilds a missing set, so concurrent misses
+# do not all scan the database
+INDEX_REBUILD_LOCK_KEY = f"{ARTICLE_INDEX_KEY}_rebuild_lock"
+INDEX_REBUILD_LOCK_TTL = 10 * 60  # 10 minutes
+# Exists while rebuild_index runs, so that the scripts also write the sets
+# being built (see scripts.INDEX_FUNCTIONS); its name is derived there
+INDEX_REBUILDING_KEY = f"{ARTICLE_INDEX_KEY}_rebuilding"
+TRENDING_REBUILD_LOCK_KEY = f"{ARTICLE_TRENDING_KEY}_rebuild_lock"
+# How long a leaderboard request waits for another worker's rebuild
+REBUILD_WAIT = 5  # seconds
+REBUILD_POLL_INTERVAL = 0.05  # seconds
+# Hashes per LOAD_ARTICLES call, which keeps each call short enough not to
+# stall other clients
+LOAD_ARTICLES_BATCH_SIZE = 500
+
+# Decay of the trending score per second (see scripts.INDEX_FUNCTIONS). A
+# rating older than TRENDING_WINDOW weighs less than a millionth of a new one,
+# so rebuilds ignore it.
+TRENDING_RATE = math.log(2) / TRENDING_HALF_LIFE
+TRENDING_WINDOW = 20 * TRENDING_HALF_LIFE
+
+# Registered once per process, since registering hashes the script; calls
+# pass the client or pipeline to run on
+index_article = r.register_script(INDEX_ARTICLE)
+update_article_indexes = r.register_script(UPDATE_ARTICLE_INDEXES)
+load_article_hashes = r.register_script(LOAD_ARTICLES)
+page_articles = r.register_script(PAGE_ARTICLES)
+swap_sorted_sets = r.register_script(SWAP_SORTED_SETS)
+
 
 class ArticlePagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
     max_page_size = 100
+    # The list version read after the page scheduled an index rebuild, for its ETag
+    rebuild_version = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not isinstance(queryset, CachedArticleList):
+            return super().paginate_queryset(queryset, request, view)
+        # Lets a list read from the database fetch the page with the count
+        queryset.page_bounds = self.page_bounds(request)
+        page = super().paginate_queryset(queryset, request, view)
+        self.rebuild_version = queryset.rebuild_version
+        return page
+
+    def page_bounds(self, request):
+        """The [start, stop) ranks of the requested page, or None if it is not a page number."""
+        try:
+            number = int(request.query_params.get(self.page_query_param) or 1)
+        except ValueError:
+            return None
+        page_size = self.get_page_size(request)
+        if number < 1 or not page_size:
+            return None
+        return (number - 1) * page_size, number * page_size
+
+
+class LeaderboardPagination(LimitOffsetPagination):
+    default_limit = 10
+    max_limit = 100
+
+
+class ArticleCursorPagination(BasePagination):
+    """
+    Keyset pagination over the article sorted sets.
+
+    The cursor holds the (score, id) of the first or last item of a page, so
+    every page costs O(log N + page_size) and stays stable while other
+    articles are rated. When the sorted set has not been built yet, the same
+    keyset is read from the database using the (field, id) indexes and the
+    set is rebuilt in the background.
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    default_ordering = 'recent'
+    rebuild_version = None
+
+    def paginate_articles(self, redis_client, request, read_version=None):
+        index_key, field, cursor, page_size = self.prepare(request)
+
+        articles = CachedArticleList(redis_client, read_version=read_version)
+        if redis_client.exists(index_key):
+            metrics.record_cache('article_list', hits=1)
+            result = page_articles(keys=[index_key], args=self.index_args(cursor, page_size), client=redis_client)
+            page, has_more = self.parse_index_result(result)
+        else:
+            metrics.record_cache('article_list', misses=1)
+            articles.schedule_rebuild()
+            self.rebuild_version = articles.rebuild_version
+            queryset, direction = self.keyset_queryset(field, cursor, page_size)
+            with replica_reads():
+                rows = list(queryset)
+            page, has_more = self.parse_db_rows(rows, direction, page_size)
+
+        self.set_cursors(page, has_more, cursor)
+        return articles.fetch_articles(self.page_ids(page))
+
+    def prepare(self, request):
+        """Read the request parameters; returns (index_key, field, cursor, page_size)."""
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.ordering = request.query_params.get(self.ordering_query_param, self.default_ordering)
+        if self.ordering not in ARTICLE_ORDERINGS:
+            self.ordering = self.default_ordering
+        index_key, field = ARTICLE_ORDERINGS[self.ordering]
+        return index_key, field, self.decode_cursor(request), self.get_page_size(request)
+
+    def set_cursors(self, page, has_more, cursor):
+        direction = cursor[0] if cursor else 'next'
+        if direction == 'previous':
+            has_previous, has_next = has_more, True
+        else:
+            has_previous, has_next = cursor is not None, has_more
+
+        # Cursors point at the last / first item of this page: (direction, score, id)
+        self.next_cursor = ('next', page[-1][1], page[-1][0]) if page and has_next else None
+        self.previous_cursor = ('previous', page[0][1], page[0][0]) if page and has_previous else None
+
+    def page_ids(self, page):
+        return [int(article_id) for article_id, _ in page]
+
+    def index_args(self, cursor, page_size):
+        direction, score, article_id = cursor or ('next', '', '')
+        member = index_member(article_id) if article_id else ''
+        return [score, member, page_size, direction]
+
+    def parse_index_result(self, result):
+        items = result[1:]
+        page = [(str(int(member)), score.decode()) for member, score in zip(items[::2], items[1::2])]
+        return page, bool(result[0])
+
+    def keyset_queryset(self, field, cursor, page_size):
+        """Return the (field, id) keyset query for one page plus one row, and its direction."""
+        queryset = Article.objects.all()
+        direction = 'next'
+        if cursor:
+            direction, score, article_id = cursor
+            value = Article._meta.get_field(field).to_python(score)
+            lookup = 'gt' if direction == 'previous' else 'lt'
+            queryset = queryset.filter(
+                Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'id__{lookup}': article_id})
+            )
+
+        if direction == 'previous':
+            queryset = queryset.order_by(field, 'id')
+        else:
+            queryset = queryset.order_by(f'-{field}', '-id')
+        return queryset.values_list('id', field)[:page_size + 1], direction
+
+    def parse_db_rows(self, rows, direction, page_size):
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if direction == 'previous':
+            rows = rows[::-1]
+        return [(str(article_id), str(score)) for article_id, score in rows], has_more
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            direction, score, article_id = base64.urlsafe_b64decode(encoded.encode()).decode().split('|')
+            float(score)
+            int(article_id)
+        except (TypeError, ValueError, UnicodeDecodeError, binascii.Error):
+            raise NotFound('Invalid cursor')
+        if direction not in ('next', 'previous'):
+            raise NotFound('Invalid cursor')
+        return direction, score, article_id
+
+    def encode_cursor(self, cursor):
+        direction, score, article_id = cursor
+        encoded = base64.urlsafe_b64encode(f"{direction}|{score}|{article_id}".encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        return self.encode_cursor(self.next_cursor) if self.next_cursor else None
+
+    def get_previous_link(self):
+        return self.encode_cursor(self.previous_cursor) if self.previous_cursor else None
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+
+class CachedArticleList:
+    """
+    Lazy, sliceable article list backed by Redis.
+
+    Ordering lives in the ``article_index`` sorted set and each article in its
+    ``article_{id}`` hash, so a page costs one ZRANGE plus one pipelined HMGET
+    per article on the page, however large the catalogue is. Rating writes
+    update the hashes in place, so pages are never stale.
+
+    Each article comes with ``score_counts``, the number of ratings per score
+    0-5 kept in its hash, so distributions never need a query on Rating.
+
+    Titles seen before come from the per-process ``local_cache.article_titles``,
+    so only the rating fields of those articles are read from Redis.
+
+    The hashes also carry the EMA state (``last_score`` and
+    ``last_rating_time``), which is synced to the database with ``avg_rating``,
+    so a hash loaded from the database continues the EMA where it stopped.
+
+    When the sorted set is missing, a Celery task rebuilds it and pages are
+    read from the database meanwhile, with the article count in the same
+    query (see ``count``).
+
+    In cluster mode the sorted sets are in another slot than the hashes, so
+    writes to a hash are followed by an UPDATE_ARTICLE_INDEXES call (see
+    ``queue_index_updates``).
+    """
+    rating_fields = ('num_ratings', 'avg_rating', *SCORE_COUNT_FIELDS)
+    fields = ('title', *rating_fields)
+    state_fields = ('last_score', 'last_rating_time')
+    db_fields = ('id', *fields, *state_fields)
+    index_keys = (ARTICLE_INDEX_KEY, ARTICLE_RATING_INDEX_KEY, ARTICLE_COUNT_INDEX_KEY, ARTICLE_TOP_RATED_KEY)
+    index_update_keys = (*index_keys, ARTICLE_TRENDING_KEY)
+
+    def __init__(self, redis_client, index_key=ARTICLE_INDEX_KEY, read_version=None):
+        self.r = redis_client
+        self.index_key = index_key
+        # Reads the page's ETag version for schedule_rebuild; the list version by default
+        self.read_version = read_version
+        self.from_database = False
+        # The [start, stop) ranks the paginator will slice, set by
+        # ArticlePagination, and their ids once read from the database
+        self.page_bounds = None
+        self.database_page = None
+        self.rebuild_version = None
+
+    def count(self):
+        count = self.r.zcard(self.index_key)
+        if count:
+            metrics.record_cache('article_list', hits=1)
+            return count
+
+        metrics.record_cache('article_list', misses=1)
+        # The sets are rebuilt by a Celery worker; page through the database until it is done
+        self.schedule_rebuild()
+        self.from_database = True
+        with replica_reads():
+            if self.page_bounds is not None:
+                rows = list(self.database_page_queryset(*self.page_bounds))
+                if rows:
+                    self.database_page = [article_id for article_id, _ in rows]
+                    return rows[0][1]
+            # A page past the end, or one not given by number
+            return Article.objects.count()
+
+    def database_page_queryset(self, start, stop):
+        """(id, article count) rows of the articles ranked [start, stop), so a page costs one query."""
+        return Article.objects.order_by(INDEX_FIELDS[self.index_key], 'id').annotate(
+            total=Window(Count('id'))
+        ).values_list('id', 'total')[start:stop]
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError('CachedArticleList only supports slicing')
+
+        start = index.start or 0
+        if index.stop is not None and index.stop <= start:
+            return []
+        stop = -1 if index.stop is None else index.stop - 1
+
+        if self.database_page is not None and start == self.page_bounds[0]:
+            article_ids = self.database_page[:None if index.stop is None else index.stop - start]
+        elif self.from_database:
+            queryset = Article.objects.order_by(INDEX_FIELDS[self.index_key], 'id').values_list('id', flat=True)
+            with replica_reads():
+                article_ids = list(queryset[start:index.stop])
+        else:
+            article_ids = [int(article_id) for article_id in self.r.zrange(self.index_key, start, stop)]
+        return self.fetch_articles(article_ids)
+
+    def fetch_articles(self, article_ids):
+        titles = article_titles.get_many(article_ids)
+        pipe = self.r.pipeline(transaction=False)
+        self.queue_article_reads(pipe, article_ids, titles)
+        version, *results = pipe.execute()
+
+        if not article_titles.check_version(version) and titles:
+            # An article was edited since the titles were cached
+            titles = {}
+            results = hmget_many([article_key(article_id) for article_id in article_ids], *self.fields,
+                                 client=self.r)
+        articles, missing_ids = self.decode_articles(article_ids, results, titles)
+
+        if missing_ids:
+            articles.update(self.load_from_database(missing_ids))
+
+        return [articles[article_id] for article_id in article_ids if article_id in articles]
+
+    def queue_article_reads(self, pipe, article_ids, titles):
+        """
+        Queue a GET of the metadata version, then an HMGET per article that
+        leaves out the title when it is in `titles`.
+        """
+        pipe.get(ARTICLE_META_VERSION_KEY)
+        for article_id in article_ids:
+            pipe.hmget(article_key(article_id), *(self.rating_fields if article_id in titles else self.fields))
+
+    def decode_articles(self, article_ids, results, titles=None):
+        """
+        Decode HMGET results, taking the titles found in `titles` from there;
+        returns ({id: article}, ids whose hash is missing or incomplete).
+        """
+        titles = titles or {}
+        articles = {}
+        missing_ids = []
+        new_titles = {}
+        for article_id, row in zip(article_ids, results):
+            if article_id in titles:
+                title = titles[article_id]
+            else:
+                title, *row = row
+                if title is not None:
+                    title = new_titles[article_id] = title.decode()
+            num_ratings, avg_rating, *score_counts = row
+            if title is None or num_ratings is None or avg_rating is None or None in score_counts:
+                missing_ids.append(article_id)
+                continue
+            articles[article_id] = {
+                'id': article_id,
+                'title': title,
+                'num_ratings': int(num_ratings),
+                'avg_rating': float(avg_rating),
+                'score_counts': [int(count) for count in score_counts],
+                'user_rating': None
+            }
+        article_titles.set_many(new_titles)
+        metrics.record_cache('article', hits=len(articles), misses=len(missing_ids))
+        metrics.record_cache('article_title', hits=len(titles), misses=len(article_ids) - len(titles))
+        return articles, missing_ids
+
+    def load_from_database(self, article_ids):
+        """Backfill the hashes of articles from the database; returns {id: article} of those that exist."""
+        return self.load_articles(list(Article.objects.filter(id__in=article_ids).values(*self.db_fields)))
+
+    def load_articles(self, rows):
+        """Backfill the hashes of articles loaded from the database."""
+        pipe = self.r.pipeline(transaction=False)
+        self.queue_index_articles(pipe, rows)
+        results = pipe.execute()
+        if REDIS_CLUSTER:
+            pipe = self.r.pipeline(transaction=False)
+            self.queue_index_updates(pipe, self.index_updates(rows, results))
+            pipe.execute()
+        return self.merge_indexed_articles(rows, results)
+
+    def queue_index_articles(self, pipe, rows):
+        for article in rows:
+            index_article(
+                keys=self.index_article_keys(article['id']),
+                args=self.index_article_args(article),
+                client=pipe
+            )
+
+    @classmethod
+    def index_article_keys(cls, article_id):
+        """INDEX_ARTICLE keys: the hash, and the sorted sets unless they are in another slot."""
+        if REDIS_CLUSTER:
+            return [article_key(article_id)]
+        return [article_key(article_id), *cls.index_keys]
+
+    @classmethod
+    def index_article_args(cls, article):
+        """INDEX_ARTICLE arguments for an article row with the db_fields."""
+        return [*cls.load_article_args(article), NUM_RATING_THRESHOLD]
+
+    @staticmethod
+    def load_article_args(article):
+        """The ARTICLE_LOAD_ARGS values of an article row with the db_fields, see scripts.load_article."""
+        last_rating_time = article['last_rating_time']
+        return [article['id'], article['title'], article['num_ratings'], article['avg_rating'],
+                *(article[field] for field in SCORE_COUNT_FIELDS),
+                '' if article['last_score'] is None else article['last_score'],
+                '' if last_rating_time is None else last_rating_time.timestamp()]
+
+    @staticmethod
+    def index_updates(rows, results):
+        """queue_index_updates input for the INDEX_ARTICLE results of `rows`."""
+        return [(article['id'], avg_rating, num_ratings, ())
+                for article, (num_ratings, avg_rating, *_) in zip(rows, results)]
+
+    def queue_index_updates(self, pipe, updates):
+        """
+        Queue an UPDATE_ARTICLE_INDEXES call per (article_id, avg_rating,
+        num_ratings, epoch seconds of new ratings), in cluster mode.
+        """
+        for update in updates:
+            update_article_indexes(keys=self.index_update_keys, args=self.index_update_args(*update), client=pipe)
+
+    @staticmethod
+    def index_update_args(article_id, avg_rating, num_ratings, rated_at=()):
+        return [article_id, avg_rating, num_ratings, NUM_RATING_THRESHOLD, TRENDING_RATE, *rated_at]
+
+    def merge_indexed_articles(self, rows, results):
+        # The script returns the rating fields now in Redis, which are newer than the database copy
+        articles = {}
+        for article, (num_ratings, avg_rating, *score_counts) in zip(rows, results):
+            articles[article['id']] = {
+                'id': article['id'],
+                'title': article['title'],
+                'num_ratings': int(num_ratings),
+                'avg_rating': float(avg_rating),
+                'score_counts': [int(count) for count in score_counts],
+                'user_rating': None
+            }
+        article_titles.set_many({article['id']: article['title'] for article in rows})
+        return articles
+
+    def fetch_cached_ratings(self, article_ids):
+        results = hmget_many([article_key(article_id) for article_id in article_ids], 'num_ratings', 'avg_rating',
+                             client=self.r)
+        return {
+            article_id: (int(num_ratings), float(avg_rating))
+            for article_id, (num_ratings, avg_rating) in zip(article_ids, results)
+            if num_ratings is not None and avg_rating is not None
+        }
+
+    def schedule_rebuild(self):
+        """
+        Rebuild the sorted sets in a Celery worker, at most once at a time.
+        The call that schedules it reads the page's ETag version into
+        ``rebuild_version`` afterwards, before any page is read, so a
+        rebuild that has already run (e.g. eagerly) is not missing from the
+        page's ETag.
+        """
+        if self.r.set(INDEX_REBUILD_LOCK_KEY, 1, nx=True, ex=INDEX_REBUILD_LOCK_TTL):
+            from .tasks import rebuild_article_index
+            rebuild_article_index.delay()
+            self.rebuild_version = self.read_version() if self.read_version else list_version.get(self.r, fresh=True)
+
+    def try_rebuild_index(self):
+        """
+        Rebuild the sorted sets unless another worker is already doing it.
+        Returns the number of articles indexed, or None if the lock was taken.
+        """
+        if not self.r.set(INDEX_REBUILD_LOCK_KEY, 1, nx=True, ex=INDEX_REBUILD_LOCK_TTL):
+            return None
+        try:
+            # Another worker may have finished a rebuild since the caller's miss
+            return self.r.zcard(self.index_key) or self.rebuild_index()
+        finally:
+            self.r.delete(INDEX_REBUILD_LOCK_KEY)
+
+    def rebuild_index(self, batch_size=10000, load_hashes=False):
+        """
+        Rebuild the ordering sorted sets from the database and swap them in
+        atomically. With ``load_hashes`` the article hashes are loaded in the
+        same pass, for warm starts after Redis lost its data.
+
+        Rows are streamed from a replica with a server-side cursor on
+        PostgreSQL, so memory stays bounded by ``batch_size``.
+
+        Ratings made while it runs are written to the sets being built by the
+        scripts, and batches never overwrite them, so the swapped-in sets
+        hold every rating made up to the swap.
+        """
+        metrics.record_rebuild('article_index')
+        building_keys = {key: f"{key}_building" for key in self.index_keys}
+        self.r.delete(*building_keys.values())
+        self.r.set(INDEX_REBUILDING_KEY, 1, ex=INDEX_REBUILD_LOCK_TTL)
+
+        if load_hashes:
+            rows = Article.objects.values(*self.db_fields)
+        else:
+            rows = Article.objects.values_list('id', 'num_ratings', 'avg_rating')
+        count = 0
+        batch = []
+        try:
+            with replica_reads():
+                for row in rows.iterator(chunk_size=batch_size):
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        self.rebuild_batch(batch, building_keys, load_hashes)
+                        count += len(batch)
+                        batch = []
+            if batch:
+                self.rebuild_batch(batch, building_keys, load_hashes)
+                count += len(batch)
+
+            # A transaction without a cluster, so no rating lands between the swap and the end of the rebuild
+            pipe = self.r.pipeline()
+            if count:
+                # The top rated set is not built when no article has enough ratings yet, and is then deleted
+                swap_sorted_sets(
+                    keys=[key for live_key, building_key in building_keys.items() for key in (building_key, live_key)],
+                    client=pipe
+                )
+                pipe.incr(ARTICLE_LIST_VERSION_KEY)
+                pipe.incr(ARTICLE_MEMBERSHIP_VERSION_KEY)
+            pipe.delete(INDEX_REBUILDING_KEY, *building_keys.values())
+            pipe.execute()
+        except Exception:
+            self.r.delete(INDEX_REBUILDING_KEY, *building_keys.values())
+            raise
+        return count
+
+    def rebuild_batch(self, rows, building_keys, load_hashes):
+        if load_hashes:
+            cached = self.load_hashes(rows)
+            rows = [(article['id'], article['num_ratings'], article['avg_rating']) for article in rows]
+        else:
+            # Rating fields in Redis are newer than the database copy
+            cached = self.fetch_cached_ratings([article_id for article_id, _, _ in rows])
+        self.index_batch(rows, building_keys, cached)
+
+    def load_hashes(self, rows):
+        """
+        Load the hashes of article rows with the db_fields in one pipeline of
+        LOAD_ARTICLES calls, grouped by shard so that each call stays in one
+        slot. Returns {article_id: (num_ratings, avg_rating)} now in Redis.
+        """
+        shards = {}
+        for article in rows:
+            shards.setdefault(article_shard(article['id']), []).append(article)
+
+        pipe = self.r.pipeline(transaction=False)
+        calls = []
+        for articles in shards.values():
+            for start in range(0, len(articles), LOAD_ARTICLES_BATCH_SIZE):
+                chunk = articles[start:start + LOAD_ARTICLES_BATCH_SIZE]
+                load_article_hashes(
+                    keys=[article_key(article['id']) for article in chunk],
+                    args=[value for article in chunk for value in self.load_article_args(article)],
+                    client=pipe
+                )
+                calls.append(chunk)
+
+        cached = {}
+        for chunk, result in zip(calls, pipe.execute()):
+            for article, num_ratings, avg_rating in zip(chunk, result[::2], result[1::2]):
+                cached[article['id']] = (int(num_ratings), float(avg_rating))
+        return cached
+
+    def index_batch(self, rows, building_keys, cached):
+
+        scores = {key: {} for key in self.index_keys}
+        for article_id, num_ratings, avg_rating in rows:
+            num_ratings, avg_rating = cached.get(article_id, (num_ratings, avg_rating))
+            member = index_member(article_id)
+            scores[ARTICLE_INDEX_KEY][member] = article_id
+            scores[ARTICLE_RATING_INDEX_KEY][member] = avg_rating
+            scores[ARTICLE_COUNT_INDEX_KEY][member] = num_ratings
+            if num_ratings >= NUM_RATING_THRESHOLD:
+                scores[ARTICLE_TOP_RATED_KEY][member] = avg_rating
+
+        pipe = self.r.pipeline(transaction=False)
+        for key, mapping in scores.items():
+            if mapping:
+                # Members written by a rating since the batch was read are newer
+                pipe.zadd(building_keys[key], mapping, nx=True)
+        pipe.execute()
+
+
+class Leaderboard:
+    """
+    Sliceable leaderboard backed by a sorted set, for LeaderboardPagination.
+
+    A slice costs one ZREVRANGE, O(log N + limit), plus the article hashes
+    read by CachedArticleList. Missing sets are rebuilt from the database like
+    the article list: the top and most rated sets with the list index, the
+    trending set from recent ratings.
+    """
+
+    def __init__(self, redis_client, board):
+        self.r = redis_client
+        self.board = board
+        self.key = LEADERBOARDS[board]
+
+    def is_built(self):
+        # An empty top rated set is missing, but complete once the list index is built
+        return self.r.exists(ARTICLE_INDEX_KEY if self.key == ARTICLE_TOP_RATED_KEY else self.key)
+
+    def count(self):
+        if self.is_built():
+            metrics.record_cache('leaderboard', hits=1)
+        else:
+            metrics.record_cache('leaderboard', misses=1)
+            self.rebuild_or_wait()
+        return self.r.zcard(self.key)
+
+    def rebuild_or_wait(self):
+        """Rebuild the set, or wait up to REBUILD_WAIT for the worker already rebuilding it."""
+        if self.key == ARTICLE_TRENDING_KEY:
+            lock_key = TRENDING_REBUILD_LOCK_KEY
+            if self.r.set(lock_key, 1, nx=True, ex=INDEX_REBUILD_LOCK_TTL):
+                try:
+                    if not self.is_built():
+                        rebuild_trending(self.r)
+                finally:
+                    self.r.delete(lock_key)
+                return
+        else:
+            lock_key = INDEX_REBUILD_LOCK_KEY
+            if CachedArticleList(self.r).try_rebuild_index() is not None:
+                return
+
+        # A set can stay missing after a rebuild when it is empty, so stop once the lock is released
+        deadline = time.monotonic() + REBUILD_WAIT
+        while self.r.exists(lock_key) and not self.is_built() and time.monotonic() < deadline:
+            time.sleep(REBUILD_POLL_INTERVAL)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError('Leaderboard only supports slicing')
+
+        start = index.start or 0
+        if index.stop is not None and index.stop <= start:
+            return []
+        stop = -1 if index.stop is None else index.stop - 1
+
+        entries = self.r.zrevrange(self.key, start, stop, withscores=True)
+        articles = CachedArticleList(self.r).fetch_articles([int(member) for member, _ in entries])
+        scores = {int(member): score for member, score in entries}
+        now = time.time()
+        for rank, article in enumerate(articles, start + 1):
+            article['rank'] = rank
+            if self.key == ARTICLE_TRENDING_KEY:
+                # Ratings weighted by exp(-rate * age): a rating just now counts 1
+                article['trending_score'] = math.exp(scores[article['id']] - TRENDING_RATE * now)
+        return articles
+
+
+def rebuild_trending(redis_client, batch_size=10000):
+    """
+    Rebuild the trending sorted set from the ratings of the last
+    TRENDING_WINDOW seconds and swap it in atomically. Returns its size.
+
+    Rating keeps only each user's latest rating, so earlier ratings that were
+    replaced by a re-rate no longer count.
+    """
+    metrics.record_rebuild('trending')
+    since = datetime.fromtimestamp(time.time() - TRENDING_WINDOW, tz=dt_timezone.utc)
+    rows = Rating.objects.filter(updated_at__gte=since).values_list('article_id', 'updated_at')
+
+    scores = {}
+    with replica_reads():
+        for article_id, updated_at in rows.iterator(chunk_size=batch_size):
+            value = TRENDING_RATE * updated_at.timestamp()
+            current = scores.get(article_id)
+            if current is not None:
+                high = max(current, value)
+                value = high + math.log1p(math.exp(min(current, value) - high))
+            scores[article_id] = value
+
+    building_key = f"{ARTICLE_TRENDING_KEY}_building"
+    members = [(index_member(article_id), score) for article_id, score in scores.items()]
+    pipe = redis_client.pipeline()
+    pipe.delete(building_key)
+    for start in range(0, len(members), batch_size):
+        pipe.zadd(building_key, dict(members[start:start + batch_size]))
+    # Deletes the trending set when nobody rated lately
+    swap_sorted_sets(keys=[building_key, ARTICLE_TRENDING_KEY], client=pipe)
+    pipe.execute()
+    return len(members)
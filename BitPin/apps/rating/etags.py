@@ -0,0 +1,96 @@
+"""
+Strong ETags for the article list, so polling clients revalidate pages
+instead of downloading them again.
+
+Pages of the ``recent`` ordering, the default, change when an article is
+added, edited or removed, or when one of their own articles is rated. Their
+version is ARTICLE_MEMBERSHIP_VERSION_KEY, incremented by article saves and
+deletes (``signals``), index rebuilds and EMA recomputes, plus a digest of
+the ``article_version_{id}`` counter of each article on the page, which
+every accepted rating (``RatingView.queue_rating_writes``, used by all
+rating endpoints) and the rating counts of the write-behind drain increment.
+A rating therefore changes the ETags of the pages showing that article only.
+Finding those costs two pipelined reads: the page's ids, then one GET per id.
+
+Pages ordered by rating or count can change with a rating of any article, so
+they use ARTICLE_LIST_VERSION_KEY, which all of the above increment. So do
+pages whose ids the index cannot give (while it is rebuilt, or past the
+end). A page's ETag is the version plus a hash of the URL and the response
+format, so it changes whenever the page may have. A request whose
+``If-None-Match`` holds it is answered 304 before the page is read.
+
+Each process keeps the list and membership versions it read last for
+ETAG_VERSION_CACHE_SECONDS. Within that window a poll without ``user_id``
+does not read them, and a page can be up to that old. Requests with
+``user_id`` always read them, so users see their own ratings at once. The
+versions are read before the page, so a concurrent write can only make an
+ETag older than its page, and clients then fetch the page once more. A
+request that schedules an index rebuild reads the list version again after
+scheduling, still before the page (see ``CachedArticleList.schedule_rebuild``),
+so its ETag includes the rebuild's increment if the rebuild has already run.
+"""
+import hashlib
+import time
+
+from django.utils.http import parse_etags
+
+from BitPin.settings import ARTICLE_LIST_VERSION_KEY, ARTICLE_MEMBERSHIP_VERSION_KEY, ETAG_VERSION_CACHE_SECONDS
+
+
+class ListVersion:
+    """The version counter at `key`, read from Redis at most once per `ttl` seconds unless asked for a fresh one."""
+
+    def __init__(self, ttl, key):
+        self.ttl = ttl
+        self.key = key
+        # Replaced as a whole, so threads never see half an update
+        self._cached = (0.0, None)
+
+    def get(self, redis_client, fresh=False):
+        version = self.cached(fresh)
+        if version is None:
+            version = self.store(redis_client.get(self.key))
+        return version
+
+    async def aget(self, redis_client, fresh=False):
+        version = self.cached(fresh)
+        if version is None:
+            version = self.store(await redis_client.get(self.key))
+        return version
+
+    def cached(self, fresh=False):
+        """The cached version, or None when it has to be read, e.g. in a pipeline with other reads."""
+        expires, version = self._cached
+        if fresh or expires <= time.monotonic():
+            return None
+        return version
+
+    def store(self, version):
+        version = int(version or 0)
+        self._cached = (time.monotonic() + self.ttl, version)
+        return version
+
+
+def page_version(membership, article_ids, article_versions):
+    """The version of a page of the recent ordering: the membership version and a digest of its articles' versions."""
+    articles = ' '.join(f'{article_id}:{int(version or 0)}'
+                        for article_id, version in zip(article_ids, article_versions))
+    return f'{membership}.{hashlib.blake2b(articles.encode(), digest_size=8).hexdigest()}'
+
+
+def list_etag(version, url, media_type):
+    """The strong ETag of the page at `url` rendered as `media_type`, at list `version`."""
+    digest = hashlib.blake2b(f'{media_type} {url}'.encode(), digest_size=8).hexdigest()
+    return f'"{version}-{digest}"'
+
+
+def etag_matches(request, etag):
+    """Whether the request's If-None-Match holds `etag` (weak comparison, as RFC 9110 asks for If-None-Match)."""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    return any(tag == '*' or tag.removeprefix('W/') == etag for tag in parse_etags(header))
+
+
+list_version = ListVersion(ETAG_VERSION_CACHE_SECONDS, ARTICLE_LIST_VERSION_KEY)
+membership_version = ListVersion(ETAG_VERSION_CACHE_SECONDS, ARTICLE_MEMBERSHIP_VERSION_KEY)
@@ -0,0 +1,80 @@
+"""
+Per-process cache in front of Redis for data that almost never changes.
+
+Article titles are the same on every page view, so each worker keeps the ones
+it has seen in a bounded LRU and reads only the rating fields from Redis.
+
+Invalidation is by key versioning: editing or deleting an article increments
+the ``article_meta_version`` key (see ``signals``), which readers fetch in the
+same pipeline as the article hashes. When it differs from the version the
+local entries were cached under, they are all dropped. New articles never need
+an invalidation because their ids are not cached yet. Entries also expire
+after a TTL, which bounds staleness after writes that skip the signals, such
+as ``QuerySet.update``.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from BitPin.settings import ARTICLE_META_CACHE_SIZE, ARTICLE_META_CACHE_TTL
+
+
+class LocalCache:
+    """Thread-safe LRU cache with a TTL, tied to a version kept in Redis."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = None
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get_many(self, keys):
+        """Return {key: value} for the keys that are cached and not expired."""
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                item = self._items.get(key)
+                if item is None:
+                    continue
+                expires, value = item
+                if expires < now:
+                    del self._items[key]
+                    continue
+                self._items.move_to_end(key)
+                found[key] = value
+        return found
+
+    def set_many(self, items):
+        if not self.max_size:
+            return
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in items.items():
+                self._items[key] = (expires, value)
+                self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def check_version(self, version):
+        """
+        Compare the version read from Redis with the one the entries belong
+        to. Returns False, after dropping every entry, if it has changed.
+        """
+        if version == self.version:
+            return True
+        with self._lock:
+            self._items.clear()
+            self.version = version
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+article_titles = LocalCache(ARTICLE_META_CACHE_SIZE, ARTICLE_META_CACHE_TTL)
@@ -0,0 +1,603 @@
+import json
+import platform
+import random
+import statistics
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from urllib.parse import urlsplit, parse_qsl
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+from prometheus_client import REGISTRY
+from redis.exceptions import ResponseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from BitPin.apps.rating.classes import CachedArticleList
+from BitPin.apps.rating.models import Article, Rating
+from BitPin.apps.rating.renderers import FastJSONRenderer
+from BitPin.apps.rating.redis_client import r, pool, command_stats, reset_command_stats, user_ratings_key, \
+    article_key, article_shard, dirty_articles_key, hmget_many
+from BitPin.apps.rating.routers import REPLICAS
+from BitPin.apps.rating.tasks import sync_articles_from_redis, warm_redis_cache
+from BitPin.apps.rating.views import RatingView, ArticleListView
+from BitPin.settings import REDIS_DB, REDIS_CLUSTER
+
+SCENARIOS = ('rate', 'list', 'cursor', 'sync', 'warm', 'memory', 'stampede', 'poll')
+# Synthetic user ids, far above real ones
+LIST_USER_ID = 10 ** 9
+RATE_USER_ID = 2 * 10 ** 9
+# The parameters that identify a case when comparing runs
+CASE_KEYS = ('scenario', 'articles', 'page_size', 'user_ratings', 'conditional', 'rating_rate', 'concurrency')
+
+
+def int_list(value):
+    try:
+        return [int(item) for item in value.split(',') if item]
+    except ValueError:
+        raise CommandError(f'Expected a comma separated list of integers, got {value!r}')
+
+
+def summarize(latencies):
+    if not latencies:
+        return {}
+    summary = {
+        'mean': statistics.mean(latencies) * 1000,
+        'max': max(latencies) * 1000,
+    }
+    if len(latencies) > 1:
+        cuts = statistics.quantiles(latencies, n=100)
+        summary.update(p50=cuts[49] * 1000, p95=cuts[94] * 1000, p99=cuts[98] * 1000)
+    else:
+        summary.update(p50=summary['mean'], p95=summary['mean'], p99=summary['mean'])
+    return summary
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the rating, list and sync hot paths in-process and save the results as JSON. '
+            'Data is created in a throwaway test database and a separate Redis database (or fakeredis).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f'Comma separated subset of {", ".join(SCENARIOS)}')
+        parser.add_argument('--articles', type=int_list, default=[1000, 10000], help='Article counts, e.g. 1000,10000')
+        parser.add_argument('--page-sizes', type=int_list, default=[10, 100], help='List page sizes')
+        parser.add_argument('--user-ratings', type=int_list, default=[0, 1000],
+                            help='Number of ratings of the user requesting the list')
+        parser.add_argument('--concurrency', type=int_list, default=[1, 8], help='Concurrent request threads')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per case')
+        parser.add_argument('--stampede-concurrency', type=int, default=500,
+                            help='Simultaneous list requests when the caches are dropped; on Postgres, '
+                                 'max_connections must be higher')
+        parser.add_argument('--poll-clients', type=int, default=50,
+                            help='Clients polling a fixed list page each in the poll scenario')
+        parser.add_argument('--poll-write-ratio', type=float, default=0.05,
+                            help='Share of rating writes among the poll scenario requests')
+        parser.add_argument('--poll-rating-rates', type=int_list, default=[0, 200],
+                            help='Ratings per second sent by another thread while the poll scenario runs')
+        parser.add_argument('--sync-runs', type=int, default=5, help='sync_articles_from_redis runs per article count')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--compare', help='JSON file of an earlier run to compare against')
+        parser.add_argument('--redis-db', type=int, default=15,
+                            help='Redis database to benchmark in; it is flushed before and after')
+        parser.add_argument('--fake-redis', action='store_true', help='Use an in-process fakeredis server')
+
+    def handle(self, *args, **kwargs):
+        scenarios = [scenario for scenario in kwargs['scenarios'].split(',') if scenario]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+        if kwargs['requests'] < 1 or kwargs['poll_clients'] < 1 \
+                or min(kwargs['concurrency'] + kwargs['articles'] + kwargs['page_sizes']) < 1:
+            raise CommandError('Counts must be positive')
+        if min(kwargs['poll_rating_rates'], default=0) < 0:
+            raise CommandError('--poll-rating-rates must not be negative')
+        if not 0 <= kwargs['poll_write_ratio'] < 1:
+            raise CommandError('--poll-write-ratio must be in [0, 1)')
+
+        self.requests = kwargs['requests']
+        self.random = random.Random(kwargs['seed'])
+        self.factory = APIRequestFactory()
+        self.results = []
+
+        self.isolate_redis(kwargs['fake_redis'], kwargs['redis_db'])
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        for alias in REPLICAS:
+            # Replica reads must see the throwaway database too
+            connections[alias].creation.set_as_test_mirror(connection.settings_dict)
+        try:
+            for num_articles in kwargs['articles']:
+                article_ids = self.create_articles(num_articles)
+                if 'rate' in scenarios:
+                    for concurrency in kwargs['concurrency']:
+                        self.run_case('rate', self.rate_request(article_ids), concurrency,
+                                      articles=num_articles)
+                for scenario in ('list', 'cursor'):
+                    if scenario in scenarios:
+                        self.run_list_cases(scenario, article_ids, kwargs)
+                if 'sync' in scenarios:
+                    self.run_sync_case(article_ids, kwargs['sync_runs'])
+                if 'warm' in scenarios:
+                    self.run_warm_case(article_ids)
+                if 'memory' in scenarios:
+                    self.run_memory_case(article_ids, kwargs['page_sizes'])
+                if 'stampede' in scenarios:
+                    self.run_stampede_case(article_ids, kwargs['stampede_concurrency'])
+                if 'poll' in scenarios:
+                    for rating_rate in kwargs['poll_rating_rates']:
+                        for page_size in kwargs['page_sizes']:
+                            for conditional in (False, True):
+                                self.run_poll_case(article_ids, page_size, kwargs['poll_clients'],
+                                                   kwargs['poll_write_ratio'], conditional, rating_rate)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            r.flushdb()
+
+        report = {'meta': self.metadata(kwargs), 'results': self.results}
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f'Results written to {kwargs["output"]}')
+        if kwargs['compare']:
+            self.compare(kwargs['compare'])
+        self.stdout.write(self.style.SUCCESS('Benchmark finished'))
+
+    def isolate_redis(self, fake_redis, redis_db):
+        """Point the shared connection pool at a scratch database."""
+        if REDIS_CLUSTER:
+            raise CommandError('The benchmark flushes its database, so it needs a standalone Redis, not a cluster')
+        if fake_redis:
+            try:
+                import fakeredis
+            except ImportError:
+                raise CommandError('--fake-redis needs the fakeredis package (and lupa for the Lua scripts)')
+            pool.connection_class = fakeredis.FakeConnection
+            pool.connection_kwargs = {'server': fakeredis.FakeServer()}
+        else:
+            if redis_db == REDIS_DB:
+                raise CommandError(f'--redis-db must not be the application database ({REDIS_DB})')
+            pool.connection_kwargs['db'] = redis_db
+        pool.reset()
+        r.flushdb()
+
+    def create_articles(self, num_articles):
+        Rating.objects.all().delete()
+        Article.objects.all().delete()
+        r.flushdb()
+        Article.objects.bulk_create(
+            [Article(title=f'Benchmark article {i}', content='') for i in range(num_articles)],
+            batch_size=5000
+        )
+        # bulk_create skips the signals that maintain the list index
+        CachedArticleList(r).rebuild_index()
+        return list(Article.objects.order_by('id').values_list('id', flat=True))
+
+    def create_user_ratings(self, user_id, article_ids, count):
+        Rating.objects.filter(user_id=user_id).delete()
+        r.delete(user_ratings_key(user_id))
+        Rating.objects.bulk_create(
+            [Rating(article_id=article_id, user_id=user_id, score=article_id % 6)
+             for article_id in self.random.sample(article_ids, min(count, len(article_ids)))],
+            batch_size=5000
+        )
+
+    def rate_request(self, article_ids):
+        view = RatingView.as_view()
+        counter = iter(range(RATE_USER_ID, RATE_USER_ID + 10 ** 9))
+        lock = threading.Lock()
+
+        def request():
+            with lock:
+                user_id = next(counter)
+                article_id = self.random.choice(article_ids)
+                score = self.random.randint(0, 5)
+            return view(self.factory.post(
+                f'/rating/article/{article_id}/rate/', {'user_id': user_id, 'score': score}, format='json'
+            ), article_id=article_id)
+        return request
+
+    def run_list_cases(self, scenario, article_ids, kwargs):
+        view = ArticleListView.as_view()
+        for user_ratings in kwargs['user_ratings']:
+            user_id = LIST_USER_ID + user_ratings
+            self.create_user_ratings(user_id, article_ids, user_ratings)
+            for page_size in kwargs['page_sizes']:
+                num_pages = max(1, len(article_ids) // page_size)
+                for concurrency in kwargs['concurrency']:
+                    if scenario == 'list':
+                        request = self.page_request(view, user_id, page_size, num_pages)
+                    else:
+                        request = self.cursor_request(view, user_id, page_size)
+                    self.run_case(scenario, request, concurrency, articles=len(article_ids),
+                                  page_size=page_size, user_ratings=user_ratings)
+
+    def page_request(self, view, user_id, page_size, num_pages):
+        def request():
+            page = self.random.randint(1, num_pages)
+            return view(self.factory.get('/rating/article/list/', {
+                'user_id': user_id, 'page': page, 'page_size': page_size,
+            }))
+        return request
+
+    def cursor_request(self, view, user_id, page_size):
+        # Every thread walks the pages by following the next links
+        state = threading.local()
+
+        def request():
+            params = getattr(state, 'params', None)
+            if params is None:
+                params = {
+                    'user_id': user_id, 'page_size': page_size, 'pagination': 'cursor',
+                    'ordering': self.random.choice(('recent', 'rating', 'count')),
+                }
+            response = view(self.factory.get('/rating/article/list/', params))
+            next_link = response.data.get('next') if response.status_code == 200 else None
+            state.params = dict(parse_qsl(urlsplit(next_link).query)) if next_link else None
+            return response
+        return request
+
+    def run_case(self, scenario, request, concurrency, **params):
+        """Send self.requests requests from `concurrency` threads and record one result."""
+        latencies = []
+        queries = []
+        errors = []
+        lock = threading.Lock()
+        per_thread = [self.requests // concurrency + (i < self.requests % concurrency) for i in range(concurrency)]
+
+        def worker(count):
+            try:
+                for _ in range(count):
+                    with CaptureQueriesContext(connection) as captured:
+                        started = time.perf_counter()
+                        try:
+                            response = request()
+                            status = response.status_code
+                        except Exception as e:
+                            status = repr(e)
+                        elapsed = time.perf_counter() - started
+                    with lock:
+                        if status == 200:
+                            latencies.append(elapsed)
+                            queries.append(len(captured.captured_queries))
+                        else:
+                            errors.append(str(status))
+            finally:
+                connection.close()
+
+        reset_command_stats()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(worker, per_thread))
+        elapsed = time.perf_counter() - started
+        self.record(scenario, params, concurrency, latencies, queries, errors, elapsed, len(latencies))
+
+    def run_sync_case(self, article_ids, runs):
+        """Time sync_articles_from_redis with every article dirty."""
+        CachedArticleList(r).fetch_articles(article_ids)  # seed the hashes
+        latencies = []
+        queries = []
+        reset_command_stats()
+        started = time.perf_counter()
+        shards = {}
+        for article_id in article_ids:
+            shards.setdefault(article_shard(article_id), []).append(article_id)
+        for _ in range(runs):
+            for shard, shard_ids in shards.items():
+                r.sadd(dirty_articles_key(shard), *shard_ids)
+            with CaptureQueriesContext(connection) as captured:
+                run_started = time.perf_counter()
+                sync_articles_from_redis()
+                latencies.append(time.perf_counter() - run_started)
+            queries.append(len(captured.captured_queries))
+        elapsed = time.perf_counter() - started
+        self.record('sync', {'articles': len(article_ids)}, 1, latencies, queries, [], elapsed, len(latencies),
+                    articles_per_second=len(article_ids) * runs / sum(latencies))
+
+    def run_warm_case(self, article_ids):
+        """Time warm_redis_cache after flushing the Redis database."""
+        r.flushdb()
+        reset_command_stats()
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            warm_redis_cache()
+            elapsed = time.perf_counter() - started
+        self.record('warm', {'articles': len(article_ids)}, 1, [elapsed], [len(captured.captured_queries)], [],
+                    elapsed, 1, articles_per_second=len(article_ids) / elapsed)
+        self.stdout.write(f'  {len(article_ids) / elapsed:.0f} articles per second')
+
+    def run_stampede_case(self, article_ids, concurrency, user_ratings=1000):
+        """
+        Drop the list index and a user's ratings hash, then send `concurrency`
+        list requests for that user at the same moment and count how many
+        times each cache was rebuilt from the database.
+        """
+        view = ArticleListView.as_view()
+        user_id = LIST_USER_ID + user_ratings
+        self.create_user_ratings(user_id, article_ids, user_ratings)
+        r.delete(*CachedArticleList.index_keys, user_ratings_key(user_id))
+
+        caches = ('article_index', 'user_ratings')
+        rebuilds = {cache: self.rebuild_count(cache) for cache in caches}
+        barrier = threading.Barrier(concurrency)
+        latencies = []
+        queries = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                barrier.wait()
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    try:
+                        status = view(self.factory.get('/rating/article/list/', {'user_id': user_id})).status_code
+                    except Exception as e:
+                        status = repr(e)
+                    elapsed = time.perf_counter() - started
+                with lock:
+                    if status == 200:
+                        latencies.append(elapsed)
+                        queries.append(len(captured.captured_queries))
+                    else:
+                        errors.append(str(status))
+            finally:
+                connection.close()
+
+        reset_command_stats()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _ in range(concurrency):
+                executor.submit(worker)
+        elapsed = time.perf_counter() - started
+        rebuilds = {cache: self.rebuild_count(cache) - count for cache, count in rebuilds.items()}
+        self.record('stampede', {'articles': len(article_ids)}, concurrency, latencies, queries, errors, elapsed,
+                    len(latencies), rebuilds=rebuilds)
+        self.stdout.write('  rebuilds: ' + ', '.join(f'{cache} {count:.0f}' for cache, count in rebuilds.items()))
+
+    def rate_in_background(self, article_ids, per_second):
+        """
+        Rate random articles `per_second` times a second in another thread.
+        The returned function stops it and returns the statuses of the
+        ratings that failed, and how many were sent.
+        """
+        rate = self.rate_request(article_ids)
+        stopped = threading.Event()
+        errors = []
+        sent = 0
+
+        def worker():
+            nonlocal sent
+            try:
+                while not stopped.wait(1 / per_second):
+                    try:
+                        status = rate().status_code
+                    except Exception as e:
+                        status = repr(e)
+                    sent += 1
+                    if status != 200:
+                        errors.append(str(status))
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+
+        def stop():
+            stopped.set()
+            thread.join()
+            return errors, sent
+        return stop
+
+    def run_poll_case(self, article_ids, page_size, clients, write_ratio, conditional, rating_rate=0):
+        """
+        Clients poll a fixed list page each, among occasional rating writes.
+        With `conditional`, they send the ETag of the last page they got, as
+        browsers and HTTP caches do. With `rating_rate`, another thread rates
+        random articles that many times a second meanwhile, as other users
+        do. Records the CPU time and body bytes per poll, and how many were
+        answered 304 and the bytes that saved. The Redis calls per request
+        include those of the writes.
+        """
+        view = ArticleListView.as_view()
+        rate = self.rate_request(article_ids)
+        num_pages = max(1, len(article_ids) // page_size)
+        pages = [self.random.randint(1, num_pages) for _ in range(clients)]
+        etags = [None] * clients
+        sizes = [0] * clients
+
+        latencies = []
+        cpu_times = []
+        queries = []
+        errors = []
+        sent = saved = not_modified = 0
+        reset_command_stats()
+        stop_rating = self.rate_in_background(article_ids, rating_rate) if rating_rate else None
+        started = time.perf_counter()
+        for _ in range(self.requests):
+            if self.random.random() < write_ratio:
+                rate()
+                continue
+            client = self.random.randrange(clients)
+            headers = {'HTTP_IF_NONE_MATCH': etags[client]} if conditional and etags[client] else {}
+            request = self.factory.get('/rating/article/list/', {'page': pages[client], 'page_size': page_size},
+                                       **headers)
+            with CaptureQueriesContext(connection) as captured:
+                cpu_started = time.thread_time()
+                request_started = time.perf_counter()
+                response = view(request)
+                response.render()
+                latency = time.perf_counter() - request_started
+                cpu_time = time.thread_time() - cpu_started
+            if response.status_code == 304:
+                not_modified += 1
+                saved += sizes[client]
+            elif response.status_code == 200:
+                etags[client] = response.get('ETag')
+                sizes[client] = len(response.content)
+            else:
+                errors.append(str(response.status_code))
+                continue
+            sent += len(response.content)
+            latencies.append(latency)
+            cpu_times.append(cpu_time)
+            queries.append(len(captured.captured_queries))
+        elapsed = time.perf_counter() - started
+        rating_errors, ratings = stop_rating() if stop_rating else ([], 0)
+
+        count = len(latencies)
+        page = ArticleListView.as_view()(self.factory.get('/rating/article/list/', {'page_size': page_size})).data
+        render_us = {
+            name: self.time_render(renderer, page)
+            for name, renderer in (('json', JSONRenderer()), ('orjson', FastJSONRenderer()))
+        }
+        self.record('poll', {'articles': len(article_ids), 'page_size': page_size, 'conditional': conditional,
+                             'rating_rate': rating_rate},
+                    1, latencies, queries, errors, elapsed, count,
+                    cpu_us_per_request=statistics.mean(cpu_times) * 10 ** 6 if cpu_times else 0.0,
+                    bytes_per_request=sent / max(count, 1), bytes_saved_per_request=saved / max(count, 1),
+                    not_modified_ratio=not_modified / max(count, 1), render_us_per_page=render_us,
+                    background_ratings=ratings, background_rating_errors=len(rating_errors))
+        self.stdout.write(
+            f'  {statistics.mean(cpu_times) * 10 ** 6 if cpu_times else 0:.0f} us CPU per poll, '
+            f'{sent / max(count, 1):.0f} bytes sent and {saved / max(count, 1):.0f} saved per poll, '
+            f'{not_modified / max(count, 1):.0%} not modified; page render '
+            + ', '.join(f'{name} {us:.1f} us' for name, us in render_us.items())
+        )
+        if rating_errors:
+            self.stdout.write(self.style.WARNING(
+                f'  {len(rating_errors)} of {ratings} background ratings failed, first: {rating_errors[0]}'
+            ))
+
+    def time_render(self, renderer, data):
+        started = time.perf_counter()
+        for _ in range(self.requests):
+            renderer.render(data)
+        return (time.perf_counter() - started) / self.requests * 10 ** 6
+
+    @staticmethod
+    def rebuild_count(cache):
+        return REGISTRY.get_sample_value('bitpin_cache_rebuilds_total', {'cache': cache}) or 0
+
+    def run_memory_case(self, article_ids, page_sizes, sample_size=1000):
+        """
+        Measure the Redis memory of the article hashes and the cost of
+        decoding a page of them. Earlier scenarios have rated some articles,
+        so the sample holds both rated and never-rated hashes.
+        """
+        articles = CachedArticleList(r)
+        for start in range(0, len(article_ids), 1000):
+            articles.fetch_articles(article_ids[start:start + 1000])  # seed the missing hashes
+
+        sample = self.random.sample(article_ids, min(sample_size, len(article_ids)))
+        pipe = r.pipeline(transaction=False)
+        for article_id in sample:
+            pipe.hgetall(article_key(article_id))
+        payload = [sum(len(field) + len(value) for field, value in fields.items()) for fields in pipe.execute()]
+        try:
+            pipe = r.pipeline(transaction=False)
+            for article_id in sample:
+                pipe.memory_usage(article_key(article_id))
+            memory = statistics.mean(pipe.execute())
+        except ResponseError:
+            memory = None  # fakeredis has no MEMORY USAGE
+
+        decode_us = {}
+        for page_size in page_sizes:
+            page = article_ids[:page_size]
+            results = hmget_many([article_key(article_id) for article_id in page], *articles.fields)
+            started = time.perf_counter()
+            for _ in range(self.requests):
+                articles.decode_articles(page, results)
+            decode_us[page_size] = (time.perf_counter() - started) / self.requests * 10 ** 6
+
+        self.results.append({
+            'scenario': 'memory',
+            'articles': len(article_ids),
+            'hash_memory_bytes': memory,
+            'hash_payload_bytes': statistics.mean(payload),
+            'decode_us_per_page': decode_us,
+        })
+        self.stdout.write(
+            f'memory articles={len(article_ids)}: '
+            f'{"n/a" if memory is None else f"{memory:.0f}"} bytes per hash (MEMORY USAGE), '
+            f'{statistics.mean(payload):.0f} bytes of fields and values, decode '
+            + ', '.join(f'{us:.1f} us per {size} articles' for size, us in decode_us.items())
+        )
+
+    def record(self, scenario, params, concurrency, latencies, queries, errors, elapsed, count, **extra):
+        stats = command_stats()
+        redis_calls = sum(command['calls'] for command in stats.values())
+        result = {
+            'scenario': scenario,
+            **params,
+            'concurrency': concurrency,
+            'requests': count,
+            'errors': len(errors),
+            'throughput': count / elapsed if elapsed else 0.0,
+            'latency_ms': summarize(latencies),
+            'db_queries_per_request': statistics.mean(queries) if queries else 0.0,
+            'redis_calls_per_request': redis_calls / max(count + len(errors), 1),
+            'redis_commands': {name: command['calls'] for name, command in sorted(stats.items())},
+            **extra,
+        }
+        self.results.append(result)
+
+        latency = result['latency_ms']
+        label = ' '.join(f'{key}={value}' for key, value in params.items())
+        self.stdout.write(
+            f'{scenario:<6} {label} concurrency={concurrency}: {result["throughput"]:.1f} req/s, '
+            f'p50 {latency.get("p50", 0):.2f} ms, p95 {latency.get("p95", 0):.2f} ms, '
+            f'p99 {latency.get("p99", 0):.2f} ms, {result["db_queries_per_request"]:.1f} queries, '
+            f'{result["redis_calls_per_request"]:.1f} redis calls'
+        )
+        if errors:
+            self.stdout.write(self.style.WARNING(f'  {len(errors)} failed, first: {errors[0]}'))
+
+    def metadata(self, kwargs):
+        try:
+            commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                    check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            'commit': commit,
+            'created_at': datetime.now(dt_timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'redis': 'fakeredis' if kwargs['fake_redis'] else 'redis',
+            'requests': kwargs['requests'],
+            'seed': kwargs['seed'],
+        }
+
+    @staticmethod
+    def case_key(result):
+        return tuple(result.get(key) for key in CASE_KEYS)
+
+    def compare(self, path):
+        with open(path) as f:
+            baseline = {self.case_key(result): result for result in json.load(f)['results']}
+
+        self.stdout.write(f'Compared with {path}:')
+        for result in self.results:
+            old = baseline.get(self.case_key(result))
+            if old and result['scenario'] == 'memory':
+                change = (result['hash_payload_bytes'] / old['hash_payload_bytes'] - 1) * 100
+                self.stdout.write(f'  memory articles={result["articles"]}: hash payload {change:+.1f}%')
+                continue
+            if not old or not old['throughput'] or not old['latency_ms']:
+                continue
+            changes = [f'throughput {(result["throughput"] / old["throughput"] - 1) * 100:+.1f}%']
+            for quantile in ('p50', 'p99'):
+                if old['latency_ms'].get(quantile) and result['latency_ms'].get(quantile):
+                    change = (result['latency_ms'][quantile] / old['latency_ms'][quantile] - 1) * 100
+                    changes.append(f'{quantile} {change:+.1f}%')
+            label = ' '.join(f'{key}={value}' for key, value in zip(CASE_KEYS[1:], self.case_key(result)[1:])
+                             if value is not None)
+            self.stdout.write(f'  {result["scenario"]:<6} {label}: {", ".join(changes)}')
@@ -0,0 +1,71 @@
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Compare sync and async endpoint throughput with many concurrent HTTP clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000', help='Server under test (run it via ASGI)')
+        parser.add_argument('--clients', type=int, default=1000, help='Concurrent clients per endpoint')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds to load each endpoint')
+        parser.add_argument('--path', action='append', dest='paths',
+                            help='Endpoint to load, may be repeated (defaults to the sync and async list)')
+
+    def handle(self, *args, **kwargs):
+        base_url = urlsplit(kwargs['base_url'])
+        if base_url.scheme != 'http':
+            raise CommandError('Only plain http base URLs are supported')
+        paths = kwargs['paths'] or [
+            '/rating/article/list/?user_id=1',
+            '/rating/async/article/list/?user_id=1',
+        ]
+
+        for path in paths:
+            latencies, errors, elapsed = asyncio.run(
+                self.run_load(base_url.hostname, base_url.port or 80, path, kwargs['clients'], kwargs['duration'])
+            )
+            self.report(path, latencies, errors, elapsed)
+
+    async def run_load(self, host, port, path, clients, duration):
+        latencies = []
+        errors = []
+        deadline = time.monotonic() + duration
+        request = f'GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n'.encode()
+
+        async def client():
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    reader, writer = await asyncio.open_connection(host, port)
+                    writer.write(request)
+                    await writer.drain()
+                    response = await reader.read()
+                    writer.close()
+                except OSError as e:
+                    errors.append(str(e))
+                    continue
+                if response.startswith(b'HTTP/1.1 200') or response.startswith(b'HTTP/1.0 200'):
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors.append(response.split(b'\r\n', 1)[0].decode(errors='replace'))
+
+        started = time.monotonic()
+        await asyncio.gather(*(client() for _ in range(clients)))
+        return latencies, errors, time.monotonic() - started
+
+    def report(self, path, latencies, errors, elapsed):
+        self.stdout.write(f'{path}')
+        self.stdout.write(f'  requests: {len(latencies)} ok, {len(errors)} failed in {elapsed:.1f} s')
+        self.stdout.write(f'  throughput: {len(latencies) / elapsed:.1f} req/s')
+        if len(latencies) > 1:
+            cuts = statistics.quantiles(latencies, n=100)
+            self.stdout.write(
+                f'  latency p50 {cuts[49] * 1000:.1f} ms, p95 {cuts[94] * 1000:.1f} ms, p99 {cuts[98] * 1000:.1f} ms'
+            )
+        if errors:
+            self.stdout.write(self.style.WARNING(f'  first error: {errors[0]}'))
@@ -0,0 +1,78 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory
+
+from BitPin.apps.rating.models import Article, Rating
+from BitPin.apps.rating.redis_client import r, user_ratings_key
+from BitPin.apps.rating.views import ArticleListView
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the user_ratings cache of the article list for a user with many ratings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ratings', type=int, default=10000, help='Number of ratings the user has')
+        parser.add_argument('--requests', type=int, default=200, help='Number of list requests to time')
+        parser.add_argument('--page-size', type=int, default=10, help='Articles per page')
+        parser.add_argument('--user-id', type=int, default=10 ** 9,
+                            help='Synthetic user id; its ratings are removed afterwards')
+
+    def handle(self, *args, **kwargs):
+        num_ratings = kwargs['ratings']
+        num_requests = kwargs['requests']
+        page_size = kwargs['page_size']
+        user_id = kwargs['user_id']
+        user_rating_key = user_ratings_key(user_id)
+
+        article_ids = list(Article.objects.order_by('id').values_list('id', flat=True)[:num_ratings])
+        if len(article_ids) < num_ratings:
+            raise CommandError(f'Only {len(article_ids)} articles exist, run populate_db first')
+
+        Rating.objects.filter(user_id=user_id).delete()
+        r.delete(user_rating_key)
+        Rating.objects.bulk_create(
+            [Rating(article_id=article_id, user_id=user_id, score=article_id % 6) for article_id in article_ids],
+            batch_size=5000
+        )
+
+        view = ArticleListView.as_view()
+        factory = APIRequestFactory()
+        num_pages = max(1, len(article_ids) // page_size)
+        rating_table = Rating._meta.db_table
+
+        latencies = []
+        hits = 0
+        try:
+            for i in range(num_requests):
+                request = factory.get('/rating/article/list/', {
+                    'user_id': user_id,
+                    'page': i % num_pages + 1,
+                    'page_size': page_size,
+                })
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    response = view(request)
+                    latencies.append(time.perf_counter() - started)
+
+                if response.status_code != 200:
+                    raise CommandError(f'Article list returned {response.status_code}')
+                if not any(rating_table in query['sql'] for query in queries.captured_queries):
+                    hits += 1
+        finally:
+            Rating.objects.filter(user_id=user_id).delete()
+            r.delete(user_rating_key)
+
+        self.stdout.write(f'User ratings: {num_ratings}, requests: {num_requests}, page size: {page_size}')
+        self.stdout.write(f'Cache hit rate: {hits / num_requests:.2%}')
+        self.stdout.write(f'Cold request: {latencies[0] * 1000:.2f} ms')
+        if len(latencies) > 1:
+            cuts = statistics.quantiles(latencies, n=100)
+            self.stdout.write(
+                f'Latency mean {statistics.mean(latencies) * 1000:.2f} ms, p50 {cuts[49] * 1000:.2f} ms, '
+                f'p95 {cuts[94] * 1000:.2f} ms, p99 {cuts[98] * 1000:.2f} ms'
+            )
+        self.stdout.write(self.style.SUCCESS('Benchmark finished'))
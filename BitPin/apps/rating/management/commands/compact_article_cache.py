@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from BitPin.apps.rating.redis_client import r
+from BitPin.apps.rating.scripts import COMPACT_ARTICLE
+
+# article_{id} hashes, not the article_index* sorted sets
+ARTICLE_KEY_PATTERN = 'article_[0-9]*'
+
+
+class Command(BaseCommand):
+    help = ('Rewrite article hashes cached by older versions in the current, smaller format. '
+            'Safe to run while the site is up and to run more than once.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Hashes per pipeline')
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive')
+
+        compact_article = r.register_script(COMPACT_ARTICLE)
+        started = time.monotonic()
+        scanned = compacted = 0
+        batch = []
+        for key in r.scan_iter(match=ARTICLE_KEY_PATTERN, count=batch_size, _type='hash'):
+            batch.append(key)
+            if len(batch) == batch_size:
+                compacted += self.compact_batch(compact_article, batch)
+                scanned += len(batch)
+                batch = []
+        if batch:
+            compacted += self.compact_batch(compact_article, batch)
+            scanned += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Compacted {compacted} of {scanned} article hashes in {time.monotonic() - started:.2f} s'
+        ))
+
+    @staticmethod
+    def compact_batch(compact_article, keys):
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            compact_article(keys=[key], client=pipe)
+        return sum(pipe.execute())
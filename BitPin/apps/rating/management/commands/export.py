@@ -0,0 +1,54 @@
+import gzip
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from BitPin.apps.rating.export import EXPORT_DATASETS, EXPORT_FORMATS, export_chunks
+from BitPin.settings import EXPORT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = ('Export every article (optionally with one user\'s ratings) or every rating as NDJSON or CSV. '
+            'Rows are streamed from a server-side cursor, so memory stays flat however many there are.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=EXPORT_DATASETS)
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+        parser.add_argument('--user-id', type=int, default=None,
+                            help="Add this user's rating to each article, or export only their ratings")
+        parser.add_argument('--output', '-o', default='-', help='File to write, or - for stdout')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help='Rows per cursor fetch and per write')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+
+        to_stdout = kwargs['output'] == '-'
+        output = sys.stdout.buffer if to_stdout else open(kwargs['output'], 'wb')
+        started = time.monotonic()
+        written = 0
+        try:
+            stream = gzip.GzipFile(fileobj=output, mode='wb') if kwargs['gzip'] else output
+            try:
+                for chunk in export_chunks(kwargs['dataset'], kwargs['format'], kwargs['user_id'],
+                                           kwargs['chunk_size']):
+                    data = chunk.encode()
+                    stream.write(data)
+                    written += len(data)
+            finally:
+                if stream is not output:
+                    stream.close()
+        finally:
+            if to_stdout:
+                output.flush()
+            else:
+                output.close()
+
+        # Keep stdout for the export itself
+        (self.stderr if to_stdout else self.stdout).write(self.style.SUCCESS(
+            f"Exported {kwargs['dataset']} ({written} bytes before compression) "
+            f"in {time.monotonic() - started:.2f} s"
+        ))
@@ -1,29 +1,187 @@
-import random
-from django.core.management.base import BaseCommand
+import csv
+import io
+import time
+from datetime import datetime, timezone as dt_timezone
+from multiprocessing import Pool
+
+import numpy as np
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
 from faker import Faker
-from BitPin.apps.rating.models import Article, Rating
+from BitPin.apps.rating.classes import CachedArticleList, rebuild_trending
+from BitPin.apps.rating.models import Article, Rating, SCORE_COUNT_FIELDS
+from BitPin.apps.rating.redis_client import r
 from django.utils import timezone
 
+faker = None
+
+
+def init_faker():
+    global faker
+    faker = Faker()
+
+
+def generate_texts(task):
+    """(title, content) pairs for one chunk, run in the worker pool."""
+    count, seed = task
+    if seed is not None:
+        faker.seed_instance(seed)
+    return [(faker.sentence(nb_words=6)[:100], faker.paragraph(nb_sentences=10)) for _ in range(count)]
+
+
+def copy_rows(model, fields, rows):
+    """Insert rows with COPY on Postgres, falling back to bulk_create elsewhere."""
+    if connection.vendor != 'postgresql':
+        model.objects.bulk_create([model(**dict(zip(fields, row))) for row in rows])
+        return
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns = ', '.join(connection.ops.quote_name(model._meta.get_field(field).column) for field in fields)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+class RatingGenerator:
+    """
+    Synthetic rating histories.
+
+    Article popularity is Zipfian, each article has a hidden quality that
+    normal raters score around, a fraction of users are outliers who score
+    against it, and a fraction of each article's ratings arrive in a burst of
+    a few seconds, which exercises the outlier damping of the EMA.
+    """
+
+    def __init__(self, num_users, zipf_s, burst_fraction, outlier_fraction, days, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.num_users = num_users
+        self.zipf_s = zipf_s
+        self.burst_fraction = burst_fraction
+        self.days = days
+        self.outlier_users = self.rng.random(num_users + 1) < outlier_fraction
+        self.user_order = self.rng.permutation(num_users) + 1
+
+    def ratings_per_article(self, num_articles, num_ratings):
+        # Random popularity ranks, so the hot articles are spread over the id range
+        ranks = self.rng.permutation(num_articles) + 1
+        weights = 1.0 / ranks ** self.zipf_s
+        counts = self.rng.multinomial(num_ratings, weights / weights.sum())
+        return np.minimum(counts, self.num_users)
+
+    def generate(self, article_ids, counts, now):
+        """Returns (article_ids, user_ids, scores, times) arrays, one row per (article, user)."""
+        positions = np.repeat(np.arange(len(article_ids)), counts)
+        # The k-th rater of an article is the user at a random offset + k in a
+        # shuffled user list, so raters are distinct per article (counts never
+        # exceed num_users), like the unique constraint requires
+        rank = np.arange(len(positions)) - np.repeat(np.cumsum(counts) - counts, counts)
+        offsets = self.rng.integers(0, self.num_users, len(article_ids))
+        users = self.user_order[(offsets[positions] + rank) % self.num_users]
+        articles = article_ids[positions]
+
+        article_quality = self.rng.uniform(1, 5, len(article_ids))[positions]
+        scores = np.clip(np.rint(self.rng.normal(article_quality, 0.8)), 0, 5)
+        outliers = self.outlier_users[users]
+        scores[outliers] = np.where(article_quality[outliers] >= 2.5, 0, 5)
+
+        span = self.days * 86400
+        times = now - self.rng.uniform(0, span, len(articles))
+        burst_start = now - self.rng.uniform(60, span, len(article_ids))
+        burst = self.rng.random(len(articles)) < self.burst_fraction
+        times[burst] = burst_start[positions[burst]] + self.rng.exponential(2.0, burst.sum())
+
+        return articles, users, scores.astype(np.int64), times
+
+
 class Command(BaseCommand):
     help = 'Populate the database with random articles and ratings'
 
     def add_arguments(self, parser):
         parser.add_argument('num_articles', type=int, help='The number of articles to create')
+        parser.add_argument('--ratings', type=int, default=0,
+                            help='Approximate number of ratings to create for the new articles')
+        parser.add_argument('--users', type=int, default=10000, help='Number of distinct raters')
+        parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of article popularity')
+        parser.add_argument('--burst-fraction', type=float, default=0.1,
+                            help='Fraction of ratings that arrive in a burst of a few seconds')
+        parser.add_argument('--outlier-fraction', type=float, default=0.02,
+                            help='Fraction of users who score against the article quality')
+        parser.add_argument('--days', type=int, default=30, help='Spread ratings over this many past days')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Rows per COPY / bulk_create')
+        parser.add_argument('--workers', type=int, default=4, help='Processes generating Faker text')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed for reproducible data')
+        parser.add_argument('--warm-redis', action='store_true',
+                            help='Write the article hashes to Redis instead of loading them lazily')
 
     def handle(self, *args, **kwargs):
-        fake = Faker()
         num_articles = kwargs['num_articles']
+        chunk_size = kwargs['chunk_size']
+        if num_articles < 0 or kwargs['ratings'] < 0 or chunk_size < 1 or kwargs['workers'] < 1:
+            raise CommandError('Counts must not be negative, --chunk-size and --workers must be positive')
 
-        for _ in range(num_articles):
-            article = Article.objects.create(
-                title=fake.sentence(nb_words=6),
-                content=fake.paragraph(nb_sentences=10),
-                created_at=timezone.now(),
-                updated_at=timezone.now(),
-                num_ratings=0,  # Start with 0 ratings
-                avg_rating=0.0,
-            )
-            self.stdout.write(self.style.SUCCESS('Created Article: {article.title}'))
+        started = time.monotonic()
+        first_id = (Article.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+        self.create_articles(num_articles, chunk_size, kwargs['workers'], kwargs['seed'])
+        self.stdout.write(f'Created {num_articles} articles in {time.monotonic() - started:.2f} s')
 
+        article_ids = np.array(list(
+            Article.objects.filter(id__gte=first_id).order_by('id').values_list('id', flat=True)
+        ), dtype=np.int64)
+
+        if kwargs['ratings'] and len(article_ids):
+            started = time.monotonic()
+            generator = RatingGenerator(kwargs['users'], kwargs['zipf'], kwargs['burst_fraction'],
+                                        kwargs['outlier_fraction'], kwargs['days'], kwargs['seed'])
+            created = self.create_ratings(generator, article_ids, kwargs['ratings'], chunk_size)
+            self.stdout.write(f'Created {created} ratings in {time.monotonic() - started:.2f} s')
+
+            # Derive avg_rating, num_ratings and the EMA state from the new histories
+            call_command('recompute_ema', min_id=first_id, workers=kwargs['workers'], no_redis=True,
+                         stdout=self.stdout)
+
+        # Bulk inserts skip the post_save signals and scripts that maintain the indexes
+        indexed = CachedArticleList(r).rebuild_index(chunk_size, load_hashes=kwargs['warm_redis'])
+        rebuild_trending(r)
+        if kwargs['warm_redis']:
+            self.stdout.write(f'Warmed {indexed} article hashes')
 
         self.stdout.write(self.style.SUCCESS(f'Successfully populated {num_articles}'))
+
+    def create_articles(self, num_articles, chunk_size, workers, seed):
+        now = timezone.now()
+        no_scores = [0] * len(SCORE_COUNT_FIELDS)
+        tasks = [
+            (min(chunk_size, num_articles - start), None if seed is None else seed + index)
+            for index, start in enumerate(range(0, num_articles, chunk_size))
+        ]
+        # Forked workers must not inherit the database connection
+        connections.close_all()
+        with Pool(workers, initializer=init_faker) as pool:
+            for texts in pool.imap(generate_texts, tasks):
+                rows = [(title, content, 0, 0.0, *no_scores, now, now) for title, content in texts]
+                with transaction.atomic():
+                    copy_rows(Article, ('title', 'content', 'num_ratings', 'avg_rating', *SCORE_COUNT_FIELDS,
+                                        'created_at', 'updated_at'), rows)
+
+    def create_ratings(self, generator, article_ids, num_ratings, chunk_size):
+        counts = generator.ratings_per_article(len(article_ids), num_ratings)
+        now = timezone.now().timestamp()
+        created = 0
+
+        # Chunks of whole articles, so every (article, user) pair is unique
+        cumulative = np.cumsum(counts)
+        splits = np.unique(np.searchsorted(cumulative, np.arange(chunk_size, cumulative[-1], chunk_size),
+                                           side='right'))
+        for chunk_ids, chunk_counts in zip(np.split(article_ids, splits), np.split(counts, splits)):
+            articles, users, scores, times = generator.generate(chunk_ids, chunk_counts, now)
+            if not len(articles):
+                continue
+            rated_at = [datetime.fromtimestamp(t, tz=dt_timezone.utc) for t in times.tolist()]
+            rows = list(zip(articles.tolist(), users.tolist(), scores.tolist(), rated_at, rated_at))
+            with transaction.atomic():
+                copy_rows(Rating, ('article_id', 'user_id', 'score', 'created_at', 'updated_at'), rows)
+            created += len(rows)
+        return created
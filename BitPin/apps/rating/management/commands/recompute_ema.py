@@ -0,0 +1,314 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Max, Min
+
+from BitPin.apps.rating.models import Article, Rating, SCORES, SCORE_COUNT_FIELDS
+from BitPin.apps.rating.redis_client import r, article_key, article_version_key
+from BitPin.apps.rating.routers import replica_connection
+from BitPin.apps.rating.scripts import index_member
+from BitPin.apps.rating.tasks import update_articles
+from BitPin.apps.rating.views import EMA_K, MIN_TIME_WINDOW_SECOND, OUTLIER_THRESHOLD
+from BitPin.settings import ARTICLE_INDEX_KEY, ARTICLE_RATING_INDEX_KEY, ARTICLE_COUNT_INDEX_KEY, \
+    ARTICLE_TOP_RATED_KEY, ARTICLE_LIST_VERSION_KEY, NUM_RATING_THRESHOLD
+
+NO_TIME = np.iinfo(np.int64).min
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+# Below this many articles still being folded, a plain Python loop is cheaper
+# than one round of NumPy calls per rating
+VECTOR_MIN_ARTICLES = 16
+
+
+def dynamic_alpha(old_ema, score, last_score, time_diff_us):
+    """RatingView.calculate_dynamic_alpha for a time difference in microseconds."""
+    if time_diff_us is None:
+        return 1
+    # Same value as timedelta.total_seconds()
+    time_diff_seconds = time_diff_us / 10 ** 6
+    alpha = time_diff_seconds / (EMA_K + time_diff_seconds)
+    if time_diff_seconds < MIN_TIME_WINDOW_SECOND and score == last_score and abs(
+            old_ema - score) > OUTLIER_THRESHOLD:
+        alpha /= abs(old_ema - score)
+    return alpha
+
+
+class EMAState:
+    """
+    Per-article EMA state: avg_rating, last_score, last rating time in
+    microseconds (NO_TIME if never rated), num_ratings and the number of
+    ratings per score.
+    """
+    fields = ('ema', 'last_score', 'last_time', 'count', 'score_counts')
+
+    def __init__(self, size):
+        self.ema = np.zeros(size)
+        self.last_score = np.full(size, -1.0)
+        self.last_time = np.full(size, NO_TIME, dtype=np.int64)
+        self.count = np.zeros(size, dtype=np.int64)
+        self.score_counts = np.zeros((size, len(SCORES)), dtype=np.int64)
+
+    def get(self, i):
+        return (float(self.ema[i]), float(self.last_score[i]), int(self.last_time[i]), int(self.count[i]),
+                tuple(int(count) for count in self.score_counts[i]))
+
+    def set(self, i, values):
+        self.ema[i], self.last_score[i], self.last_time[i], self.count[i], self.score_counts[i] = values
+
+    def take(self, index):
+        result = EMAState(0)
+        for field in self.fields:
+            setattr(result, field, getattr(self, field)[index])
+        return result
+
+    @classmethod
+    def single(cls, values):
+        state = cls(1)
+        state.set(0, values)
+        return state
+
+
+def fold_ratings(article_ids, scores, times, carried=None):
+    """
+    Fold a chunk of ratings, ordered by (article_id, time), into each article's EMA.
+
+    Articles are folded in lockstep: step k applies the k-th rating of every
+    article that has one, with the same floating point operations as
+    RatingView.calculate_dynamic_alpha, so the results are bit-for-bit equal
+    to folding the ratings one at a time. ``carried`` is the state of an
+    article whose ratings continue from the previous chunk, as
+    (article_id, state tuple); it must be the first article of the chunk.
+    Returns (ids, EMAState) in article id order.
+    """
+    starts = np.flatnonzero(np.r_[True, article_ids[1:] != article_ids[:-1]])
+    lengths = np.diff(np.r_[starts, len(article_ids)])
+    ids = article_ids[starts]
+
+    # Longest histories first, so the articles still being folded are a prefix
+    order = np.argsort(-lengths, kind='stable')
+    starts, lengths = starts[order], lengths[order]
+    state = EMAState(len(ids))
+    if carried is not None:
+        state.set(np.flatnonzero(order == 0)[0], carried[1])
+
+    negative_lengths = -lengths
+    step = 0
+    while step < lengths[0]:
+        active = int(np.searchsorted(negative_lengths, -step, side='left'))
+        if active < VECTOR_MIN_ARTICLES:
+            break
+        idx = starts[:active] + step
+        score = scores[idx]
+        now = times[idx]
+        old_ema = state.ema[:active]
+        last_score = state.last_score[:active]
+        last_time = state.last_time[:active]
+
+        has_last = last_time != NO_TIME
+        time_diff = np.where(has_last, now - np.where(has_last, last_time, now), 0) / 10 ** 6
+        alpha = time_diff / (EMA_K + time_diff)
+        distance = np.abs(old_ema - score)
+        outlier = has_last & (time_diff < MIN_TIME_WINDOW_SECOND) & (score == last_score) & (
+                distance > OUTLIER_THRESHOLD)
+        np.divide(alpha, distance, out=alpha, where=outlier)
+        alpha = np.where(has_last, alpha, 1.0)
+
+        state.ema[:active] = old_ema * (1 - alpha) + score * alpha
+        state.last_score[:active] = score
+        state.last_time[:active] = now
+        state.count[:active] += 1
+        step += 1
+
+    # Finish the few longest histories one rating at a time
+    for i in np.flatnonzero(lengths > step):
+        ema, last_score, last_time, count, score_counts = state.get(i)
+        for j in range(starts[i] + step, starts[i] + lengths[i]):
+            score = float(scores[j])
+            now = int(times[j])
+            alpha = dynamic_alpha(ema, score, last_score, None if last_time == NO_TIME else now - last_time)
+            ema = ema * (1 - alpha) + score * alpha
+            last_score, last_time, count = score, now, count + 1
+        state.set(i, (ema, last_score, last_time, count, score_counts))
+
+    unsorted = np.empty_like(order)
+    unsorted[order] = np.arange(len(order))
+    state = state.take(unsorted)
+
+    # The score counts do not depend on the order, so they are added in one go
+    positions = np.repeat(np.arange(len(ids)), lengths[unsorted])
+    state.score_counts += np.bincount(positions * len(SCORES) + scores.astype(np.int64),
+                                      minlength=len(ids) * len(SCORES)).reshape(-1, len(SCORES))
+    return ids, state
+
+
+def stream_ratings(start_id, stop_id, chunk_size):
+    """Yield (article_ids, scores, times_us) arrays for ratings of articles in [start_id, stop_id)."""
+    # The ratings are read from a replica: ratings submitted while this runs may be overwritten anyway
+    replica = replica_connection()
+    if replica.vendor != 'postgresql':
+        yield from stream_ratings_portable(replica.alias, start_id, stop_id, chunk_size)
+        return
+
+    table = replica.ops.quote_name(Rating._meta.db_table)
+    # A named (server-side) cursor, so memory stays bounded by chunk_size. It
+    # lives in a transaction; WITH HOLD would materialise the whole result.
+    with transaction.atomic(using=replica.alias), replica.chunked_cursor() as cursor:
+        cursor.execute(
+            f"SELECT article_id, score, (EXTRACT(EPOCH FROM updated_at) * 1000000)::bigint "
+            f"FROM {table} WHERE article_id >= %s AND article_id < %s "
+            f"ORDER BY article_id, updated_at, id",
+            [start_id, stop_id]
+        )
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            data = np.array(rows, dtype=np.int64)
+            yield data[:, 0], data[:, 1].astype(np.float64), data[:, 2]
+
+
+def stream_ratings_portable(using, start_id, stop_id, chunk_size):
+    """stream_ratings for databases without EXTRACT(EPOCH ...); the times are converted in Python."""
+    rows = Rating.objects.using(using).filter(article_id__gte=start_id, article_id__lt=stop_id).order_by(
+        'article_id', 'updated_at', 'id'
+    ).values_list('article_id', 'score', 'updated_at').iterator(chunk_size=chunk_size)
+    while chunk := list(islice(rows, chunk_size)):
+        article_ids, scores, rated_at = zip(*chunk)
+        # Integer microseconds, exact like the Postgres query
+        times = [(time - EPOCH) // timedelta(microseconds=1) for time in rated_at]
+        yield (np.array(article_ids, dtype=np.int64), np.array(scores, dtype=np.float64),
+               np.array(times, dtype=np.int64))
+
+
+def write_results(ids, state, update_redis):
+    rows = [
+        (int(article_id), float(ema), int(count), *score_counts)
+        for article_id, ema, count, score_counts in zip(ids, state.ema, state.count, state.score_counts.tolist())
+    ]
+    # The EMA state goes to the database too, so hashes loaded from it later continue the EMA
+    last_states = [
+        (None, None) if last_time == NO_TIME else
+        (int(last_score), datetime.fromtimestamp(last_time / 10 ** 6, tz=dt_timezone.utc))
+        for last_score, last_time in zip(state.last_score.tolist(), state.last_time.tolist())
+    ]
+    with transaction.atomic():
+        update_articles([(*row[:3], *last_state, *row[3:]) for row, last_state in zip(rows, last_states)],
+                        ('avg_rating', 'num_ratings', 'last_score', 'last_rating_time', *SCORE_COUNT_FIELDS))
+
+    if update_redis:
+        # Cached hashes carry the EMA state forward, so they get the new values too
+        pipe = r.pipeline(transaction=False)
+        for i, (article_id, ema, count, *score_counts) in enumerate(rows):
+            pipe.hset(article_key(article_id), mapping={
+                'avg_rating': repr(ema),
+                'num_ratings': count,
+                'last_score': int(state.last_score[i]),
+                'last_rating_time': repr(int(state.last_time[i]) / 10 ** 6),
+                **dict(zip(SCORE_COUNT_FIELDS, score_counts)),
+            })
+        members = [index_member(row[0]) for row in rows]
+        pipe.zadd(ARTICLE_RATING_INDEX_KEY, {m: row[1] for m, row in zip(members, rows)}, xx=True)
+        pipe.zadd(ARTICLE_COUNT_INDEX_KEY, {m: row[2] for m, row in zip(members, rows)}, xx=True)
+        if r.exists(ARTICLE_INDEX_KEY):
+            top_rated = {m: row[1] for m, row in zip(members, rows) if row[2] >= NUM_RATING_THRESHOLD}
+            if top_rated:
+                pipe.zadd(ARTICLE_TOP_RATED_KEY, top_rated)
+            if len(top_rated) < len(members):
+                pipe.zrem(ARTICLE_TOP_RATED_KEY, *(m for m in members if m not in top_rated))
+        for row in rows:
+            pipe.incr(article_version_key(row[0]))
+        pipe.incr(ARTICLE_LIST_VERSION_KEY)
+        pipe.execute()
+    return len(rows)
+
+
+def recompute_shard(start_id, stop_id, chunk_size, update_redis):
+    """Recompute the EMAs of articles in [start_id, stop_id); returns (ratings, articles)."""
+    num_ratings = num_articles = 0
+    carried = None
+    for article_ids, scores, times in stream_ratings(start_id, stop_id, chunk_size):
+        if carried is not None and article_ids[0] != carried[0]:
+            num_articles += write_results(np.array([carried[0]]), EMAState.single(carried[1]), update_redis)
+            carried = None
+
+        ids, state = fold_ratings(article_ids, scores, times, carried)
+        num_ratings += len(article_ids)
+
+        # The last article may continue in the next chunk
+        last = len(ids) - 1
+        carried = (ids[last], state.get(last))
+        if last:
+            num_articles += write_results(ids[:last], state.take(slice(0, last)), update_redis)
+
+    if carried is not None:
+        num_articles += write_results(np.array([carried[0]]), EMAState.single(carried[1]), update_redis)
+    return num_ratings, num_articles
+
+
+def run_shard(start_id, stop_id, chunk_size, update_redis):
+    try:
+        return recompute_shard(start_id, stop_id, chunk_size, update_redis)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = ('Recompute every article\'s avg_rating, num_ratings, EMA state and score counts from the Rating '
+            'table, e.g. after losing Redis or changing EMA_K, MIN_TIME_WINDOW_SECOND or OUTLIER_THRESHOLD. Only '
+            'the latest rating of each user is stored, so the EMA is rebuilt from those. Ratings submitted while '
+            'it runs may be overwritten.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Worker processes')
+        parser.add_argument('--shards', type=int, default=None,
+                            help='Article id ranges to split the work into (default: 8 per worker)')
+        parser.add_argument('--chunk-size', type=int, default=100000, help='Ratings fetched per round trip')
+        parser.add_argument('--no-redis', action='store_true', help='Do not update cached article hashes')
+        parser.add_argument('--min-id', type=int, default=None, help='Only recompute articles from this id on')
+
+    def handle(self, *args, **kwargs):
+        workers = kwargs['workers']
+        chunk_size = kwargs['chunk_size']
+        update_redis = not kwargs['no_redis']
+        if workers < 1 or chunk_size < 1:
+            raise CommandError('--workers and --chunk-size must be positive')
+
+        articles = Article.objects.all()
+        if kwargs['min_id'] is not None:
+            articles = articles.filter(id__gte=kwargs['min_id'])
+        bounds = articles.aggregate(low=Min('id'), high=Max('id'))
+        if bounds['low'] is None:
+            self.stdout.write('No articles to recompute')
+            return
+
+        num_shards = kwargs['shards'] or workers * 8
+        edges = np.unique(np.linspace(bounds['low'], bounds['high'] + 1, num_shards + 1).astype(np.int64))
+        shards = [(int(low), int(high), chunk_size, update_redis) for low, high in zip(edges[:-1], edges[1:])]
+
+        started = time.monotonic()
+        num_ratings = num_articles = 0
+        if workers == 1:
+            for shard in shards:
+                ratings, articles = recompute_shard(*shard)
+                num_ratings += ratings
+                num_articles += articles
+        else:
+            # Forked workers must not share the parent's database connection
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(run_shard, *shard) for shard in shards]
+                for future in as_completed(futures):
+                    ratings, articles = future.result()
+                    num_ratings += ratings
+                    num_articles += articles
+        elapsed = time.monotonic() - started
+
+        self.stdout.write(
+            f'Recomputed {num_articles} articles from {num_ratings} ratings in {elapsed:.2f} s '
+            f'({num_ratings / max(elapsed, 1e-9):,.0f} ratings/s)'
+        )
+        self.stdout.write(self.style.SUCCESS('EMA recomputation finished'))
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from BitPin.apps.rating.tasks import warm_redis_cache
+
+
+class Command(BaseCommand):
+    help = ('Load every article hash, the article list caches and the leaderboards from the database into Redis, '
+            'e.g. after a flush. Hashes already in Redis keep their rating fields. Safe to run while the site is up.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Articles fetched from the server-side cursor and written per pipeline')
+        parser.add_argument('--background', action='store_true', help='Queue the warm_redis_cache Celery task instead')
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive')
+
+        if kwargs['background']:
+            warm_redis_cache.delay(batch_size)
+            self.stdout.write(self.style.SUCCESS('Queued warm_redis_cache'))
+            return
+
+        started = time.monotonic()
+        result = warm_redis_cache(batch_size)
+        if result is None:
+            raise CommandError('The article index is being rebuilt by another worker, try again later')
+        self.stdout.write(self.style.SUCCESS(
+            f"Loaded {result['articles']} articles and {result['trending']} trending articles "
+            f"in {time.monotonic() - started:.2f} s"
+        ))
@@ -0,0 +1,167 @@
+"""
+Prometheus metrics for the rating hot paths.
+
+Requests are timed by ``middleware.MetricsMiddleware``. Every Redis command
+(see ``redis_client``) and every database query (through an execute wrapper
+installed on each new connection) is added to the totals of the request that
+issued it, so the latency of an endpoint can be split into Postgres, Redis and
+Python time. Recording is a few counter increments per call.
+
+With several worker processes, set ``PROMETHEUS_MULTIPROC_DIR`` to a shared,
+empty directory; ``metrics_view`` then aggregates all processes, Celery
+workers on the same host included.
+"""
+import contextvars
+import os
+import time
+
+from celery.signals import task_prerun, task_postrun
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+from prometheus_client import Counter, Histogram, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST, \
+    REGISTRY
+from prometheus_client import multiprocess
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+REQUEST_SECONDS = Histogram(
+    'bitpin_http_request_duration_seconds', 'Request latency', ['endpoint', 'method', 'status']
+)
+REQUEST_DB_QUERIES = Histogram(
+    'bitpin_http_request_db_queries', 'Database queries per request', ['endpoint'], buckets=COUNT_BUCKETS
+)
+REQUEST_DB_SECONDS = Histogram(
+    'bitpin_http_request_db_seconds', 'Time spent in database queries per request', ['endpoint']
+)
+REQUEST_REDIS_COMMANDS = Histogram(
+    'bitpin_http_request_redis_commands', 'Redis round trips per request (a pipeline counts once)', ['endpoint'],
+    buckets=COUNT_BUCKETS
+)
+REQUEST_REDIS_SECONDS = Histogram(
+    'bitpin_http_request_redis_seconds', 'Time spent waiting on Redis per request', ['endpoint']
+)
+REDIS_COMMANDS = Counter('bitpin_redis_commands', 'Redis round trips', ['command'])
+REDIS_ERRORS = Counter('bitpin_redis_command_errors', 'Failed Redis round trips', ['command'])
+REDIS_SECONDS = Counter('bitpin_redis_command_seconds', 'Time spent waiting on Redis', ['command'])
+DB_QUERIES = Counter('bitpin_db_queries', 'Database queries')
+DB_SECONDS = Counter('bitpin_db_query_seconds', 'Time spent in database queries')
+CACHE_LOOKUPS = Counter('bitpin_cache_lookups', 'Cache lookups by cache and result', ['cache', 'result'])
+CACHE_REBUILDS = Counter('bitpin_cache_rebuilds', 'Rebuilds of a cache from the database', ['cache'])
+RATING_LIMIT_DECISIONS = Counter(
+    'bitpin_rating_limit_decisions', 'Single-rating submissions by rate limiter outcome', ['outcome']
+)
+TASK_SECONDS = Histogram(
+    'bitpin_celery_task_duration_seconds', 'Celery task duration', ['task', 'state'],
+    buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+SYNC_PHASE_SECONDS = Histogram(
+    'bitpin_article_sync_phase_seconds', 'Time spent per phase of sync_articles_from_redis', ['phase'],
+    buckets=(.001, .005, .01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+)
+
+# Totals of the request being served; contextvars follow the request into
+# the threads sync_to_async runs the async ORM in
+request_totals = contextvars.ContextVar('request_totals', default=None)
+
+
+class RequestTotals:
+    __slots__ = ('db_queries', 'db_seconds', 'redis_commands', 'redis_seconds')
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.redis_commands = 0
+        self.redis_seconds = 0.0
+
+
+def start_request():
+    totals = RequestTotals()
+    return totals, request_totals.set(totals)
+
+
+def finish_request(token, totals, endpoint, method, status, seconds):
+    request_totals.reset(token)
+    REQUEST_SECONDS.labels(endpoint, method, status).observe(seconds)
+    REQUEST_DB_QUERIES.labels(endpoint).observe(totals.db_queries)
+    REQUEST_DB_SECONDS.labels(endpoint).observe(totals.db_seconds)
+    REQUEST_REDIS_COMMANDS.labels(endpoint).observe(totals.redis_commands)
+    REQUEST_REDIS_SECONDS.labels(endpoint).observe(totals.redis_seconds)
+
+
+def record_redis_command(command, seconds, failed=False):
+    REDIS_COMMANDS.labels(command).inc()
+    REDIS_SECONDS.labels(command).inc(seconds)
+    if failed:
+        REDIS_ERRORS.labels(command).inc()
+    totals = request_totals.get()
+    if totals is not None:
+        totals.redis_commands += 1
+        totals.redis_seconds += seconds
+
+
+def record_cache(cache, hits=0, misses=0):
+    """Count lookups of `cache` ('article', 'article_title', 'user_ratings', 'article_list' or 'leaderboard')."""
+    if hits:
+        CACHE_LOOKUPS.labels(cache, 'hit').inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache, 'miss').inc(misses)
+
+
+def record_rebuild(cache):
+    """Count a rebuild of `cache` ('article_index', 'trending' or 'user_ratings') from the database."""
+    CACHE_REBUILDS.labels(cache).inc()
+
+
+def record_rating_limit(outcome):
+    """Count a submission that was 'accepted', a 'duplicate', 'limited_user' or 'limited_article'."""
+    RATING_LIMIT_DECISIONS.labels(outcome).inc()
+
+
+def record_sync_phases(stats):
+    for phase in ('claim', 'fetch', 'write'):
+        SYNC_PHASE_SECONDS.labels(phase).observe(stats[f'{phase}_seconds'])
+
+
+def db_execute_wrapper(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - started
+        DB_QUERIES.inc()
+        DB_SECONDS.inc(seconds)
+        totals = request_totals.get()
+        if totals is not None:
+            totals.db_queries += 1
+            totals.db_seconds += seconds
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    if db_execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(db_execute_wrapper)
+
+
+task_started = {}
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def observe_task(task_id=None, task=None, state=None, **kwargs):
+    started = task_started.pop(task_id, None)
+    if started is not None:
+        TASK_SECONDS.labels(task.name, state or 'UNKNOWN').observe(time.perf_counter() - started)
+
+
+def metrics_view(request):
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,44 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import metrics
+
+
+class MetricsMiddleware:
+    """
+    Record latency, query and Redis totals per endpoint.
+
+    Works for sync and async views alike, so it does not force async
+    requests through a thread. The endpoint label is the URL route, which
+    keeps the label set small.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        totals, token = metrics.start_request()
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self.finish(request, response, totals, token, started)
+        return response
+
+    async def __acall__(self, request):
+        totals, token = metrics.start_request()
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.finish(request, response, totals, token, started)
+        return response
+
+    def finish(self, request, response, totals, token, started):
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.route if match else 'unmatched'
+        metrics.finish_request(token, totals, endpoint, request.method, response.status_code,
+                               time.perf_counter() - started)
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rating', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['avg_rating', 'id'], name='rating_arti_avg_rat_4a3fd0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['num_ratings', 'id'], name='rating_arti_num_rat_122184_idx'),
+        ),
+    ]
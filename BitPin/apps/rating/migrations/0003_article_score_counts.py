@@ -0,0 +1,57 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:58
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_score_counts(apps, schema_editor):
+    Article = apps.get_model('rating', 'Article')
+    Rating = apps.get_model('rating', 'Rating')
+    counts = {}
+    for score in range(6):
+        per_article = Rating.objects.filter(article=OuterRef('pk'), score=score).values('article').annotate(
+            count=Count('*')).values('count')
+        counts[f'score_{score}_count'] = Coalesce(Subquery(per_article), 0)
+    Article.objects.update(**counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rating', '0002_article_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='score_0_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='score_1_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='score_2_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='score_3_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='score_4_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='score_5_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_score_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rating', '0003_article_score_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='rating',
+            index=models.Index(fields=['updated_at'], name='rating_rati_updated_3d5d0e_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.2 on 2026-10-18 15:42
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_ema_state(apps, schema_editor):
+    Article = apps.get_model('rating', 'Article')
+    Rating = apps.get_model('rating', 'Rating')
+    latest = Rating.objects.filter(article=OuterRef('pk')).order_by('-updated_at', '-id')
+    Article.objects.update(
+        last_score=Subquery(latest.values('score')[:1]),
+        last_rating_time=Subquery(latest.values('updated_at')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rating', '0004_rating_updated_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='last_score',
+            field=models.SmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='last_rating_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_ema_state, migrations.RunPython.noop),
+    ]
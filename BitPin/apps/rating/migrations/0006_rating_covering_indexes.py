@@ -0,0 +1,61 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:39
+
+from django.contrib.postgres import operations
+from django.db import migrations, models
+
+
+class AddIndexConcurrently(operations.AddIndexConcurrently):
+    """CREATE INDEX CONCURRENTLY on PostgreSQL, which keeps the table writable, and a plain AddIndex elsewhere."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return migrations.AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+        return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return migrations.AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
+        return super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class RemoveIndexConcurrently(operations.RemoveIndexConcurrently):
+    """DROP INDEX CONCURRENTLY on PostgreSQL and a plain RemoveIndex elsewhere."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return migrations.RemoveIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+        return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return migrations.RemoveIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
+        return super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+    # The concurrent operations cannot run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('rating', '0005_article_ema_state'),
+    ]
+
+    operations = [
+        # The new indexes lead with the same columns, so they replace the old ones once built
+        AddIndexConcurrently(
+            model_name='rating',
+            index=models.Index(fields=['user_id', 'article_id'], include=('score',), name='rating_user_article_score_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='rating',
+            index=models.Index(fields=['updated_at'], include=('article_id',), name='rating_updated_article_idx'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='rating',
+            name='rating_rati_user_id_f06737_idx',
+        ),
+        RemoveIndexConcurrently(
+            model_name='rating',
+            name='rating_rati_updated_3d5d0e_idx',
+        ),
+    ]
@@ -0,0 +1,158 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:42
+
+import django.db.models.deletion
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import migrations, models
+from django.utils import timezone
+
+# On PostgreSQL the event log and the rollups are partitioned by month, which
+# Django cannot express: the models are created in the migration state only,
+# and the tables with the SQL below. Primary keys and unique constraints of a
+# partitioned table must include its partition key.
+EVENT_TABLE_SQL = """
+CREATE TABLE rating_ratingevent (
+    id bigint GENERATED BY DEFAULT AS IDENTITY,
+    article_id bigint NOT NULL REFERENCES rating_article (id) DEFERRABLE INITIALLY DEFERRED,
+    user_id integer NOT NULL,
+    score smallint NOT NULL,
+    avg_rating double precision NULL,
+    rated_at timestamp with time zone NOT NULL,
+    stream_id varchar(32) NOT NULL,
+    PRIMARY KEY (id, rated_at),
+    CONSTRAINT rating_event_stream_id_uniq UNIQUE (stream_id, rated_at)
+) PARTITION BY RANGE (rated_at);
+CREATE INDEX rating_event_article_idx ON rating_ratingevent (article_id, rated_at);
+"""
+
+ROLLUP_TABLE_SQL = """
+CREATE TABLE {table} (
+    id bigint GENERATED BY DEFAULT AS IDENTITY,
+    article_id bigint NOT NULL REFERENCES rating_article (id) DEFERRABLE INITIALLY DEFERRED,
+    bucket timestamp with time zone NOT NULL,
+    num_ratings integer NOT NULL,
+    score_sum integer NOT NULL,
+    score_0_count integer NOT NULL,
+    score_1_count integer NOT NULL,
+    score_2_count integer NOT NULL,
+    score_3_count integer NOT NULL,
+    score_4_count integer NOT NULL,
+    score_5_count integer NOT NULL,
+    avg_rating double precision NULL,
+    avg_rating_at timestamp with time zone NULL,
+    PRIMARY KEY (id, bucket),
+    CONSTRAINT {constraint} UNIQUE (article_id, bucket)
+) PARTITION BY RANGE (bucket);
+"""
+
+TABLES = (
+    ('RatingEvent', 'rating_ratingevent'),
+    ('ArticleRatingHourly', 'rating_articleratinghourly'),
+    ('ArticleRatingDaily', 'rating_articleratingdaily'),
+)
+
+
+def month_start(moment, months=0):
+    month = moment.month - 1 + months
+    return datetime(moment.year + month // 12, month % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def create_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        for model_name, table in TABLES:
+            schema_editor.create_model(apps.get_model('rating', model_name))
+        return
+
+    schema_editor.execute(EVENT_TABLE_SQL)
+    schema_editor.execute(ROLLUP_TABLE_SQL.format(table='rating_articleratinghourly',
+                                                  constraint='rating_hourly_article_bucket_uniq'))
+    schema_editor.execute(ROLLUP_TABLE_SQL.format(table='rating_articleratingdaily',
+                                                  constraint='rating_daily_article_bucket_uniq'))
+    # This month and the next; rollups.create_partitions adds later ones
+    now = timezone.now()
+    for model_name, table in TABLES:
+        schema_editor.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+        for months in range(2):
+            start = month_start(now, months)
+            schema_editor.execute(
+                f"CREATE TABLE {table}_p{start:%Y%m} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+                [start, month_start(now, months + 1)]
+            )
+
+
+def drop_tables(apps, schema_editor):
+    for model_name, table in TABLES:
+        schema_editor.delete_model(apps.get_model('rating', model_name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rating', '0006_rating_covering_indexes'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='ArticleRatingDaily',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('bucket', models.DateTimeField()),
+                        ('num_ratings', models.IntegerField(default=0)),
+                        ('score_sum', models.IntegerField(default=0)),
+                        ('score_0_count', models.IntegerField(default=0)),
+                        ('score_1_count', models.IntegerField(default=0)),
+                        ('score_2_count', models.IntegerField(default=0)),
+                        ('score_3_count', models.IntegerField(default=0)),
+                        ('score_4_count', models.IntegerField(default=0)),
+                        ('score_5_count', models.IntegerField(default=0)),
+                        ('avg_rating', models.FloatField(blank=True, null=True)),
+                        ('avg_rating_at', models.DateTimeField(blank=True, null=True)),
+                        ('article', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='rating.article')),
+                    ],
+                    options={
+                        'constraints': [models.UniqueConstraint(fields=('article', 'bucket'), name='rating_daily_article_bucket_uniq')],
+                    },
+                ),
+                migrations.CreateModel(
+                    name='ArticleRatingHourly',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('bucket', models.DateTimeField()),
+                        ('num_ratings', models.IntegerField(default=0)),
+                        ('score_sum', models.IntegerField(default=0)),
+                        ('score_0_count', models.IntegerField(default=0)),
+                        ('score_1_count', models.IntegerField(default=0)),
+                        ('score_2_count', models.IntegerField(default=0)),
+                        ('score_3_count', models.IntegerField(default=0)),
+                        ('score_4_count', models.IntegerField(default=0)),
+                        ('score_5_count', models.IntegerField(default=0)),
+                        ('avg_rating', models.FloatField(blank=True, null=True)),
+                        ('avg_rating_at', models.DateTimeField(blank=True, null=True)),
+                        ('article', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='rating.article')),
+                    ],
+                    options={
+                        'constraints': [models.UniqueConstraint(fields=('article', 'bucket'), name='rating_hourly_article_bucket_uniq')],
+                    },
+                ),
+                migrations.CreateModel(
+                    name='RatingEvent',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('user_id', models.IntegerField()),
+                        ('score', models.SmallIntegerField()),
+                        ('avg_rating', models.FloatField(blank=True, null=True)),
+                        ('rated_at', models.DateTimeField()),
+                        ('stream_id', models.CharField(max_length=32)),
+                        ('article', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='rating_events', to='rating.article')),
+                    ],
+                    options={
+                        'indexes': [models.Index(fields=['article', 'rated_at'], name='rating_event_article_idx')],
+                        'constraints': [models.UniqueConstraint(fields=('stream_id', 'rated_at'), name='rating_event_stream_id_uniq')],
+                    },
+                ),
+            ],
+        ),
+        migrations.RunPython(create_tables, drop_tables),
+    ]
@@ -1,14 +1,36 @@
 from django.db import models
 from django.core.validators import MinValueValidator, MaxValueValidator
 
+SCORES = range(6)
+SCORE_COUNT_FIELDS = tuple(f'score_{score}_count' for score in SCORES)
+
+
 class Article(models.Model):
     title = models.CharField(max_length=100)
     content = models.TextField()
     num_ratings = models.IntegerField(default=0)
     avg_rating = models.FloatField(default=0.0)
+    # Number of ratings per score, kept up to date in Redis and synced with avg_rating
+    score_0_count = models.IntegerField(default=0)
+    score_1_count = models.IntegerField(default=0)
+    score_2_count = models.IntegerField(default=0)
+    score_3_count = models.IntegerField(default=0)
+    score_4_count = models.IntegerField(default=0)
+    score_5_count = models.IntegerField(default=0)
+    # EMA state of the latest rating, synced from Redis with avg_rating so the
+    # hashes can be rebuilt after a flush; null until the article is rated
+    last_score = models.SmallIntegerField(null=True, blank=True)
+    last_rating_time = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination by rating and by rating count
+            models.Index(fields=['avg_rating', 'id']),
+            models.Index(fields=['num_ratings', 'id']),
+        ]
+
 
 class Rating(models.Model):
     article = models.ForeignKey(Article,related_name='ratings', on_delete=models.CASCADE)
@@ -21,5 +43,73 @@ class Rating(models.Model):
     class Meta:
         unique_together = (('article', 'user_id'),)
         indexes = [
-            models.Index(fields=['user_id']),
-        ]
\ No newline at end of file
+            # Covering indexes, so loading a user's ratings and rebuilding
+            # the trending set (recent ratings only) are index-only scans
+            models.Index(fields=['user_id', 'article_id'], include=['score'], name='rating_user_article_score_idx'),
+            models.Index(fields=['updated_at'], include=['article_id'], name='rating_updated_article_idx'),
+        ]
+
+class RatingEvent(models.Model):
+    """
+    Append-only log of accepted ratings, re-rates included, filled from the
+    RATING_LOG_KEY stream by tasks.roll_up_rating_events. Partitioned by
+    month of rated_at on PostgreSQL (see rollups).
+    """
+    # Indexed by rating_event_article_idx, which leads with it
+    article = models.ForeignKey(Article, related_name='rating_events', on_delete=models.CASCADE, db_index=False)
+    user_id = models.IntegerField()
+    score = models.SmallIntegerField()
+    # The article's EMA right after this rating, when the view knew it
+    avg_rating = models.FloatField(null=True, blank=True)
+    rated_at = models.DateTimeField()
+    # Id of the stream entry, so a redelivered entry is logged once
+    stream_id = models.CharField(max_length=32)
+
+    class Meta:
+        constraints = [
+            # Includes the partition key, as unique constraints on partitioned tables must
+            models.UniqueConstraint(fields=['stream_id', 'rated_at'], name='rating_event_stream_id_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['article', 'rated_at'], name='rating_event_article_idx'),
+        ]
+
+
+class ArticleRatingRollup(models.Model):
+    """The ratings of an article in one time bucket, added up from RatingEvent rows."""
+    # Indexed by the (article, bucket) unique constraint of each table
+    article = models.ForeignKey(Article, related_name='+', on_delete=models.CASCADE, db_index=False)
+    # Start of the bucket, in UTC
+    bucket = models.DateTimeField()
+    num_ratings = models.IntegerField(default=0)
+    score_sum = models.IntegerField(default=0)
+    score_0_count = models.IntegerField(default=0)
+    score_1_count = models.IntegerField(default=0)
+    score_2_count = models.IntegerField(default=0)
+    score_3_count = models.IntegerField(default=0)
+    score_4_count = models.IntegerField(default=0)
+    score_5_count = models.IntegerField(default=0)
+    # EMA at bucket close, i.e. after the latest rating in the bucket that
+    # carried one, and when that rating was made
+    avg_rating = models.FloatField(null=True, blank=True)
+    avg_rating_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+
+class ArticleRatingHourly(ArticleRatingRollup):
+
+    class Meta:
+        constraints = [
+            # Also serves the trend queries, which read one article's buckets in order
+            models.UniqueConstraint(fields=['article', 'bucket'], name='rating_hourly_article_bucket_uniq'),
+        ]
+
+
+class ArticleRatingDaily(ArticleRatingRollup):
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['article', 'bucket'], name='rating_daily_article_bucket_uniq'),
+        ]
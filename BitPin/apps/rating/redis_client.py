@@ -0,0 +1,379 @@
+"""
+Shared Redis clients for the rating app.
+
+Views, async views, signals and Celery tasks all use the clients defined here.
+They share one configured connection pool per process, so every code path gets
+the same timeouts, health checks and protocol. The clients also record
+per-command latency counters (see ``command_stats``) and Prometheus metrics.
+
+With ``REDIS_CLUSTER`` the clients are cluster clients, and the key helpers
+below add hash tags, so the keys a Lua script uses together hash to the same
+slot: an article hash shares the tag of its shard with the shard's dirty sets,
+and a user's rate limit bucket shares the user's tag with their recent scores.
+The list caches and leaderboards share the ``{article_index}`` tag (see
+settings). Without a cluster the key names carry no tags.
+"""
+import threading
+import time
+from collections import defaultdict
+
+import redis
+import redis.asyncio
+import redis.asyncio.cluster
+import redis.cluster
+from redis.commands.core import Script, AsyncScript
+
+from . import metrics
+from BitPin.settings import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_MAX_CONNECTIONS, REDIS_SOCKET_TIMEOUT, \
+    REDIS_SOCKET_CONNECT_TIMEOUT, REDIS_HEALTH_CHECK_INTERVAL, REDIS_PROTOCOL, REDIS_CLUSTER, ARTICLE_SHARDS, \
+    DIRTY_ARTICLES_KEY
+
+POOL_KWARGS = {
+    'host': REDIS_HOST,
+    'port': REDIS_PORT,
+    'db': REDIS_DB,
+    'max_connections': REDIS_MAX_CONNECTIONS,
+    'socket_timeout': REDIS_SOCKET_TIMEOUT,
+    'socket_connect_timeout': REDIS_SOCKET_CONNECT_TIMEOUT,
+    'socket_keepalive': True,
+    'health_check_interval': REDIS_HEALTH_CHECK_INTERVAL,
+    'protocol': REDIS_PROTOCOL,
+}
+# A cluster has no databases, and each node gets its own pool
+CLUSTER_KWARGS = {key: value for key, value in POOL_KWARGS.items() if key != 'db'}
+
+
+def hash_tag(tag):
+    """Suffix that puts keys with the same `tag` in one cluster slot; empty without a cluster."""
+    return f"{{{tag}}}" if REDIS_CLUSTER else ''
+
+
+def article_shard(article_id):
+    return int(article_id) % ARTICLE_SHARDS
+
+
+def article_key(article_id):
+    return f"article_{article_id}{hash_tag(f's{article_shard(article_id)}')}"
+
+
+def dirty_articles_key(shard):
+    """The set of articles of `shard` rated since its last sync."""
+    if ARTICLE_SHARDS == 1 and not REDIS_CLUSTER:
+        return DIRTY_ARTICLES_KEY
+    return f"{DIRTY_ARTICLES_KEY}_{shard}{hash_tag(f's{shard}')}"
+
+
+def dirty_articles_syncing_key(shard):
+    """The snapshot of the dirty set that the sync task of `shard` works on."""
+    return f"{dirty_articles_key(shard)}_syncing"
+
+
+def counted_ratings_key(shard):
+    """The stream ids of rating events counted in the hashes of `shard` and not acknowledged yet."""
+    return f"{dirty_articles_key(shard)}_counted"
+
+
+def article_version_key(article_id):
+    """Incremented by every rating of the article, for the ETags of the pages showing it (see etags)."""
+    return f"article_version_{article_id}{hash_tag(f's{article_shard(article_id)}')}"
+
+
+def user_ratings_key(user_id):
+    return f"user_ratings_{user_id}"
+
+
+def user_ratings_lock_key(user_id):
+    return f"user_ratings_{user_id}_lock"
+
+
+def replica_pin_key(user_id):
+    """Set for DATABASE_REPLICA_PIN_SECONDS after the user rates, see routers."""
+    return f"replica_pin_{user_id}"
+
+
+def rate_limit_user_key(user_id):
+    return f"rate_limit_user_{user_id}{hash_tag(f'u{user_id}')}"
+
+
+def rate_limit_article_key(article_id):
+    return f"rate_limit_article_{article_id}"
+
+
+def recent_rating_key(user_id, article_id):
+    return f"recent_rating_{user_id}_{article_id}{hash_tag(f'u{user_id}')}"
+
+
+class CommandStats:
+    """Thread-safe per-command call counts and latencies, in seconds."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'calls': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+
+    def record(self, command, seconds, failed=False):
+        with self._lock:
+            stats = self._stats[command]
+            stats['calls'] += 1
+            stats['errors'] += failed
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {command: dict(stats) for command, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+stats = CommandStats()
+
+
+def record(command, seconds, failed):
+    stats.record(command, seconds, failed)
+    metrics.record_redis_command(command, seconds, failed)
+
+
+def command_name(args):
+    name = args[0]
+    return (name.decode() if isinstance(name, bytes) else str(name)).upper()
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+
+    def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return super().execute(raise_on_error)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return super().execute(raise_on_error)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            record('PIPELINE', time.perf_counter() - started, failed)
+
+
+class InstrumentedRedis(redis.Redis):
+
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return super().execute_command(*args, **options)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            record(command_name(args), time.perf_counter() - started, failed)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedAsyncPipeline(redis.asyncio.client.Pipeline):
+
+    async def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return await super().execute(raise_on_error)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await super().execute(raise_on_error)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            record('PIPELINE', time.perf_counter() - started, failed)
+
+
+class InstrumentedAsyncRedis(redis.asyncio.Redis):
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await super().execute_command(*args, **options)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            record(command_name(args), time.perf_counter() - started, failed)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedAsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class ClusterScript(Script):
+    """
+    A script that is loaded on every primary before its first call: EVALSHA
+    queued in a cluster pipeline cannot fall back to SCRIPT LOAD.
+    """
+
+    def __call__(self, keys=None, args=None, client=None):
+        self.registered_client.load_script(self)
+        return super().__call__(keys, args, client)
+
+
+class InstrumentedClusterPipeline(redis.cluster.ClusterPipeline):
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        # redis-py blocks it in cluster pipelines, which cannot load a missing
+        # script; ClusterScript loads it on every primary first
+        return self.execute_command('EVALSHA', sha, numkeys, *keys_and_args)
+
+    def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return super().execute(raise_on_error)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return super().execute(raise_on_error)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            record('PIPELINE', time.perf_counter() - started, failed)
+
+
+class InstrumentedRedisCluster(redis.cluster.RedisCluster):
+
+    def execute_command(self, *args, **kwargs):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return super().execute_command(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            record(command_name(args), time.perf_counter() - started, failed)
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        # Cluster pipelines are never transactions: the callers that ask for
+        # one only batch idempotent writes, which may land on several nodes
+        return InstrumentedClusterPipeline(
+            nodes_manager=self.nodes_manager,
+            commands_parser=self.commands_parser,
+            startup_nodes=self.nodes_manager.startup_nodes,
+            result_callbacks=self.result_callbacks,
+            cluster_response_callbacks=self.cluster_response_callbacks,
+            cluster_error_retry_attempts=self.cluster_error_retry_attempts,
+            read_from_replicas=self.read_from_replicas,
+            reinitialize_steps=self.reinitialize_steps,
+            lock=self._lock,
+        )
+
+    def register_script(self, script):
+        return ClusterScript(self, script)
+
+    def load_script(self, script):
+        loaded = self.__dict__.setdefault('loaded_scripts', set())
+        if script.sha not in loaded:
+            self.script_load(script.script)
+            loaded.add(script.sha)
+
+
+class AsyncClusterScript(AsyncScript):
+
+    async def __call__(self, keys=None, args=None, client=None):
+        await self.registered_client.load_script(self)
+        if isinstance(client, redis.asyncio.cluster.ClusterPipeline):
+            # Awaiting a cluster pipeline empties it, so queue the call without AsyncScript's await
+            keys = keys or []
+            return client.evalsha(self.sha, len(keys), *keys, *(args or []))
+        return await super().__call__(keys, args, client)
+
+
+class InstrumentedAsyncClusterPipeline(redis.asyncio.cluster.ClusterPipeline):
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        return self.execute_command('EVALSHA', sha, numkeys, *keys_and_args)
+
+    async def execute(self, raise_on_error=True, allow_redirections=True):
+        if not self._command_stack:
+            return await super().execute(raise_on_error, allow_redirections)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await super().execute(raise_on_error, allow_redirections)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            record('PIPELINE', time.perf_counter() - started, failed)
+
+
+class InstrumentedAsyncRedisCluster(redis.asyncio.cluster.RedisCluster):
+
+    async def execute_command(self, *args, **kwargs):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await super().execute_command(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            record(command_name(args), time.perf_counter() - started, failed)
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        return InstrumentedAsyncClusterPipeline(self)
+
+    def register_script(self, script):
+        return AsyncClusterScript(self, script)
+
+    async def load_script(self, script):
+        loaded = self.__dict__.setdefault('loaded_scripts', set())
+        if script.sha not in loaded:
+            await self.script_load(script.script)
+            loaded.add(script.sha)
+
+
+if REDIS_CLUSTER:
+    # Cluster clients keep one pool per node
+    pool = async_pool = None
+    r = InstrumentedRedisCluster(**CLUSTER_KWARGS)
+    ar = InstrumentedAsyncRedisCluster(**CLUSTER_KWARGS)
+else:
+    pool = redis.ConnectionPool(**POOL_KWARGS)
+    r = InstrumentedRedis(connection_pool=pool)
+
+    # Bound to the event loop of the ASGI worker that first uses it
+    async_pool = redis.asyncio.ConnectionPool(**POOL_KWARGS)
+    ar = InstrumentedAsyncRedis(connection_pool=async_pool)
+
+
+def hmget_many(keys, *fields, client=None):
+    """HMGET the same fields from many hashes in a single round trip."""
+    pipe = (client or r).pipeline(transaction=False)
+    for key in keys:
+        pipe.hmget(key, *fields)
+    return pipe.execute()
+
+
+async def ahmget_many(keys, *fields, client=None):
+    async with (client or ar).pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.hmget(key, *fields)
+        return await pipe.execute()
+
+
+def stream_entries(response):
+    """Entries of a single-stream XREAD/XREADGROUP reply, for RESP2 and RESP3 replies."""
+    if not response:
+        return []
+    if isinstance(response, dict):
+        return next(iter(response.values()))[0]
+    return response[0][1]
+
+
+def command_stats():
+    """Per-command calls, errors, total and max latency recorded in this process."""
+    return stats.snapshot()
+
+
+def reset_command_stats():
+    stats.reset()
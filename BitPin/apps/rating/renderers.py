@@ -0,0 +1,23 @@
+import orjson
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that encodes with orjson, which is several times faster than
+    json.dumps on an article page. The output is JSONRenderer's compact form:
+    types orjson does not know, and datetimes, go through DRF's encoder.
+    Requests for indented output are left to JSONRenderer.
+    """
+    encoder = JSONEncoder()
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        # Escaped like JSONRenderer does, for JSON embedded in JavaScript
+        return orjson.dumps(data, default=self.encoder.default, option=self.options) \
+            .replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
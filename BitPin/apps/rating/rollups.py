@@ -0,0 +1,188 @@
+"""
+Rating event log and hourly and daily rollups per article.
+
+The rating views add every accepted rating to the RATING_LOG_KEY stream, with
+the EMA it produced, in the pipeline they already send. tasks.roll_up_rating_events
+moves the entries into the append-only RatingEvent table and adds them to the
+ArticleRatingHourly and ArticleRatingDaily buckets in the same transaction.
+Events are inserted with ON CONFLICT DO NOTHING on their stream id and only
+the inserted ones are rolled up, so a redelivered entry is counted once. A
+trend query reads one row per bucket instead of the article's ratings.
+
+On PostgreSQL the three tables are partitioned by month (see migration 0007),
+so old months can be detached or dropped instead of deleted row by row.
+create_partitions adds the partitions of the coming months ahead of time;
+rows outside every partition land in the default one.
+"""
+import logging
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import connection, transaction, DatabaseError
+from django.utils import timezone
+
+from .models import Article, RatingEvent, ArticleRatingHourly, ArticleRatingDaily, SCORES, SCORE_COUNT_FIELDS
+
+logger = logging.getLogger(__name__)
+
+ROLLUPS = {
+    'hour': ArticleRatingHourly,
+    'day': ArticleRatingDaily,
+}
+ROLLUP_BUCKET_SECONDS = {
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+}
+ROLLUP_FIELDS = ('num_ratings', 'score_sum', *SCORE_COUNT_FIELDS, 'avg_rating', 'avg_rating_at')
+
+PARTITIONED_MODELS = {
+    RatingEvent: 'rated_at',
+    ArticleRatingHourly: 'bucket',
+    ArticleRatingDaily: 'bucket',
+}
+PARTITION_MONTHS_AHEAD = 2
+
+
+def bucket_start(moment, interval):
+    """Start of the UTC hour or day `moment` falls in."""
+    moment = moment.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+    return moment if interval == 'hour' else moment.replace(hour=0)
+
+
+def month_start(moment, months=0):
+    """Start of the UTC month `months` months after the one `moment` falls in."""
+    month = moment.month - 1 + months
+    return datetime(moment.year + month // 12, month % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def create_partitions(months_ahead=PARTITION_MONTHS_AHEAD, now=None):
+    """
+    Create the missing monthly partitions from this month to `months_ahead`
+    months ahead, on PostgreSQL. Returns the names of the created partitions.
+    """
+    if connection.vendor != 'postgresql':
+        return []
+
+    now = now or timezone.now()
+    created = []
+    with connection.cursor() as cursor:
+        for model in PARTITIONED_MODELS:
+            table = model._meta.db_table
+            for months in range(months_ahead + 1):
+                start = month_start(now, months)
+                name = f"{table}_p{start:%Y%m}"
+                cursor.execute("SELECT to_regclass(%s)", [name])
+                if cursor.fetchone()[0] is not None:
+                    continue
+                try:
+                    with transaction.atomic():
+                        cursor.execute(
+                            f"CREATE TABLE {connection.ops.quote_name(name)} "
+                            f"PARTITION OF {connection.ops.quote_name(table)} FOR VALUES FROM (%s) TO (%s)",
+                            [start, month_start(now, months + 1)]
+                        )
+                except DatabaseError as e:
+                    # The default partition already holds rows of that month
+                    logger.warning(f"Could not create partition {name}: {str(e)}")
+                    continue
+                created.append(name)
+    return created
+
+
+def insert_events(events):
+    """
+    Append (stream_id, article_id, user_id, score, avg_rating, rated_at)
+    events to the log, skipping the ones already logged and those of deleted
+    articles. Returns the inserted events.
+    """
+    existing_ids = set(Article.objects.filter(
+        id__in={event[1] for event in events}
+    ).values_list('id', flat=True))
+    events = [event for event in events if event[1] in existing_ids]
+    if not events:
+        return []
+
+    if connection.vendor != 'postgresql':
+        logged = set(RatingEvent.objects.filter(
+            stream_id__in=[event[0] for event in events]
+        ).values_list('stream_id', flat=True))
+        events = [event for event in events if event[0] not in logged]
+        RatingEvent.objects.bulk_create([
+            RatingEvent(stream_id=stream_id, article_id=article_id, user_id=user_id, score=score,
+                        avg_rating=avg_rating, rated_at=rated_at)
+            for stream_id, article_id, user_id, score, avg_rating, rated_at in events
+        ])
+        return events
+
+    table = connection.ops.quote_name(RatingEvent._meta.db_table)
+    values = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(events))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (stream_id, article_id, user_id, score, avg_rating, rated_at) "
+            f"VALUES {values} "
+            f"ON CONFLICT (stream_id, rated_at) DO NOTHING "
+            f"RETURNING stream_id",
+            [value for event in events for value in event]
+        )
+        inserted = {stream_id for stream_id, in cursor.fetchall()}
+    return [event for event in events if event[0] in inserted]
+
+
+def roll_up(events):
+    """Add logged events to their hourly and daily buckets; returns the number of buckets written."""
+    written = 0
+    for interval, model in ROLLUPS.items():
+        buckets = {}
+        for stream_id, article_id, user_id, score, avg_rating, rated_at in events:
+            bucket = buckets.setdefault((article_id, bucket_start(rated_at, interval)),
+                                        [0, 0, *([0] * len(SCORES)), None, None])
+            bucket[0] += 1
+            bucket[1] += score
+            bucket[2 + score] += 1
+            # The EMA at bucket close is that of its latest rating
+            if avg_rating is not None and (bucket[-1] is None or bucket[-1] <= rated_at):
+                bucket[-2], bucket[-1] = avg_rating, rated_at
+        # In key order, so concurrent tasks lock the rows in the same order
+        written += upsert_buckets(model, [(*key, *values) for key, values in sorted(buckets.items())])
+    return written
+
+
+def upsert_buckets(model, rows):
+    """
+    Add (article_id, bucket, *ROLLUP_FIELDS) rows to the buckets of `model`
+    with one INSERT ... ON CONFLICT, keeping the EMA of the latest rating.
+    """
+    if connection.vendor != 'postgresql':
+        existing = {
+            (bucket.article_id, bucket.bucket): bucket
+            for bucket in model.objects.filter(article_id__in={row[0] for row in rows},
+                                               bucket__in={row[1] for row in rows})
+        }
+        created = []
+        for article_id, start, *values in rows:
+            bucket = existing.get((article_id, start))
+            if bucket is None:
+                created.append(model(article_id=article_id, bucket=start, **dict(zip(ROLLUP_FIELDS, values))))
+                continue
+            for field, value in zip(ROLLUP_FIELDS[:-2], values):
+                setattr(bucket, field, getattr(bucket, field) + value)
+            if values[-1] is not None and (bucket.avg_rating_at is None or bucket.avg_rating_at <= values[-1]):
+                bucket.avg_rating, bucket.avg_rating_at = values[-2:]
+        model.objects.bulk_create(created)
+        model.objects.bulk_update(list(existing.values()), ROLLUP_FIELDS)
+        return len(rows)
+
+    table = connection.ops.quote_name(model._meta.db_table)
+    values = ', '.join([f"({', '.join(['%s'] * (len(ROLLUP_FIELDS) + 2))})"] * len(rows))
+    sums = [f"{field} = b.{field} + EXCLUDED.{field}" for field in ROLLUP_FIELDS[:-2]]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} AS b (article_id, bucket, {', '.join(ROLLUP_FIELDS)}) "
+            f"VALUES {values} "
+            f"ON CONFLICT (article_id, bucket) DO UPDATE "
+            f"SET {', '.join(sums)}, "
+            f"avg_rating = CASE WHEN b.avg_rating_at IS NULL OR EXCLUDED.avg_rating_at >= b.avg_rating_at "
+            f"THEN EXCLUDED.avg_rating ELSE b.avg_rating END, "
+            f"avg_rating_at = GREATEST(b.avg_rating_at, EXCLUDED.avg_rating_at)",
+            [value for row in rows for value in row]
+        )
+        return cursor.rowcount
@@ -0,0 +1,59 @@
+"""
+Database router for the read replicas in ``DATABASE_REPLICAS``.
+
+Reads go to the primary unless the code path opts in with ``replica_reads``.
+The paths that do are the ones that tolerate replication lag: rebuilding the
+list caches and leaderboards, reading a page from the database while they are
+missing, loading a user's ratings and backfills. Writes, and reads that
+decide a write (row locks, existence checks), always use the primary.
+
+A user who rated in the last DATABASE_REPLICA_PIN_SECONDS is pinned to the
+primary (read-your-writes): the rating views set ``replica_pin_{user_id}`` in
+Redis, and the list views read it in the pipeline they already send, so
+pinning costs no extra round trip. The choice is kept in a contextvar, which
+follows the request into the threads that run the async ORM.
+"""
+import contextvars
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICAS = [alias for alias in settings.DATABASES if alias.startswith('replica_')]
+
+use_replicas = contextvars.ContextVar('use_replicas', default=False)
+
+
+@contextmanager
+def replica_reads(enabled=True):
+    """Send the reads in the block to a replica, unless `enabled` is False (e.g. the user is pinned)."""
+    token = use_replicas.set(enabled and bool(REPLICAS))
+    try:
+        yield
+    finally:
+        use_replicas.reset(token)
+
+
+def replica_connection():
+    """A connection to a replica for raw SQL reads, or to the primary without replicas."""
+    return connections[random.choice(REPLICAS) if REPLICAS else DEFAULT_DB_ALIAS]
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if use_replicas.get():
+            return random.choice(REPLICAS)
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # Replicas get the schema through replication
+        return db == 'default'
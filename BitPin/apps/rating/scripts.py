@@ -0,0 +1,644 @@
+"""
+Lua scripts executed server-side in Redis.
+
+Each script is registered once per process with ``Redis.register_script`` and
+then invoked with EVALSHA, so a rating costs a single round trip and is applied
+atomically even when many users rate the same article concurrently. In
+cluster mode the article hash and the list caches are in different slots, so
+the caches are updated by a second call (see UPDATE_ARTICLE_INDEXES).
+
+Sorted sets that order articles use the zero-padded id as member (see
+``index_member``), so Redis breaks score ties by descending id when reading in
+reverse, exactly like ``ORDER BY score DESC, id DESC`` in the database.
+"""
+
+INDEX_MEMBER_WIDTH = 12
+
+
+def index_member(article_id):
+    return f"{int(article_id):0{INDEX_MEMBER_WIDTH}d}"
+
+
+# Sorted sets are only written once they exist, otherwise a single member
+# would look like a complete index; see CachedArticleList.rebuild_index.
+#
+# The top rated set may legitimately be empty (hence missing), so it is
+# written once the id index exists, which rebuild_index swaps in together
+# with it.
+#
+# While CachedArticleList.rebuild_index runs, the <id index>_rebuilding key
+# exists and the sets it is building (<set>_building) are written as well, so
+# ratings made during a rebuild survive the swap. The rebuild only adds the
+# members these writes have not (ZADD NX). The building keys share the hash
+# tag of the live sets, so in cluster mode they are in the same slot.
+#
+# The trending score of an article is log(sum(exp(rate * t))) over the times
+# t of its ratings: ordering by it is ordering by sum(exp(-rate * (now - t))),
+# the rating count decayed with rate = ln 2 / TRENDING_HALF_LIFE, at any
+# "now", so scores never have to be decayed in place. Adding a rating is a
+# log-add-exp, which cannot overflow. The set is written even when missing;
+# tasks.rebuild_trending_index rebuilds it from the database every hour.
+INDEX_FUNCTIONS = """
+local function index_member(article_id)
+    return string.format('%%0%dd', tonumber(article_id))
+end
+
+local function rebuilding(id_index)
+    return redis.call('EXISTS', id_index .. '_rebuilding') == 1
+end
+
+local function zadd_if_exists(key, score, article_id, id_index)
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('ZADD', key, score, index_member(article_id))
+    end
+    if rebuilding(id_index) then
+        redis.call('ZADD', key .. '_building', score, index_member(article_id))
+    end
+end
+
+local function update_top_rated(id_index, top_rated, article_id, avg_rating, num_ratings, threshold)
+    if tonumber(num_ratings) < threshold then return end
+    if redis.call('EXISTS', id_index) == 1 then
+        redis.call('ZADD', top_rated, avg_rating, index_member(article_id))
+    end
+    if rebuilding(id_index) then
+        redis.call('ZADD', top_rated .. '_building', avg_rating, index_member(article_id))
+    end
+end
+
+local function index_rating(rating_index, count_index, id_index, top_rated, article_id, avg_rating, num_ratings,
+                            threshold)
+    zadd_if_exists(rating_index, avg_rating, article_id, id_index)
+    zadd_if_exists(count_index, num_ratings, article_id, id_index)
+    update_top_rated(id_index, top_rated, article_id, avg_rating, num_ratings, threshold)
+end
+
+local function add_trending(key, article_id, rate, rated_at)
+    local member = index_member(article_id)
+    local value = rate * rated_at
+    local current = tonumber(redis.call('ZSCORE', key, member))
+    if current then
+        local high = math.max(current, value)
+        value = high + math.log(1 + math.exp(math.min(current, value) - high))
+    end
+    redis.call('ZADD', key, value, member)
+end
+""" % INDEX_MEMBER_WIDTH
+
+# Lua helpers shared by the EMA scripts.
+#
+# apply_rating folds one rating into the article hash and returns
+# {avg_rating, num_ratings}. The alpha calculation mirrors
+# RatingView.calculate_dynamic_alpha exactly. last_rating_time is stored as
+# epoch seconds; legacy ISO-8601 values written by older versions are still
+# understood. Hashes of articles that were never rated have no last_score or
+# last_rating_time, which reads as -1 and no time; hashes written by older
+# versions hold -1 and 'None' instead (see COMPACT_ARTICLE). A rating older
+# than the article's last one (e.g. replayed from an offline client) still
+# counts towards num_ratings but leaves the EMA alone.
+#
+# The per-score counters (score_0_count .. score_5_count) are only touched in
+# hashes that have them: hashes cached before they existed get them from the
+# database through INDEX_ARTICLE, and an increment would stop HSETNX from
+# filling them in.
+EMA_FUNCTIONS = INDEX_FUNCTIONS + """
+local function days_from_civil(y, m, d)
+    if m <= 2 then y = y - 1 end
+    local era = math.floor(y / 400)
+    local yoe = y - era * 400
+    local mp = (m + 9) % 12
+    local doy = math.floor((153 * mp + 2) / 5) + d - 1
+    local doe = yoe * 365 + math.floor(yoe / 4) - math.floor(yoe / 100) + doy
+    return era * 146097 + doe - 719468
+end
+
+local function parse_time(value)
+    if not value or value == 'None' then return nil end
+    local ts = tonumber(value)
+    if ts then return ts end
+    local y, mo, d, h, mi, s, rest = string.match(value,
+        '^(%d+)-(%d+)-(%d+)[T ](%d+):(%d+):([%d%.]+)(.*)$')
+    if not y then return nil end
+    ts = days_from_civil(tonumber(y), tonumber(mo), tonumber(d)) * 86400
+        + tonumber(h) * 3600 + tonumber(mi) * 60 + tonumber(s)
+    local sign, oh, om = string.match(rest, '^([%+%-])(%d%d):?(%d%d)$')
+    if sign then
+        local offset = tonumber(oh) * 3600 + tonumber(om) * 60
+        if sign == '+' then ts = ts - offset else ts = ts + offset end
+    end
+    return ts
+end
+
+local function seed_article(key, seed)
+    if redis.call('EXISTS', key) == 1 then return true end
+    if seed ~= '1' then return false end
+    redis.call('HSET', key, 'num_ratings', 0, 'avg_rating', 0,
+        'score_0_count', 0, 'score_1_count', 0, 'score_2_count', 0,
+        'score_3_count', 0, 'score_4_count', 0, 'score_5_count', 0)
+    return true
+end
+
+local function has_score_counts(key)
+    return redis.call('HEXISTS', key, 'score_0_count') == 1
+end
+
+local function add_score_count(key, score, delta)
+    if delta ~= 0 then
+        redis.call('HINCRBY', key, 'score_' .. score .. '_count', delta)
+    end
+end
+
+local function apply_rating(key, score_arg, created, now_arg, K, min_window, outlier_threshold)
+    local score = tonumber(score_arg)
+    local now = tonumber(now_arg)
+    local fields = redis.call('HMGET', key, 'avg_rating', 'num_ratings', 'last_score', 'last_rating_time')
+    local old_ema = tonumber(fields[1]) or 0
+    local num_ratings = tonumber(fields[2]) or 0
+    local last_score = tonumber(fields[3]) or -1
+    local last_time = parse_time(fields[4])
+    if created then num_ratings = num_ratings + 1 end
+
+    if last_time and now < last_time then
+        redis.call('HSET', key, 'num_ratings', num_ratings)
+        return {fields[1] or '0', num_ratings}
+    end
+
+    local alpha = 1
+    if last_time then
+        local time_diff = now - last_time
+        alpha = time_diff / (K + time_diff)
+        if time_diff < min_window and score == last_score and math.abs(old_ema - score) > outlier_threshold then
+            alpha = alpha / math.abs(old_ema - score)
+        end
+    end
+
+    local ema_str = string.format('%.17g', old_ema * (1 - alpha) + score * alpha)
+    redis.call('HSET', key, 'last_score', score_arg, 'num_ratings', num_ratings,
+        'avg_rating', ema_str, 'last_rating_time', now_arg)
+    return {ema_str, num_ratings}
+end
+"""
+
+# Folds one rating into the article's EMA.
+#
+# KEYS[1]  article hash (article_{id})
+# KEYS[2]  dirty article set of the article's shard, picked up by
+#          tasks.sync_articles_from_redis
+# KEYS[3]  article index ordered by avg_rating
+# KEYS[4]  article index ordered by num_ratings
+# KEYS[5]  article index ordered by id
+# KEYS[6]  top rated leaderboard
+# KEYS[7]  trending leaderboard
+#
+# KEYS[3:7] are left out in cluster mode, where they live in another slot;
+# UPDATE_ARTICLE_INDEXES then updates them in a second call.
+# ARGV[1]  score
+# ARGV[2]  1 if this is a new (article, user) rating, 0 for a re-rate
+# ARGV[3]  rating time as epoch seconds
+# ARGV[4]  K (EMA decay constant in seconds)
+# ARGV[5]  MIN_TIME_WINDOW_SECOND
+# ARGV[6]  OUTLIER_THRESHOLD
+# ARGV[7]  article id
+# ARGV[8]  the user's previous score for a re-rate, -1 for a new rating, or ''
+#          to leave the score counts to tasks.process_rating_entries
+# ARGV[9]  NUM_RATING_THRESHOLD
+# ARGV[10] trending decay rate per second
+# ARGV[11] 1 to initialise a missing hash, 0 to return nil instead
+#
+# Returns {avg_rating, num_ratings}, or nil when the hash is missing and
+# ARGV[11] is 0 so the caller can check the article exists before seeding it.
+UPDATE_ARTICLE_EMA = EMA_FUNCTIONS + """
+if not seed_article(KEYS[1], ARGV[11]) then return nil end
+if ARGV[8] ~= '' and has_score_counts(KEYS[1]) then
+    if ARGV[8] ~= '-1' then add_score_count(KEYS[1], ARGV[8], -1) end
+    add_score_count(KEYS[1], ARGV[1], 1)
+end
+local result = apply_rating(KEYS[1], ARGV[1], ARGV[2] == '1', ARGV[3],
+    tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6]))
+redis.call('SADD', KEYS[2], ARGV[7])
+if #KEYS > 2 then
+    index_rating(KEYS[3], KEYS[4], KEYS[5], KEYS[6], ARGV[7], result[1], result[2], tonumber(ARGV[9]))
+    add_trending(KEYS[7], ARGV[7], tonumber(ARGV[10]), tonumber(ARGV[3]))
+end
+return result
+"""
+
+# Folds a batch of ratings for one article into its EMA, in the order given.
+#
+# KEYS     as for UPDATE_ARTICLE_EMA
+# ARGV[1]  K, ARGV[2] MIN_TIME_WINDOW_SECOND, ARGV[3] OUTLIER_THRESHOLD
+# ARGV[4]  article id
+# ARGV[5]  1 to initialise a missing hash, 0 to return nil instead
+# ARGV[6]  NUM_RATING_THRESHOLD, ARGV[7] trending decay rate per second
+# ARGV[8:13] change of the score_0_count .. score_5_count counters
+# ARGV[14:] (score, created, epoch seconds) triples, oldest first
+#
+# Returns {avg_rating, num_ratings} after the last rating, or nil like
+# UPDATE_ARTICLE_EMA.
+APPLY_ARTICLE_RATINGS = EMA_FUNCTIONS + """
+if not seed_article(KEYS[1], ARGV[5]) then return nil end
+if has_score_counts(KEYS[1]) then
+    for score = 0, 5 do add_score_count(KEYS[1], score, tonumber(ARGV[8 + score])) end
+end
+local K = tonumber(ARGV[1])
+local min_window = tonumber(ARGV[2])
+local outlier_threshold = tonumber(ARGV[3])
+local trending_rate = tonumber(ARGV[7])
+local indexed = #KEYS > 2
+local result
+for i = 14, #ARGV, 3 do
+    result = apply_rating(KEYS[1], ARGV[i], ARGV[i + 1] == '1', ARGV[i + 2],
+        K, min_window, outlier_threshold)
+    if indexed then add_trending(KEYS[7], ARGV[4], trending_rate, tonumber(ARGV[i + 2])) end
+end
+if not result then
+    return redis.call('HMGET', KEYS[1], 'avg_rating', 'num_ratings')
+end
+redis.call('SADD', KEYS[2], ARGV[4])
+if indexed then
+    index_rating(KEYS[3], KEYS[4], KEYS[5], KEYS[6], ARGV[4], result[1], result[2], tonumber(ARGV[6]))
+end
+return result
+"""
+
+# Applies the rating counts of written ratings to the cached articles.
+#
+# KEYS     article hashes (article_{id}) of one shard, followed by the dirty
+#          article set of the shard, the hash of stream ids counted in the
+#          shard and, except in cluster mode, the article indexes ordered by
+#          num_ratings and by id and the top rated leaderboard
+# ARGV[1]  NUM_RATING_THRESHOLD
+# ARGV[2]  number of hashes n
+# ARGV[3:] the n article ids, then 5 values per written rating: the number of
+#          its hash (1 to n), the stream id of its event, 1 for a new rater or
+#          0, its score and the score it replaced or -1
+#
+# The counts are applied before the transaction that wrote the ratings
+# commits. Each counted stream id is recorded until the entry is
+# acknowledged, so a batch redelivered after its commit failed, which counts
+# its ratings again, leaves them as they are. Missing hashes are not created
+# half-empty, and their counts are not recorded, since they go to the
+# database in the same transaction. Returns {missing, uncounted, counted}:
+# the ids of missing hashes, whose counts belong in the database only, of
+# hashes without score counters, which got num_ratings but not the rest, and
+# (article id, num_ratings, avg_rating) of every updated hash, for
+# UPDATE_ARTICLE_INDEXES when the indexes were left out.
+INCREMENT_RATING_COUNTS = INDEX_FUNCTIONS + """
+local threshold = tonumber(ARGV[1])
+local hashes = tonumber(ARGV[2])
+local dirty = KEYS[hashes + 1]
+local counted_ids = KEYS[hashes + 2]
+local count_index = KEYS[hashes + 3]
+local id_index = KEYS[hashes + 4]
+local top_rated = KEYS[hashes + 5]
+local exists = {}
+local changes = {}
+for i = 1, hashes do
+    exists[i] = redis.call('EXISTS', KEYS[i]) == 1
+    changes[i] = {0, 0, 0, 0, 0, 0, 0}
+end
+for row = hashes + 3, #ARGV, 5 do
+    local i = tonumber(ARGV[row])
+    if exists[i] and redis.call('HSETNX', counted_ids, ARGV[row + 1], 1) == 1 then
+        local change = changes[i]
+        local score = tonumber(ARGV[row + 3])
+        local previous_score = tonumber(ARGV[row + 4])
+        change[1] = change[1] + tonumber(ARGV[row + 2])
+        change[2 + score] = change[2 + score] + 1
+        if previous_score >= 0 then
+            change[2 + previous_score] = change[2 + previous_score] - 1
+        end
+    end
+end
+
+local missing = {}
+local uncounted = {}
+local counted = {}
+for i = 1, hashes do
+    local article_id = ARGV[2 + i]
+    if exists[i] then
+        local change = changes[i]
+        local num_ratings = redis.call('HINCRBY', KEYS[i], 'num_ratings', change[1])
+        if redis.call('HEXISTS', KEYS[i], 'score_0_count') == 1 then
+            for score = 0, 5 do
+                if change[2 + score] ~= 0 then
+                    redis.call('HINCRBY', KEYS[i], 'score_' .. score .. '_count', change[2 + score])
+                end
+            end
+        else
+            table.insert(uncounted, article_id)
+        end
+        local avg_rating = redis.call('HGET', KEYS[i], 'avg_rating')
+        redis.call('SADD', dirty, article_id)
+        if top_rated then
+            zadd_if_exists(count_index, num_ratings, article_id, id_index)
+            update_top_rated(id_index, top_rated, article_id, avg_rating, num_ratings, threshold)
+        end
+        table.insert(counted, article_id)
+        table.insert(counted, num_ratings)
+        table.insert(counted, avg_rating)
+    else
+        table.insert(missing, article_id)
+    end
+end
+return {missing, uncounted, counted}
+"""
+
+# Moves the dirty article set of a shard aside so the sync task can work on a
+# stable snapshot while new ratings keep marking articles dirty.
+#
+# KEYS[1]  dirty article set
+# KEYS[2]  set being synced
+#
+# Ids left over from a sync that crashed midway are merged in rather than
+# overwritten. Returns the number of ids to sync.
+CLAIM_DIRTY_ARTICLES = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    if redis.call('EXISTS', KEYS[2]) == 1 then
+        redis.call('SUNIONSTORE', KEYS[2], KEYS[2], KEYS[1])
+        redis.call('DEL', KEYS[1])
+    else
+        redis.call('RENAME', KEYS[1], KEYS[2])
+    end
+end
+return redis.call('SCARD', KEYS[2])
+"""
+
+# Releases a lock taken with SET NX EX only if it still holds the holder's
+# token, so a holder that outlived the TTL never releases the lock of the
+# worker that took it next.
+#
+# KEYS[1]  lock
+# ARGV[1]  token stored when the lock was taken
+#
+# Returns 1 if the lock was released, 0 if it had expired or was taken over.
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Lua helper shared by INDEX_ARTICLE and LOAD_ARTICLES.
+#
+# load_article fills the hash of an article from its database row, taken from
+# the ARTICLE_LOAD_ARGS arguments after args[base]: article id, title,
+# num_ratings, avg_rating, score_0_count .. score_5_count, last_score and
+# last_rating_time as epoch seconds ('' for both if never rated). The title
+# is always written. Rating fields already in the hash are newer than the
+# database and are never overwritten; the EMA state (avg_rating, last_score,
+# last_rating_time) is only taken as a whole. Returns {num_ratings,
+# avg_rating, score_0_count .. score_5_count}.
+ARTICLE_LOAD_ARGS = 12
+LOAD_FUNCTIONS = """
+local function load_article(key, args, base)
+    if redis.call('EXISTS', key) == 0 then
+        -- The common case on a warm start: one write, and the row is the result
+        local fields = {'title', args[base + 2], 'num_ratings', args[base + 3], 'avg_rating', args[base + 4]}
+        local counts = {args[base + 3], args[base + 4]}
+        for score = 0, 5 do
+            table.insert(fields, 'score_' .. score .. '_count')
+            table.insert(fields, args[base + 5 + score])
+            table.insert(counts, args[base + 5 + score])
+        end
+        if args[base + 12] ~= '' then
+            table.insert(fields, 'last_score')
+            table.insert(fields, args[base + 11])
+            table.insert(fields, 'last_rating_time')
+            table.insert(fields, args[base + 12])
+        end
+        redis.call('HSET', key, unpack(fields))
+        return counts
+    end
+    redis.call('HSET', key, 'title', args[base + 2])
+    redis.call('HSETNX', key, 'num_ratings', args[base + 3])
+    if redis.call('HSETNX', key, 'avg_rating', args[base + 4]) == 1 and args[base + 12] ~= '' then
+        redis.call('HSET', key, 'last_score', args[base + 11], 'last_rating_time', args[base + 12])
+    end
+    for score = 0, 5 do
+        redis.call('HSETNX', key, 'score_' .. score .. '_count', args[base + 5 + score])
+    end
+    return redis.call('HMGET', key, 'num_ratings', 'avg_rating', 'score_0_count', 'score_1_count',
+        'score_2_count', 'score_3_count', 'score_4_count', 'score_5_count')
+end
+"""
+
+# Adds or refreshes an article in the list cache.
+#
+# KEYS[1]  article hash (article_{id})
+# KEYS[2]  article index ordered by id
+# KEYS[3]  article index ordered by avg_rating
+# KEYS[4]  article index ordered by num_ratings
+# KEYS[5]  top rated leaderboard
+# ARGV[1:12] the article row, see load_article
+# ARGV[13] NUM_RATING_THRESHOLD
+#
+# KEYS[2:5] are left out in cluster mode, like for UPDATE_ARTICLE_EMA.
+#
+# Returns {num_ratings, avg_rating, score_0_count .. score_5_count}.
+INDEX_ARTICLE = INDEX_FUNCTIONS + LOAD_FUNCTIONS + """
+local fields = load_article(KEYS[1], ARGV, 0)
+if #KEYS > 1 then
+    zadd_if_exists(KEYS[2], ARGV[1], ARGV[1], KEYS[2])
+    index_rating(KEYS[3], KEYS[4], KEYS[2], KEYS[5], ARGV[1], fields[2], fields[1], tonumber(ARGV[13]))
+end
+return fields
+"""
+
+# Fills a batch of article hashes from the database, for warm starts. The
+# list caches are rebuilt separately (see CachedArticleList.rebuild_index).
+#
+# KEYS     article hashes (article_{id}), of one shard in cluster mode
+# ARGV     ARTICLE_LOAD_ARGS values per hash, see load_article
+#
+# Returns {num_ratings, avg_rating} of every hash, flattened.
+LOAD_ARTICLES = LOAD_FUNCTIONS + """
+local result = {}
+for i = 1, #KEYS do
+    local fields = load_article(KEYS[i], ARGV, (i - 1) * 12)
+    table.insert(result, fields[1])
+    table.insert(result, fields[2])
+end
+return result
+"""
+
+# Brings the list caches and leaderboards up to date with an article hash, for
+# cluster mode, where they live in another slot than the hash: the second
+# half of UPDATE_ARTICLE_EMA, APPLY_ARTICLE_RATINGS, INCREMENT_RATING_COUNTS
+# and INDEX_ARTICLE.
+#
+# KEYS[1]  article index ordered by id
+# KEYS[2]  article index ordered by avg_rating
+# KEYS[3]  article index ordered by num_ratings
+# KEYS[4]  top rated leaderboard
+# KEYS[5]  trending leaderboard
+# ARGV[1]  article id
+# ARGV[2]  avg_rating, ARGV[3] num_ratings
+# ARGV[4]  NUM_RATING_THRESHOLD
+# ARGV[5]  trending decay rate per second
+# ARGV[6:] epoch seconds of the new ratings, added to the trending score
+UPDATE_ARTICLE_INDEXES = INDEX_FUNCTIONS + """
+zadd_if_exists(KEYS[1], ARGV[1], ARGV[1], KEYS[1])
+index_rating(KEYS[2], KEYS[3], KEYS[1], KEYS[4], ARGV[1], ARGV[2], ARGV[3], tonumber(ARGV[4]))
+local rate = tonumber(ARGV[5])
+for i = 6, #ARGV do
+    add_trending(KEYS[5], ARGV[1], rate, tonumber(ARGV[i]))
+end
+"""
+
+# Swaps rebuilt sorted sets in for the live ones, all at once.
+#
+# KEYS     (rebuilt set, live set) pairs
+#
+# A rebuilt set that is missing, because it would be empty, deletes the live
+# one. Unlike RENAME in a MULTI, this also works in a cluster pipeline.
+SWAP_SORTED_SETS = """
+for i = 1, #KEYS, 2 do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('RENAME', KEYS[i], KEYS[i + 1])
+    else
+        redis.call('DEL', KEYS[i + 1])
+    end
+end
+"""
+
+# Reads one page of a sorted set in descending order, relative to a cursor.
+#
+# KEYS[1]  article index sorted set
+# ARGV[1]  cursor score, or '' for the first page
+# ARGV[2]  cursor member
+# ARGV[3]  page size
+# ARGV[4]  'next' for the items after the cursor, 'previous' for those before
+#
+# Returns {has_more, member, score, member, score, ...}. has_more tells whether
+# there are items beyond the page in the direction of travel.
+#
+# The cursor is the (score, member) of an item, not a rank, so pages stay
+# stable while other articles are rated. If the cursor item itself has moved,
+# the page starts where (score, member) would sit in the set.
+PAGE_ARTICLES = """
+local key = KEYS[1]
+local count = tonumber(ARGV[3])
+local before = 0
+local after = 0
+
+if ARGV[1] ~= '' then
+    local current = redis.call('ZSCORE', key, ARGV[2])
+    if current and tonumber(current) == tonumber(ARGV[1]) then
+        before = redis.call('ZREVRANK', key, ARGV[2])
+        after = before + 1
+    else
+        before = redis.call('ZCOUNT', key, '(' .. ARGV[1], '+inf')
+        for _, member in ipairs(redis.call('ZRANGEBYSCORE', key, ARGV[1], ARGV[1])) do
+            if member > ARGV[2] then before = before + 1 end
+        end
+        after = before
+    end
+end
+
+local start, stop, has_more
+if ARGV[4] == 'previous' then
+    stop = before - 1
+    start = math.max(0, before - count)
+    has_more = start > 0
+else
+    start = after
+    stop = after + count
+end
+
+if stop < start then return {0} end
+local items = redis.call('ZREVRANGE', key, start, stop, 'WITHSCORES')
+if ARGV[4] ~= 'previous' then
+    has_more = #items > count * 2
+    if has_more then
+        table.remove(items)
+        table.remove(items)
+    end
+end
+
+local result = {has_more and 1 or 0}
+for _, item in ipairs(items) do table.insert(result, item) end
+return result
+"""
+
+# Rewrites an article hash written by an older version in the current format:
+# drops the redundant id field and the never-rated placeholders, and turns an
+# ISO-8601 last_rating_time into epoch seconds. Running it on a hash that is
+# already compact is a no-op.
+#
+# KEYS[1]  article hash (article_{id})
+#
+# Returns 1 if the hash was changed, 0 otherwise.
+COMPACT_ARTICLE = EMA_FUNCTIONS + """
+local key = KEYS[1]
+local fields = redis.call('HMGET', key, 'id', 'last_score', 'last_rating_time')
+local changed = 0
+if fields[1] then
+    redis.call('HDEL', key, 'id')
+    changed = 1
+end
+if fields[3] == 'None' or (not fields[3] and fields[2]) then
+    redis.call('HDEL', key, 'last_score', 'last_rating_time')
+    changed = 1
+elseif fields[3] and not tonumber(fields[3]) then
+    local ts = parse_time(fields[3])
+    if ts then
+        local format = ts == math.floor(ts) and '%d' or '%.6f'
+        redis.call('HSET', key, 'last_rating_time', string.format(format, ts))
+    else
+        redis.call('HDEL', key, 'last_score', 'last_rating_time')
+    end
+    changed = 1
+end
+return changed
+"""
+
+# Admits or rejects one single-rating submission.
+#
+# KEYS     token buckets, e.g. of the user (rate_limit_user_{id}) and of the
+#          article (rate_limit_article_{id}), optionally followed by the last
+#          accepted score of the (user, article) pair, see
+#          RatingView.queue_rating_writes
+# ARGV[1]  score
+# ARGV[2]  now, epoch seconds
+# ARGV[3:] name, size and refill per second of each bucket
+#
+# A bucket with a size or refill of 0 is off. A token is taken from every
+# bucket or from none, and a full bucket expires, so idle users and articles
+# cost no memory. Returns {outcome, retry_after}: 'accepted', 'duplicate' (the
+# pair's last score again, costs no token) or 'limited_<bucket name>', with
+# retry_after in seconds as a string.
+LIMIT_RATING = """
+local function refill(key, size, rate, now)
+    if size <= 0 or rate <= 0 then return nil end
+    local state = redis.call('HMGET', key, 'tokens', 'time')
+    local tokens = tonumber(state[1]) or size
+    local last = tonumber(state[2]) or now
+    if now > last then tokens = math.min(size, tokens + (now - last) * rate) end
+    return tokens
+end
+
+local function take(key, tokens, size, rate, now)
+    if not tokens then return end
+    redis.call('HSET', key, 'tokens', tokens - 1, 'time', now)
+    redis.call('PEXPIRE', key, math.ceil(size / rate * 1000))
+end
+
+local buckets = (#ARGV - 2) / 3
+if #KEYS > buckets and redis.call('GET', KEYS[#KEYS]) == ARGV[1] then return {'duplicate', '0'} end
+
+local now = tonumber(ARGV[2])
+local tokens = {}
+for i = 1, buckets do
+    local size, rate = tonumber(ARGV[3 * i + 1]), tonumber(ARGV[3 * i + 2])
+    tokens[i] = refill(KEYS[i], size, rate, now)
+    if tokens[i] and tokens[i] < 1 then
+        return {'limited_' .. ARGV[3 * i], tostring((1 - tokens[i]) / rate)}
+    end
+end
+
+for i = 1, buckets do
+    take(KEYS[i], tokens[i], tonumber(ARGV[3 * i + 1]), tonumber(ARGV[3 * i + 2]), now)
+end
+return {'accepted', '0'}
+"""
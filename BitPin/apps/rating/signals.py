@@ -0,0 +1,70 @@
+import logging
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from redis.exceptions import RedisError
+
+from .classes import CachedArticleList
+from .models import Article
+from .scripts import INDEX_ARTICLE, UPDATE_ARTICLE_INDEXES, index_member
+from .redis_client import r, article_key, article_version_key
+from BitPin.settings import ARTICLE_TRENDING_KEY, ARTICLE_META_VERSION_KEY, ARTICLE_LIST_VERSION_KEY, \
+    ARTICLE_MEMBERSHIP_VERSION_KEY, REDIS_CLUSTER
+
+logger = logging.getLogger(__name__)
+
+index_article = r.register_script(INDEX_ARTICLE)
+update_article_indexes = r.register_script(UPDATE_ARTICLE_INDEXES)
+
+
+# The cache is written once the transaction commits, so a rolled back save
+# never reaches it and Redis never holds the transaction open. A Redis error
+# is logged rather than raised, since the article is already saved.
+
+@receiver(post_save, sender=Article)
+def cache_article(sender, instance, created, using, **kwargs):
+    # The values as saved, in case the instance changes before the commit
+    row = {field: getattr(instance, field) for field in CachedArticleList.db_fields}
+    transaction.on_commit(partial(index_saved_article, row, created), using=using)
+
+
+@receiver(post_delete, sender=Article)
+def uncache_article(sender, instance, using, **kwargs):
+    transaction.on_commit(partial(unindex_deleted_article, instance.id), using=using)
+
+
+def index_saved_article(row, created):
+    # Keeps the article list cache in place instead of rebuilding it
+    try:
+        num_ratings, avg_rating, *_ = index_article(
+            keys=CachedArticleList.index_article_keys(row['id']),
+            args=CachedArticleList.index_article_args(row)
+        )
+        if REDIS_CLUSTER:
+            update_article_indexes(keys=CachedArticleList.index_update_keys,
+                                   args=CachedArticleList.index_update_args(row['id'], avg_rating, num_ratings))
+        # After the hash is updated, so a worker that sees the new version reads the new title
+        pipe = r.pipeline(transaction=False)
+        if not created:
+            pipe.incr(ARTICLE_META_VERSION_KEY)
+        pipe.incr(ARTICLE_LIST_VERSION_KEY)
+        pipe.incr(ARTICLE_MEMBERSHIP_VERSION_KEY)
+        pipe.execute()
+    except RedisError as e:
+        logger.error(f"Could not cache article {row['id']}: {str(e)}")
+
+
+def unindex_deleted_article(article_id):
+    try:
+        pipe = r.pipeline(transaction=False)
+        for key in (*CachedArticleList.index_keys, ARTICLE_TRENDING_KEY):
+            pipe.zrem(key, index_member(article_id))
+        pipe.delete(article_key(article_id), article_version_key(article_id))
+        pipe.incr(ARTICLE_META_VERSION_KEY)
+        pipe.incr(ARTICLE_LIST_VERSION_KEY)
+        pipe.incr(ARTICLE_MEMBERSHIP_VERSION_KEY)
+        pipe.execute()
+    except RedisError as e:
+        logger.error(f"Could not remove article {article_id} from the cache: {str(e)}")
@@ -1,73 +1,616 @@
+import os
+import secrets
+import socket
+import time
 from celery import shared_task
-from django.db import transaction
+from django.db import transaction, connection
 from django.db.models import F
 from datetime import datetime
 import logging
-from .models import Article
-from django.core.cache import cache
-from redis import Redis
-from BitPin.settings import REDIS_PORT, REDIS_HOST
+from datetime import timezone as dt_timezone
+from . import metrics
+from .classes import CachedArticleList, INDEX_REBUILD_LOCK_KEY, INDEX_REBUILD_LOCK_TTL, rebuild_trending
+from .models import Article, Rating, SCORES, SCORE_COUNT_FIELDS
+from .scripts import INCREMENT_RATING_COUNTS, CLAIM_DIRTY_ARTICLES, RELEASE_LOCK
+from redis.exceptions import ResponseError
+from .rollups import create_partitions, insert_events, roll_up, PARTITION_MONTHS_AHEAD
+from .redis_client import r, article_key, article_shard, dirty_articles_key, dirty_articles_syncing_key, \
+    counted_ratings_key, article_version_key, hmget_many, stream_entries
+from .utils import parse_rating_time
+from BitPin.settings import RATING_STREAM_KEY, RATING_STREAM_GROUP, RATING_LOG_KEY, RATING_LOG_GROUP, \
+    RATING_LOG_BATCH_SIZE, RATING_STREAM_BATCH_SIZE, RATING_STREAM_CLAIM_IDLE_MS, ARTICLE_SYNC_CHUNK_SIZE, \
+    ARTICLE_SHARDS, ARTICLE_COUNT_INDEX_KEY, ARTICLE_INDEX_KEY, ARTICLE_TOP_RATED_KEY, ARTICLE_LIST_VERSION_KEY, \
+    NUM_RATING_THRESHOLD, REDIS_CLUSTER
 
 logger = logging.getLogger(__name__)
 
-r = Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+# Synced from every article hash; hashes cached before the score counts
+# existed have the rest only
+SYNC_FIELDS = ('avg_rating', 'num_ratings', 'last_score', 'last_rating_time')
+
+increment_rating_counts = r.register_script(INCREMENT_RATING_COUNTS)
+claim_dirty_articles = r.register_script(CLAIM_DIRTY_ARTICLES)
+release_lock = r.register_script(RELEASE_LOCK)
+
+# Held by the worker syncing a shard, so a slow run and the next one never
+# sync the same shard at once
+SYNC_LOCK_TTL = 10 * 60  # 10 minutes
+
+
+def sync_lock_key(shard):
+    return f"{dirty_articles_syncing_key(shard)}_lock"
+
+
+def update_articles(rows, fields=('avg_rating', 'num_ratings'), increment=False):
+    """
+    Apply a chunk of (id, *fields) rows with a single
+    UPDATE ... FROM (VALUES ...) statement. With ``increment`` the values are
+    added to the current ones instead of replacing them.
+    """
+    if connection.vendor != 'postgresql':
+        if not increment:
+            return Article.objects.bulk_update(
+                [Article(id=row[0], **dict(zip(fields, row[1:]))) for row in rows], fields
+            )
+        return sum(
+            Article.objects.filter(id=row[0]).update(
+                **{field: F(field) + value for field, value in zip(fields, row[1:])}
+            )
+            for row in rows
+        )
+
+    table = connection.ops.quote_name(Article._meta.db_table)
+    values = ', '.join([f"({', '.join(['%s'] * (len(fields) + 1))})"] * len(rows))
+    params = [value for row in rows for value in row]
+    assignments = []
+    for field in fields:
+        value = f"v.{field}::{Article._meta.get_field(field).db_type(connection)}"
+        assignments.append(f"{field} = a.{field} + {value}" if increment else f"{field} = {value}")
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {table} AS a "
+            f"SET {', '.join(assignments)} "
+            f"FROM (VALUES {values}) AS v(id, {', '.join(fields)}) "
+            f"WHERE a.id = v.id",
+            params
+        )
+        return cursor.rowcount
+
+
+def sync_article_chunk(article_ids, stats):
+    """Fetch one chunk of dirty article hashes in a pipeline and write it to the DB."""
+    started = time.monotonic()
+    results = hmget_many([article_key(article_id) for article_id in article_ids], *SYNC_FIELDS,
+                         *SCORE_COUNT_FIELDS)
+
+    rows = []
+    # Hashes cached before the score counts existed; the DB keeps its counts
+    uncounted_rows = []
+    for article_id, (avg_rating, num_ratings, last_score, last_rating_time, *score_counts) in zip(article_ids,
+                                                                                                   results):
+        if avg_rating is None or num_ratings is None:
+            # Hash was evicted or never fully seeded
+            continue
+        try:
+            # Hashes of articles that were never rated have no EMA state
+            row = (article_id, float(avg_rating), int(num_ratings), None if last_score is None else int(last_score),
+                   parse_rating_time(last_rating_time))
+            if None in score_counts:
+                uncounted_rows.append(row)
+            else:
+                rows.append((*row, *map(int, score_counts)))
+        except ValueError as e:
+            logger.error(f"Error processing article {article_id}: {str(e)}")
+    stats['fetch_seconds'] += time.monotonic() - started
+
+    if not rows and not uncounted_rows:
+        return
+
+    started = time.monotonic()
+    with transaction.atomic():
+        if rows:
+            stats['synced'] += update_articles(rows, (*SYNC_FIELDS, *SCORE_COUNT_FIELDS))
+        if uncounted_rows:
+            stats['synced'] += update_articles(uncounted_rows, SYNC_FIELDS)
+    stats['write_seconds'] += time.monotonic() - started
+
+
+def sync_shard(shard, chunk_size, stats):
+    """Sync the dirty articles of one shard; returns how many there were, or None if it is being synced."""
+    lock_key = sync_lock_key(shard)
+    token = secrets.token_hex(16)
+    if not r.set(lock_key, token, nx=True, ex=SYNC_LOCK_TTL):
+        logger.info(f"Shard {shard} is already being synced")
+        return None
+    try:
+        syncing_key = dirty_articles_syncing_key(shard)
+        started = time.monotonic()
+        pending = claim_dirty_articles(keys=[dirty_articles_key(shard), syncing_key])
+        stats['claim_seconds'] += time.monotonic() - started
+        if not pending:
+            return 0
+
+        article_ids = []
+        for article_id in r.sscan_iter(syncing_key, count=chunk_size):
+            article_ids.append(int(article_id))
+            if len(article_ids) >= chunk_size:
+                sync_article_chunk(article_ids, stats)
+                article_ids = []
+        if article_ids:
+            sync_article_chunk(article_ids, stats)
+
+        # Every chunk is committed, so the snapshot can go
+        r.delete(syncing_key)
+        return pending
+    finally:
+        # The lock may have expired during a slow run and been taken by another worker
+        if not release_lock(keys=[lock_key], args=[token]):
+            logger.warning(f"Sync lock of shard {shard} expired before the sync finished")
 
 
 @shared_task
-def sync_articles_from_redis():
+def sync_articles_from_redis(chunk_size=ARTICLE_SYNC_CHUNK_SIZE, shard=None):
+    """
+    Copy the Redis state of articles rated since the last run into Postgres.
+
+    Only ids in the dirty set of a shard are synced. The set is swapped out
+    atomically, fetched in pipelined chunks and written with one UPDATE per
+    chunk. Syncs ``shard``, or every shard in turn when it is None (see
+    sync_article_shards to sync them in parallel). Returns the number of
+    synced rows and the time spent in each phase.
+    """
+    stats = {'synced': 0, 'claim_seconds': 0.0, 'fetch_seconds': 0.0, 'write_seconds': 0.0}
+
     try:
-        # Get all article keys from Redis
-        article_keys = r.keys("article_*")
-
-        if not article_keys:
-            logger.info("No articles found in Redis cache")
-            return
-
-        # Prepare bulk updates
-        articles_to_update = []
-        for key in article_keys:
-            try:
-                # Get article data from Redis
-                article_data = r.hgetall(key)
-
-                if not article_data:
-                    continue
-
-                # Convert Redis byte strings to Python types
-                article_data = {k.decode(): v.decode() for k, v in article_data.items()}
-
-                # Extract article_id from key
-                article_id = key.decode().split('_')[1]
-
-                articles_to_update.append({
-                    'id': article_id,
-                    'avg_rating': float(article_data.get('avg_rating', 0)),
-                    'num_ratings': int(article_data.get('num_ratings', 0)),
-                    'last_rating_time': article_data.get('last_rating_time'),
-                    'last_score': float(article_data.get('last_score', 0))
-                })
-
-            except (ValueError, KeyError, AttributeError) as e:
-                logger.error(f"Error processing article key {key}: {str(e)}")
-                continue
-
-        if not articles_to_update:
-            logger.info("No valid articles to update")
-            return
-
-        # bulk update
-        with transaction.atomic():
-            for article_data in articles_to_update:
-                Article.objects.filter(id=article_data['id']).update(
-                    avg_rating=article_data['avg_rating'],
-                    num_ratings=article_data['num_ratings'],
-                    last_rating_time=article_data['last_rating_time'] if article_data[
-                                                                             'last_rating_time'] != "None" else None,
-                    last_score=article_data['last_score']
-                )
-
-        logger.info(f"Successfully synchronized {len(articles_to_update)} articles from Redis to database")
+        pending = 0
+        for shard in (range(ARTICLE_SHARDS) if shard is None else [shard]):
+            pending += sync_shard(shard, chunk_size, stats) or 0
+
+        if not pending:
+            logger.info("No dirty articles to sync")
+            return stats
+
+        metrics.record_sync_phases(stats)
+
+        logger.info(
+            f"Successfully synchronized {stats['synced']} articles from Redis to database "
+            f"(claim {stats['claim_seconds']:.3f}s, fetch {stats['fetch_seconds']:.3f}s, "
+            f"write {stats['write_seconds']:.3f}s)"
+        )
+        return stats
 
     except Exception as e:
         logger.error(f"Error in sync_articles_from_redis task: {str(e)}")
         raise
+
+
+@shared_task
+def sync_article_shards(chunk_size=ARTICLE_SYNC_CHUNK_SIZE):
+    """Queue a sync_articles_from_redis per shard, so that free workers sync the shards in parallel."""
+    for shard in range(ARTICLE_SHARDS):
+        sync_articles_from_redis.delay(chunk_size, shard)
+    return ARTICLE_SHARDS
+
+
+@shared_task
+def rebuild_article_index():
+    """Rebuild the article list sorted sets from the database."""
+    try:
+        count = CachedArticleList(r).rebuild_index()
+        logger.info(f"Rebuilt article index with {count} articles")
+        return count
+
+    except Exception as e:
+        logger.error(f"Error in rebuild_article_index task: {str(e)}")
+        raise
+
+    finally:
+        r.delete(INDEX_REBUILD_LOCK_KEY)
+
+
+@shared_task
+def warm_redis_cache(batch_size=10000):
+    """
+    Load every article hash, the list caches and the leaderboards from the
+    database in one pass, e.g. after Redis lost its data, instead of letting
+    each miss load its articles one page at a time.
+
+    Articles are streamed with a server-side cursor and written with a
+    pipeline of LOAD_ARTICLES calls per batch. Hashes already in Redis keep
+    their rating fields, which are newer than the database. Returns the
+    number of articles and of trending articles loaded, or None if the list
+    caches are being rebuilt by another worker.
+    """
+    if not r.set(INDEX_REBUILD_LOCK_KEY, 1, nx=True, ex=INDEX_REBUILD_LOCK_TTL):
+        logger.info("The article index is already being rebuilt")
+        return None
+
+    try:
+        started = time.monotonic()
+        count = CachedArticleList(r).rebuild_index(batch_size, load_hashes=True)
+        trending = rebuild_trending(r, batch_size)
+        logger.info(f"Warmed {count} articles and {trending} trending articles in {time.monotonic() - started:.2f}s")
+        return {'articles': count, 'trending': trending}
+
+    except Exception as e:
+        logger.error(f"Error in warm_redis_cache task: {str(e)}")
+        raise
+
+    finally:
+        r.delete(INDEX_REBUILD_LOCK_KEY)
+
+
+@shared_task
+def rebuild_trending_index():
+    """Rebuild the trending leaderboard from recent ratings, dropping articles nobody rated lately."""
+    try:
+        count = rebuild_trending(r)
+        logger.info(f"Rebuilt trending index with {count} articles")
+        return count
+
+    except Exception as e:
+        logger.error(f"Error in rebuild_trending_index task: {str(e)}")
+        raise
+
+
+def upsert_ratings(events, article_ids=None):
+    """
+    Write a batch of rating events with one upsert statement (see upsert_rating_rows).
+
+    ``events`` is a list of (article_id, user_id, score, rated_at) tuples. Only
+    the newest event per (article, user) is kept, and an event never overwrites
+    a row that was updated after it, so redelivered entries are harmless.
+    ``article_ids`` are ids already known to exist; other articles are looked up.
+    Returns (article_id, user_id, score, inserted, previous_score) for every
+    row that was written, previous_score being None for inserted rows.
+    """
+    latest = {}
+    for article_id, user_id, score, rated_at in events:
+        key = (article_id, user_id)
+        if key not in latest or latest[key][3] <= rated_at:
+            latest[key] = (article_id, user_id, score, rated_at)
+
+    # Drop events for articles that were deleted in the meantime
+    existing_ids = set(article_ids) if article_ids is not None else set(Article.objects.filter(
+        id__in={article_id for article_id, _ in latest}
+    ).values_list('id', flat=True))
+    rows = [row for key, row in latest.items() if key[0] in existing_ids]
+    if not rows:
+        return []
+
+    if connection.vendor != 'postgresql':
+        return upsert_ratings_portable(rows)
+
+    written = []
+    while rows:
+        lost = set()
+        for article_id, user_id, score, inserted, previous_score in upsert_rating_rows(rows):
+            if inserted is None:
+                lost.add((article_id, user_id))
+            else:
+                written.append((article_id, user_id, score, inserted, previous_score))
+        # Inserted by a concurrent writer after this statement's snapshot; the
+        # next statement sees the committed row and updates it instead
+        rows = [row for row in rows if row[:2] in lost]
+    return written
+
+
+def upsert_rating_rows(rows):
+    """
+    Upsert (article_id, user_id, score, rated_at) rows with one statement
+    that locks the existing rows and returns the scores they had when
+    locked, so the score counts always get the score a row really lost.
+
+    Returns (article_id, user_id, score, inserted, previous_score) rows. Rows
+    a concurrent transaction inserted after this statement started come back
+    with ``inserted`` None and are not written; stale rows do not come back.
+    """
+    table = connection.ops.quote_name(Rating._meta.db_table)
+    values = ', '.join(['(%s, %s, %s, %s)'] * len(rows))
+    same_pair = "{0}.article_id = {1}.article_id AND {0}.user_id = {1}.user_id"
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"WITH input (article_id, user_id, score, rated_at) AS (VALUES {values}), "
+            # In key order, so concurrent batches lock rows in the same order
+            f"locked AS ("
+            f"SELECT r.id, r.article_id, r.user_id, r.score FROM {table} AS r "
+            f"JOIN input AS i ON {same_pair.format('r', 'i')} "
+            f"ORDER BY r.article_id, r.user_id FOR UPDATE OF r"
+            f"), "
+            f"updated AS ("
+            f"UPDATE {table} AS r SET score = i.score, updated_at = i.rated_at "
+            f"FROM locked AS l JOIN input AS i ON {same_pair.format('l', 'i')} "
+            f"WHERE r.id = l.id AND r.updated_at <= i.rated_at "
+            f"RETURNING r.article_id, r.user_id, r.score, l.score AS previous_score"
+            f"), "
+            f"inserted AS ("
+            f"INSERT INTO {table} (article_id, user_id, score, created_at, updated_at) "
+            f"SELECT i.article_id, i.user_id, i.score, i.rated_at, i.rated_at FROM input AS i "
+            f"WHERE NOT EXISTS (SELECT 1 FROM locked AS l WHERE {same_pair.format('l', 'i')}) "
+            f"ORDER BY i.article_id, i.user_id "
+            f"ON CONFLICT (article_id, user_id) DO NOTHING "
+            f"RETURNING article_id, user_id, score"
+            f") "
+            f"SELECT article_id, user_id, score, false, previous_score FROM updated "
+            f"UNION ALL SELECT article_id, user_id, score, true, NULL FROM inserted "
+            f"UNION ALL SELECT i.article_id, i.user_id, i.score, NULL, NULL FROM input AS i "
+            f"WHERE NOT EXISTS (SELECT 1 FROM locked AS l WHERE {same_pair.format('l', 'i')}) "
+            f"AND NOT EXISTS (SELECT 1 FROM inserted AS n WHERE {same_pair.format('n', 'i')})",
+            [value for row in rows for value in row]
+        )
+        return cursor.fetchall()
+
+
+def upsert_ratings_portable(rows):
+    """upsert_ratings for databases other than PostgreSQL, with a few queries per batch."""
+    existing = {
+        (rating.article_id, rating.user_id): rating
+        for rating in Rating.objects.select_for_update().filter(
+            article_id__in={row[0] for row in rows}, user_id__in={row[1] for row in rows}
+        )
+    }
+    written = []
+    created = []
+    updated = []
+    for article_id, user_id, score, rated_at in sorted(rows):
+        rating = existing.get((article_id, user_id))
+        if rating is None:
+            created.append(Rating(article_id=article_id, user_id=user_id, score=score))
+            written.append((article_id, user_id, score, True, None))
+        elif rating.updated_at <= rated_at:
+            written.append((article_id, user_id, score, False, rating.score))
+            rating.score = score
+            rating.updated_at = rated_at
+            updated.append(rating)
+
+    created = Rating.objects.bulk_create(created)
+    # bulk_create stamps both times with now; bulk_update keeps the values given
+    for rating, (_, _, _, rated_at) in zip(created, (row for row in sorted(rows) if row[:2] not in existing)):
+        rating.created_at = rating.updated_at = rated_at
+    Rating.objects.bulk_update(created, ['created_at', 'updated_at'])
+    Rating.objects.bulk_update(updated, ['score', 'updated_at'])
+    return written
+
+
+def apply_rating_counts(written, stream_ids):
+    """
+    Add the raters and score counts of rows written by upsert_ratings to the
+    article hashes, or to the database for articles that are not cached.
+
+    Runs in the transaction of the upsert, so the database counts commit with
+    the rows. ``stream_ids`` maps each (article_id, user_id) to the stream id
+    of the event it was written from; a row whose stream id was already
+    counted in its hash is not counted again (see INCREMENT_RATING_COUNTS).
+    """
+    changes = {}
+    for article_id, user_id, score, inserted, previous_score in written:
+        change = changes.setdefault(article_id, [0] * (len(SCORES) + 1))
+        change[0] += int(inserted)
+        change[1 + score] += 1
+        if previous_score is not None:
+            change[1 + previous_score] -= 1
+
+    # One call per shard, whose hashes share a slot with its dirty set
+    shards = {}
+    for row in written:
+        shards.setdefault(article_shard(row[0]), []).append(row)
+    pipe = r.pipeline(transaction=False)
+    for shard, rows in shards.items():
+        article_ids = list(dict.fromkeys(row[0] for row in rows))
+        positions = {article_id: position for position, article_id in enumerate(article_ids, 1)}
+        keys = [article_key(article_id) for article_id in article_ids]
+        keys += [dirty_articles_key(shard), counted_ratings_key(shard)]
+        if not REDIS_CLUSTER:
+            keys += [ARTICLE_COUNT_INDEX_KEY, ARTICLE_INDEX_KEY, ARTICLE_TOP_RATED_KEY]
+        increment_rating_counts(
+            keys=keys,
+            args=[NUM_RATING_THRESHOLD, len(article_ids), *article_ids, *(
+                value for article_id, user_id, score, inserted, previous_score in rows
+                for value in (positions[article_id], stream_ids[article_id, user_id], int(inserted), score,
+                              -1 if previous_score is None else previous_score)
+            )],
+            client=pipe
+        )
+
+    missing = []
+    uncounted = []
+    counted = []
+    for shard_missing, shard_uncounted, shard_counted in pipe.execute():
+        missing += [int(article_id) for article_id in shard_missing]
+        uncounted += [int(article_id) for article_id in shard_uncounted]
+        counted += [(article_id, avg_rating, num_ratings, ()) for article_id, num_ratings, avg_rating
+                    in zip(shard_counted[::3], shard_counted[1::3], shard_counted[2::3])]
+
+    pipe = r.pipeline(transaction=False)
+    if REDIS_CLUSTER and counted:
+        # The sorted sets are in another slot than the hashes
+        CachedArticleList(r).queue_index_updates(pipe, counted)
+    for article_id in changes:
+        pipe.incr(article_version_key(article_id))
+    pipe.incr(ARTICLE_LIST_VERSION_KEY)
+    pipe.execute()
+    if missing:
+        update_articles([(article_id, *changes[article_id]) for article_id in missing],
+                        ('num_ratings', *SCORE_COUNT_FIELDS), increment=True)
+    if uncounted:
+        update_articles([(article_id, *changes[article_id][1:]) for article_id in uncounted],
+                        SCORE_COUNT_FIELDS, increment=True)
+
+
+def process_rating_entries(entries):
+    """Persist a batch of stream entries, then acknowledge and delete them."""
+    if not entries:
+        return 0
+
+    entry_ids = []
+    events = []
+    # The entry each (article, user) row is written from: the newest, as in upsert_ratings
+    stream_ids = {}
+    for entry_id, fields in entries:
+        entry_ids.append(entry_id)
+        if not fields:
+            # Entry was trimmed from the stream after being delivered
+            continue
+        try:
+            event = (
+                int(fields[b'article_id']),
+                int(fields[b'user_id']),
+                int(fields[b'score']),
+                datetime.fromtimestamp(float(fields[b'timestamp']), tz=dt_timezone.utc),
+            )
+        except (ValueError, KeyError) as e:
+            logger.error(f"Dropping malformed rating event {entry_id}: {str(e)}")
+            continue
+        key = event[:2]
+        if key not in stream_ids or stream_ids[key][1] <= event[3]:
+            stream_ids[key] = (entry_id, event[3])
+        events.append(event)
+
+    # The counts are applied before the commit: a crash after it would
+    # otherwise lose them, since a redelivered event finds its row written
+    # and changes nothing
+    with transaction.atomic():
+        written = upsert_ratings(events) if events else []
+        if written:
+            apply_rating_counts(written, {key: entry_id for key, (entry_id, _) in stream_ids.items()})
+
+    # Acknowledge only after the batch is committed, so a crash redelivers it
+    pipe = r.pipeline(transaction=False)
+    counted = {}
+    for (article_id, _), (entry_id, _) in stream_ids.items():
+        counted.setdefault(article_shard(article_id), []).append(entry_id)
+    for shard, shard_entry_ids in counted.items():
+        pipe.hdel(counted_ratings_key(shard), *shard_entry_ids)
+    pipe.execute()
+    pipe = r.pipeline()
+    pipe.xack(RATING_STREAM_KEY, RATING_STREAM_GROUP, *entry_ids)
+    pipe.xdel(RATING_STREAM_KEY, *entry_ids)
+    pipe.execute()
+
+    return len(events)
+
+
+def consume_stream(key, group, process_entries, batch_size, max_batches):
+    """
+    Read new entries of a stream as a consumer of `group` and hand them to
+    `process_entries` in batches, up to `max_batches` batches. Entries left
+    pending by a crashed worker for longer than RATING_STREAM_CLAIM_IDLE_MS
+    are claimed and processed first. Returns the sum of what
+    `process_entries` returned.
+    """
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+
+    try:
+        r.xgroup_create(key, group, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+    processed = 0
+
+    # Redeliver entries that were read but never acknowledged
+    start_id = '0-0'
+    for _ in range(max_batches):
+        # Redis 7 appends a list of deleted ids to the reply
+        claim = r.xautoclaim(
+            key, group, consumer, min_idle_time=RATING_STREAM_CLAIM_IDLE_MS, start_id=start_id, count=batch_size
+        )
+        start_id = claim[0]
+        processed += process_entries(claim[1])
+        if start_id in (b'0-0', '0-0'):
+            break
+
+    for _ in range(max_batches):
+        entries = stream_entries(r.xreadgroup(group, consumer, {key: '>'}, count=batch_size))
+        if not entries:
+            break
+        processed += process_entries(entries)
+
+    return processed
+
+
+@shared_task
+def drain_rating_stream(batch_size=RATING_STREAM_BATCH_SIZE, max_batches=100):
+    """
+    Drain write-behind rating events from the Redis Stream into Postgres.
+
+    Entries left pending by a crashed worker for longer than
+    RATING_STREAM_CLAIM_IDLE_MS are claimed and processed first.
+    """
+    try:
+        processed = consume_stream(RATING_STREAM_KEY, RATING_STREAM_GROUP, process_rating_entries, batch_size,
+                                   max_batches)
+        if processed:
+            logger.info(f"Persisted {processed} rating events from {RATING_STREAM_KEY}")
+        return processed
+
+    except Exception as e:
+        logger.error(f"Error in drain_rating_stream task: {str(e)}")
+        raise
+
+
+def process_log_entries(entries):
+    """Log and roll up a batch of rating log entries, then acknowledge and delete them."""
+    if not entries:
+        return 0
+
+    entry_ids = []
+    events = []
+    for entry_id, fields in entries:
+        entry_ids.append(entry_id)
+        if not fields:
+            # Entry was trimmed from the stream after being delivered
+            continue
+        try:
+            avg_rating = fields.get(b'avg_rating')
+            events.append((
+                entry_id.decode() if isinstance(entry_id, bytes) else entry_id,
+                int(fields[b'article_id']),
+                int(fields[b'user_id']),
+                int(fields[b'score']),
+                None if avg_rating is None else float(avg_rating),
+                datetime.fromtimestamp(float(fields[b'timestamp']), tz=dt_timezone.utc),
+            ))
+        except (ValueError, KeyError) as e:
+            logger.error(f"Dropping malformed rating log entry {entry_id}: {str(e)}")
+
+    with transaction.atomic():
+        logged = insert_events(events) if events else []
+        if logged:
+            roll_up(logged)
+
+    # Acknowledge only after the batch is committed, so a crash redelivers it
+    pipe = r.pipeline()
+    pipe.xack(RATING_LOG_KEY, RATING_LOG_GROUP, *entry_ids)
+    pipe.xdel(RATING_LOG_KEY, *entry_ids)
+    pipe.execute()
+
+    return len(logged)
+
+
+@shared_task
+def roll_up_rating_events(batch_size=RATING_LOG_BATCH_SIZE, max_batches=100):
+    """
+    Move the ratings in the RATING_LOG_KEY stream into the RatingEvent log
+    and add them to the hourly and daily rollups. Returns the number of
+    events logged.
+    """
+    try:
+        logged = consume_stream(RATING_LOG_KEY, RATING_LOG_GROUP, process_log_entries, batch_size, max_batches)
+        if logged:
+            logger.info(f"Rolled up {logged} rating events from {RATING_LOG_KEY}")
+        return logged
+
+    except Exception as e:
+        logger.error(f"Error in roll_up_rating_events task: {str(e)}")
+        raise
+
+
+@shared_task
+def create_rating_partitions(months_ahead=PARTITION_MONTHS_AHEAD):
+    """Create the monthly partitions of the rating log and rollups ahead of time (PostgreSQL only)."""
+    created = create_partitions(months_ahead)
+    if created:
+        logger.info(f"Created partitions {', '.join(created)}")
+    return created
@@ -1,3 +1,591 @@
-from django.test import TestCase
+import io
+import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock, skipUnless
+
+from asgiref.sync import sync_to_async
+from django.core.management import call_command
+from django.db import router, transaction
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from redis.crc import key_slot
+from redis.exceptions import ConnectionError as RedisConnectionError
+from django.utils import timezone
+
+from .classes import CachedArticleList, INDEX_REBUILD_LOCK_KEY, INDEX_REBUILDING_KEY
+from .models import Article, Rating
+from .scripts import index_member, UPDATE_ARTICLE_INDEXES
+from .redis_client import r, pool, async_pool, article_key, dirty_articles_key, article_shard, replica_pin_key, \
+    dirty_articles_syncing_key, counted_ratings_key, rate_limit_user_key, recent_rating_key, \
+    InstrumentedRedisCluster, InstrumentedAsyncRedisCluster
+from .routers import replica_reads
+from BitPin.settings import ARTICLE_INDEX_KEY, ARTICLE_RATING_INDEX_KEY, ARTICLE_COUNT_INDEX_KEY, \
+    ARTICLE_TOP_RATED_KEY, ARTICLE_TRENDING_KEY, ARTICLE_LIST_VERSION_KEY
+from .tasks import rebuild_article_index, upsert_ratings, apply_rating_counts, process_rating_entries, sync_shard, \
+    sync_lock_key
+from .async_views import AsyncRatingView
+from .views import RatingView, BatchRatingView, ArticleListView
+
+try:
+    import fakeredis
+    import fakeredis.aioredis
+    import lupa  # noqa: F401, fakeredis runs Lua scripts with it
+except ImportError:
+    fakeredis = None
+
+
+@skipUnless(pool, 'needs a standalone Redis configuration')
+class FakeRedisMixin:
+    """Points the shared connection pools at an in-process fakeredis server, emptied before every test."""
+
+    @classmethod
+    def setUpClass(cls):
+        if fakeredis is None:
+            raise ImportError('The Redis tests need fakeredis and lupa: pip install -r requirements-dev.txt')
+        super().setUpClass()
+        cls.saved_connections = [(p, p.connection_class, p.connection_kwargs) for p in (pool, async_pool)]
+        server = fakeredis.FakeServer()
+        for p, connection_class in ((pool, fakeredis.FakeConnection),
+                                    (async_pool, fakeredis.aioredis.FakeConnection)):
+            p.connection_class = connection_class
+            p.connection_kwargs = {'server': server}
+            p.reset()
+
+    @classmethod
+    def tearDownClass(cls):
+        for p, connection_class, connection_kwargs in cls.saved_connections:
+            p.connection_class = connection_class
+            p.connection_kwargs = connection_kwargs
+            p.reset()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        r.flushdb()
+
+
+class ArticleEmaScriptTests(FakeRedisMixin, SimpleTestCase):
+    article_id = 7
+    start = 1_700_000_000
+
+    def seed_article(self, **fields):
+        r.hset(article_key(self.article_id), mapping={
+            'num_ratings': 0, 'avg_rating': 0, **{f'score_{score}_count': 0 for score in range(6)}, **fields
+        })
+
+    @staticmethod
+    def expected_ema(old_ema, score, last_score, last_time, now):
+        """The EMA after a rating, as RatingView.calculate_dynamic_alpha defines it, or None if it is backdated."""
+        if last_time is not None and now < last_time:
+            return None
+        alpha = RatingView().calculate_dynamic_alpha(old_ema, score, last_score, last_time, now)
+        return old_ema * (1 - alpha) + score * alpha
+
+    def test_concurrent_ratings_are_never_lost(self):
+        self.seed_article()
+        rng = random.Random(1)
+        # Half-second steps are exact as floats, so Lua and Python see the same times
+        ratings = [(rng.randint(0, 5), self.start + rng.randrange(0, 400) / 2) for _ in range(300)]
+
+        def rate(rating):
+            score, timestamp = rating
+            result = RatingView().apply_rating(self.article_id, score, True,
+                                               datetime.fromtimestamp(timestamp, tz=dt_timezone.utc), -1)
+            return result['num_ratings'], score, timestamp
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            applied = list(executor.map(rate, ratings))
+
+        # Each call returns its place in the order the script calls ran in
+        applied.sort()
+        self.assertEqual([position for position, _, _ in applied], list(range(1, len(ratings) + 1)))
+        ema, last_score, last_time = 0.0, -1, None
+        for _, score, timestamp in applied:
+            now = datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+            new_ema = self.expected_ema(ema, score, last_score, last_time, now)
+            if new_ema is not None:
+                ema, last_score, last_time = new_ema, score, now
+
+        cached = r.hgetall(article_key(self.article_id))
+        self.assertEqual(int(cached[b'num_ratings']), len(ratings))
+        self.assertEqual(float(cached[b'avg_rating']), ema)
+        for score in range(6):
+            self.assertEqual(int(cached[f'score_{score}_count'.encode()]),
+                             sum(rating[0] == score for rating in ratings))
+        self.assertTrue(r.sismember(dirty_articles_key(article_shard(self.article_id)), self.article_id))
+
+    def test_script_matches_calculate_dynamic_alpha(self):
+        rng = random.Random(2)
+        for _ in range(3000):
+            old_ema = rng.uniform(0, 5)
+            last_score = rng.randint(-1, 5)
+            last_time = None if last_score == -1 else self.start + rng.randrange(0, 100)
+            # Mostly inside MIN_TIME_WINDOW_SECOND, where the outlier damping applies, some backdated
+            now = self.start + rng.choice([rng.randrange(-20, 20) / 4, rng.randrange(0, 3 * 86400 * 4) / 4])
+            score = rng.choice([last_score, rng.randint(0, 5)]) if last_score != -1 else rng.randint(0, 5)
+            r.delete(article_key(self.article_id))
+            state = {} if last_time is None else {'last_score': last_score, 'last_rating_time': last_time}
+            self.seed_article(avg_rating=repr(old_ema), num_ratings=3, **state)
+
+            result = RatingView().apply_rating(self.article_id, score, False,
+                                               datetime.fromtimestamp(now, tz=dt_timezone.utc))
+
+            expected = self.expected_ema(
+                old_ema, score, last_score, None if last_time is None else
+                datetime.fromtimestamp(last_time, tz=dt_timezone.utc), datetime.fromtimestamp(now, tz=dt_timezone.utc)
+            )
+            self.assertEqual(result['avg_rating'], old_ema if expected is None else expected,
+                             (old_ema, score, last_score, last_time, now))
+            self.assertEqual(result['num_ratings'], 3)
+
+
+class UpsertRatingsTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.article = Article.objects.create(title='Article', content='')
+        self.now = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+    def upsert(self, *events):
+        with transaction.atomic():
+            return upsert_ratings([(self.article.id, *event) for event in events])
+
+    def test_returns_the_replaced_scores(self):
+        self.assertEqual(self.upsert((1, 4, self.now), (2, 5, self.now)),
+                         [(self.article.id, 1, 4, True, None), (self.article.id, 2, 5, True, None)])
+        self.assertEqual(self.upsert((1, 2, self.now + timedelta(seconds=1))),
+                         [(self.article.id, 1, 2, False, 4)])
+        rating = Rating.objects.get(article=self.article, user_id=1)
+        self.assertEqual((rating.score, rating.created_at, rating.updated_at),
+                         (2, self.now, self.now + timedelta(seconds=1)))
+
+    def test_keeps_newer_ratings(self):
+        self.upsert((1, 4, self.now))
+        self.assertEqual(self.upsert((1, 1, self.now - timedelta(seconds=1))), [])
+        # Only the newest event of a pair in a batch is written
+        self.assertEqual(self.upsert((1, 3, self.now + timedelta(seconds=2)), (1, 0, self.now + timedelta(seconds=1))),
+                         [(self.article.id, 1, 3, False, 4)])
+        self.assertEqual(Rating.objects.get(article=self.article, user_id=1).score, 3)
+
+
+class ProcessRatingEntriesTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.article = Article.objects.create(title='Article', content='')
+        self.entries = [
+            (f'1700000000000-{user_id}'.encode(), {b'article_id': str(self.article.id).encode(),
+                                                  b'user_id': str(user_id).encode(), b'score': str(score).encode(),
+                                                  b'timestamp': b'1700000000'})
+            for user_id, score in ((1, 4), (2, 5))
+        ]
+
+    def assertCounted(self):
+        self.assertEqual(int(r.hget(article_key(self.article.id), 'num_ratings')), 2)
+        self.assertEqual(Rating.objects.filter(article=self.article).count(), 2)
+
+    def test_redelivered_entries_are_counted_once(self):
+        def count_then_fail(*args):
+            apply_rating_counts(*args)
+            raise RuntimeError('commit failed')
+
+        with mock.patch('BitPin.apps.rating.tasks.apply_rating_counts', side_effect=count_then_fail), \
+                self.assertRaises(RuntimeError):
+            process_rating_entries(self.entries)
+        self.assertFalse(Rating.objects.filter(article=self.article).exists())
+
+        process_rating_entries(self.entries)
+        self.assertCounted()
+        self.assertEqual(r.keys('*_counted'), [])
+
+    def test_entries_redelivered_after_the_commit_keep_their_counts(self):
+        # Redis goes away between the commit and the acknowledgement
+        with mock.patch.object(type(r.pipeline()), 'hdel', side_effect=RedisConnectionError('down')), \
+                self.assertRaises(RedisConnectionError):
+            process_rating_entries(self.entries)
+        self.assertCounted()
+
+        process_rating_entries(self.entries)
+        self.assertCounted()
+
+
+class SyncShardLockTests(FakeRedisMixin, TestCase):
+
+    def sync(self):
+        return sync_shard(0, 100, mock.MagicMock())
+
+    def test_the_lock_is_released_after_a_sync(self):
+        self.assertEqual(self.sync(), 0)
+        self.assertIsNone(r.get(sync_lock_key(0)))
+
+    def test_a_lock_taken_over_after_it_expired_is_kept(self):
+        def expire_and_take_over(**kwargs):
+            # The run outlives the TTL and another worker takes the lock
+            r.set(sync_lock_key(0), 'other worker')
+            return 0
+
+        with mock.patch('BitPin.apps.rating.tasks.claim_dirty_articles', side_effect=expire_and_take_over), \
+                self.assertLogs('BitPin.apps.rating.tasks', 'WARNING'):
+            self.assertEqual(self.sync(), 0)
+        self.assertEqual(r.get(sync_lock_key(0)), b'other worker')
+        self.assertIsNone(self.sync())
+
+
+class RebuildIndexTests(FakeRedisMixin, TestCase):
+
+    def test_ratings_made_during_a_rebuild_are_kept(self):
+        article_ids = [Article.objects.create(title=f'Article {i}', content='').id for i in range(6)]
+        articles = CachedArticleList(r)
+        articles.fetch_articles(article_ids)
+        fetch_cached_ratings = articles.fetch_cached_ratings
+
+        def fetch_then_rate(batch_ids):
+            cached = fetch_cached_ratings(batch_ids)
+            # One article of this batch, read but not written yet, and the first article, already written
+            for article_id in {batch_ids[0], article_ids[0]}:
+                RatingView().apply_rating(article_id, 5, True, timezone.now(), -1)
+            return cached
+
+        with mock.patch.object(articles, 'fetch_cached_ratings', side_effect=fetch_then_rate):
+            self.assertEqual(articles.rebuild_index(batch_size=2), len(article_ids))
+
+        for article_id in article_ids:
+            num_ratings, avg_rating = r.hmget(article_key(article_id), 'num_ratings', 'avg_rating')
+            self.assertEqual(r.zscore(ARTICLE_RATING_INDEX_KEY, index_member(article_id)), float(avg_rating))
+            self.assertEqual(r.zscore(ARTICLE_COUNT_INDEX_KEY, index_member(article_id)), int(num_ratings))
+        self.assertEqual(int(r.hget(article_key(article_ids[0]), 'num_ratings')), 3)
+        self.assertEqual(r.keys('*_building') + r.keys('*_rebuilding'), [])
+
+
+class ArticleSignalTests(FakeRedisMixin, TestCase):
+
+    def test_cache_is_written_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            article = Article.objects.create(title='Article', content='')
+        self.assertFalse(r.exists(article_key(article.id)))
+        for callback in callbacks:
+            callback()
+        self.assertEqual(r.hget(article_key(article.id), 'title'), b'Article')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Article.objects.filter(id=article.id).delete()
+        self.assertFalse(r.exists(article_key(article.id)))
+
+    def test_rolled_back_saves_are_not_cached(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                Article.objects.create(title='Article', content='')
+                raise RuntimeError
+        self.assertEqual(callbacks, [])
+        self.assertEqual(r.keys(), [])
+
+    def test_redis_errors_are_logged(self):
+        with mock.patch('BitPin.apps.rating.signals.index_article', side_effect=RedisConnectionError('down')), \
+                self.assertLogs('BitPin.apps.rating.signals', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+            article = Article.objects.create(title='Article', content='')
+        self.assertTrue(Article.objects.filter(id=article.id).exists())
+
+
+class ArticleListMissTests(FakeRedisMixin, TestCase):
+    views = ('artile_list', 'artile_list_async')
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.article_ids = [Article.objects.create(title=f'Article {i}', content='').id for i in range(15)]
+        r.delete(ARTICLE_INDEX_KEY)
+
+    def get_page(self, view, page):
+        response = self.client.get(reverse(view), {'page': page})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_concurrent_miss_costs_one_query(self):
+        # Another request has scheduled the rebuild
+        r.set(INDEX_REBUILD_LOCK_KEY, 1)
+        for view in self.views:
+            with self.subTest(view=view), self.assertNumQueries(1):
+                page = self.get_page(view, 2)
+                self.assertEqual(page['count'], len(self.article_ids))
+                self.assertEqual([article['id'] for article in page['results']], self.article_ids[10:])
+        self.assertFalse(r.exists(ARTICLE_INDEX_KEY))
+
+    def test_miss_schedules_one_rebuild(self):
+        for view in self.views:
+            r.delete(INDEX_REBUILD_LOCK_KEY)
+            with self.subTest(view=view), mock.patch('BitPin.apps.rating.tasks.rebuild_article_index.delay') as delay:
+                with self.assertNumQueries(1):
+                    self.get_page(view, 1)
+                self.get_page(view, 1)
+                delay.assert_called_once_with()
+
+    def test_etag_includes_the_rebuild_a_miss_ran(self):
+        # A rebuild that runs before the page is read, like an eager or idle worker's. With
+        # user_id the version is read from Redis every time, not from the process's cache.
+        for view in self.views:
+            for params in ({'user_id': 1}, {'user_id': 1, 'pagination': 'cursor'}):
+                with self.subTest(view=view, params=params), mock.patch(
+                        'BitPin.apps.rating.tasks.rebuild_article_index.delay', side_effect=rebuild_article_index):
+                    r.delete(ARTICLE_INDEX_KEY)
+                    response = self.client.get(reverse(view), params)
+                    self.assertTrue(r.exists(ARTICLE_INDEX_KEY))
+                    response = self.client.get(reverse(view), params, HTTP_IF_NONE_MATCH=response['ETag'])
+                    self.assertEqual(response.status_code, 304)
+
+    def test_pages_past_the_end_are_not_found(self):
+        r.set(INDEX_REBUILD_LOCK_KEY, 1)
+        for view in self.views:
+            with self.subTest(view=view):
+                self.assertEqual(self.client.get(reverse(view), {'page': 3}).status_code, 404)
+
+
+class ListEtagTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.article_ids = [Article.objects.create(title=f'Article {i}', content='').id for i in range(10)]
+        rebuild_article_index()
+
+    def get(self, view, params, **headers):
+        # With user_id the versions are read from Redis every time, not from the process's cache
+        return self.client.get(reverse(view), {'user_id': 1, **params}, **headers)
+
+    def assertUnchangedBy(self, params, change, unchanged):
+        views = ('artile_list', 'artile_list_async')
+        etags = {view: self.get(view, params)['ETag'] for view in views}
+        change()
+        for view in views:
+            with self.subTest(view=view, params=params):
+                response = self.get(view, params, HTTP_IF_NONE_MATCH=etags[view])
+                self.assertEqual(response.status_code, 304 if unchanged else 200)
+
+    def rate(self, article_id):
+        # A new rater each time, as a repeated score is not written again
+        self.raters = getattr(self, 'raters', 1) + 1
+        response = self.client.post(reverse('artile_rate', kwargs={'article_id': article_id}),
+                                    {'user_id': self.raters, 'score': 4}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_recent_pages_change_with_their_own_articles_only(self):
+        for params, on_page, off_page in (
+                ({'page_size': 5}, self.article_ids[0], self.article_ids[-1]),
+                ({'page_size': 5, 'pagination': 'cursor'}, self.article_ids[-1], self.article_ids[0])):
+            self.assertUnchangedBy(params, lambda: self.rate(off_page), unchanged=True)
+            self.assertUnchangedBy(params, lambda: self.rate(on_page), unchanged=False)
+
+    def test_recent_pages_change_when_articles_are_added(self):
+        def create():
+            with self.captureOnCommitCallbacks(execute=True):
+                Article.objects.create(title='New', content='')
+        self.assertUnchangedBy({'page_size': 5, 'pagination': 'cursor'}, create, unchanged=False)
+
+    def test_pages_ordered_by_rating_change_with_any_rating(self):
+        params = {'page_size': 5, 'pagination': 'cursor', 'ordering': 'rating'}
+        self.assertUnchangedBy(params, lambda: self.rate(self.article_ids[0]), unchanged=False)
+
+
+class BatchRateLimitTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.article_ids = [Article.objects.create(title=f'Article {i}', content='').id for i in range(3)]
+
+    def post_batch(self, user_id):
+        response = self.client.post(reverse('artile_rate_batch'), {'ratings': [
+            {'article_id': article_id, 'user_id': user_id, 'score': 4} for article_id in self.article_ids
+        ]}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return [result['status'] for result in response.json()['results']]
+
+    def test_each_item_costs_a_token(self):
+        with mock.patch.multiple('BitPin.apps.rating.views', RATING_LIMIT_USER_BURST=2,
+                                 RATING_LIMIT_USER_PER_SECOND=0.001):
+            self.assertEqual(self.post_batch(1), ['created', 'created', 'limited_user'])
+            self.assertEqual(self.post_batch(1), ['limited_user'] * 3)
+            self.assertEqual(self.post_batch(2), ['created', 'created', 'limited_user'])
+        self.assertEqual(Rating.objects.count(), 4)
+
+    def test_bursts_of_zero_turn_the_limits_off(self):
+        with mock.patch.multiple('BitPin.apps.rating.views', RATING_LIMIT_USER_BURST=0, RATING_LIMIT_ARTICLE_BURST=0):
+            self.assertEqual(self.post_batch(1), ['created'] * 3)
+            self.assertEqual(self.post_batch(1), ['updated'] * 3)
+
+
+class ScoreValidationTests(SimpleTestCase):
+    invalid_scores = ['5', 2.5, True, None, -1, 6]
+    invalid_user_ids = ['1', 1.5, True, None]
+
+    def test_single_rating_views_reject_invalid_scores(self):
+        for name in ('artile_rate', 'artile_rate_async'):
+            path = reverse(name, kwargs={'article_id': 1})
+            for score in self.invalid_scores:
+                with self.subTest(path=path, score=score):
+                    response = self.client.post(path, {'user_id': 1, 'score': score}, content_type='application/json')
+                    self.assertEqual(response.status_code, 400)
+
+    def test_single_rating_views_reject_invalid_user_ids(self):
+        for write_mode in ('write_through', 'write_behind'):
+            with mock.patch('BitPin.apps.rating.views.RATING_WRITE_MODE', write_mode), \
+                    mock.patch('BitPin.apps.rating.async_views.RATING_WRITE_MODE', write_mode), \
+                    mock.patch.object(RatingView, 'check_rate_limit') as check_rate_limit, \
+                    mock.patch.object(RatingView, 'apply_rating') as apply_rating, \
+                    mock.patch.object(AsyncRatingView, 'check_rate_limit') as async_check_rate_limit, \
+                    mock.patch.object(AsyncRatingView, 'apply_rating') as async_apply_rating:
+                for name in ('artile_rate', 'artile_rate_async'):
+                    path = reverse(name, kwargs={'article_id': 1})
+                    invalid = [{'score': 4}, *({'user_id': user_id, 'score': 4} for user_id in self.invalid_user_ids)]
+                    for data in invalid:
+                        with self.subTest(write_mode=write_mode, path=path, data=data):
+                            response = self.client.post(path, data, content_type='application/json')
+                            self.assertEqual(response.status_code, 400)
+                            self.assertEqual(response.json(), {'error': 'user_id must be an integer'})
+                for method in (check_rate_limit, apply_rating, async_check_rate_limit, async_apply_rating):
+                    method.assert_not_called()
+
+    def test_batch_items_reject_invalid_scores(self):
+        now = timezone.now()
+        for score in self.invalid_scores:
+            with self.subTest(score=score), self.assertRaises(ValueError):
+                BatchRatingView.parse_item({'article_id': 1, 'user_id': 1, 'score': score}, now)
+
+
+class PopulateDbTests(FakeRedisMixin, TestCase):
+
+    def test_ratings_are_folded_on_any_database(self):
+        call_command('populate_db', 20, ratings=300, users=50, workers=1, seed=3, stdout=io.StringIO())
+
+        for article in Article.objects.all():
+            ema, last_score, last_time = 0.0, -1, None
+            ratings = Rating.objects.filter(article=article).order_by('updated_at', 'id')
+            for rating in ratings:
+                alpha = RatingView().calculate_dynamic_alpha(ema, rating.score, last_score, last_time,
+                                                             rating.updated_at)
+                ema, last_score, last_time = ema * (1 - alpha) + rating.score * alpha, rating.score, rating.updated_at
+            self.assertEqual(article.num_ratings, len(ratings))
+            self.assertEqual(article.avg_rating, ema)
+            self.assertEqual(article.last_rating_time, last_time)
+
+
+class ExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        article = Article.objects.create(title='Article', content='')
+        Rating.objects.bulk_create([Rating(article=article, user_id=user_id, score=user_id % 6)
+                                    for user_id in range(5)])
+
+    def wsgi_export(self, url, export_format):
+        response = self.client.get(url, {'format': export_format})
+        self.assertFalse(response.is_async)
+        return b''.join(response.streaming_content).decode()
+
+    async def test_asgi_export_is_streamed_asynchronously(self):
+        for export_format in ('ndjson', 'csv'):
+            with self.subTest(export_format=export_format):
+                url = reverse('export', args=['ratings'])
+                response = await self.async_client.get(url, {'format': export_format})
+                self.assertTrue(response.is_async)
+                content = b''.join([chunk async for chunk in response.streaming_content]).decode()
+                self.assertEqual(content, await sync_to_async(self.wsgi_export)(url, export_format))
+                self.assertEqual(len(content.splitlines()), 5 + (export_format == 'csv'))
+
+
+@mock.patch('BitPin.apps.rating.views.REPLICAS', ['replica_0'])
+@mock.patch('BitPin.apps.rating.routers.REPLICAS', ['replica_0'])
+class ReplicaRouterTests(FakeRedisMixin, SimpleTestCase):
+
+    def test_opted_in_reads_go_to_a_replica(self):
+        self.assertEqual(router.db_for_read(Rating), 'default')
+        with replica_reads():
+            self.assertEqual(router.db_for_read(Rating), 'replica_0')
+            self.assertEqual(Rating.objects.filter(user_id=1).db, 'replica_0')
+            with replica_reads(False):
+                self.assertEqual(router.db_for_read(Rating), 'default')
+        self.assertEqual(router.db_for_read(Rating), 'default')
+
+    def test_writes_go_to_the_primary(self):
+        with replica_reads():
+            self.assertEqual(router.db_for_write(Rating), 'default')
+            self.assertEqual(router.db_for_write(Article), 'default')
+
+    def test_users_who_just_rated_read_from_the_primary(self):
+        databases = []
+        view = ArticleListView()
+        with mock.patch.object(view, 'load_user_ratings',
+                               side_effect=lambda user_id: databases.append(router.db_for_read(Rating))):
+            view.get_user_ratings(1, [7])
+            r.flushdb()
+            pipe = r.pipeline(transaction=False)
+            RatingView.queue_rating_writes(pipe, 7, 1, 4, timezone.now())
+            pipe.execute()
+            self.assertTrue(r.exists(replica_pin_key(1)))
+            view.get_user_ratings(1, [7])
+        self.assertEqual(databases, ['replica_0', 'default'])
+
+
+@mock.patch('BitPin.apps.rating.views.REDIS_CLUSTER', True)
+@mock.patch('BitPin.apps.rating.redis_client.REDIS_CLUSTER', True)
+@mock.patch('BitPin.apps.rating.redis_client.ARTICLE_SHARDS', 4)
+class ClusterKeySlotTests(SimpleTestCase):
+    """The keys a script or a MULTI uses together must hash to one cluster slot."""
+
+    def assertOneSlot(self, keys):
+        self.assertEqual(len({key_slot(key.encode()) for key in keys}), 1, keys)
+
+    def test_article_keys_share_the_slot_of_their_shard(self):
+        for article_id in range(8):
+            shard = article_shard(article_id)
+            with self.subTest(article_id=article_id):
+                self.assertOneSlot([article_key(article_id), article_key(article_id + 4), dirty_articles_key(shard),
+                                    dirty_articles_syncing_key(shard), counted_ratings_key(shard)])
+                self.assertOneSlot(RatingView.ema_script_keys(article_id))
+        # Shards spread over the cluster
+        self.assertEqual(len({key_slot(dirty_articles_key(shard).encode()) for shard in range(4)}), 4)
+
+    def test_rate_limit_keys_share_the_slot_of_their_user(self):
+        self.assertOneSlot([rate_limit_user_key(1), recent_rating_key(1, 7), recent_rating_key(1, 8)])
+        for coalesce in (True, False):
+            for keys, args in RatingView.limit_script_calls(7, 1, 4, coalesce=coalesce):
+                with self.subTest(keys=keys):
+                    self.assertOneSlot(keys)
+
+    def test_index_keys_share_a_slot(self):
+        # The cluster names, which settings picks at import
+        index_keys = [ARTICLE_INDEX_KEY, ARTICLE_RATING_INDEX_KEY, ARTICLE_COUNT_INDEX_KEY, ARTICLE_TOP_RATED_KEY,
+                      ARTICLE_TRENDING_KEY, ARTICLE_LIST_VERSION_KEY, INDEX_REBUILDING_KEY]
+        index_keys += [f"{key}_building" for key in index_keys]
+        for key in index_keys:
+            self.assertTrue(key.startswith(ARTICLE_INDEX_KEY), key)
+        self.assertOneSlot(['{article_index}' + key[len(ARTICLE_INDEX_KEY):] for key in index_keys])
+
+
+class ClusterScriptTests(SimpleTestCase):
+    """Cluster pipelines cannot load a missing script, so the clients load each one before its first call."""
+
+    @staticmethod
+    def cluster_client(client_class):
+        # No nodes to connect to: only the script loading is exercised
+        client = object.__new__(client_class)
+        client.script_load = mock.AsyncMock() if client_class is InstrumentedAsyncRedisCluster else mock.Mock()
+        return client
+
+    def test_scripts_are_loaded_once(self):
+        client = self.cluster_client(InstrumentedRedisCluster)
+        script = client.register_script(UPDATE_ARTICLE_INDEXES.encode())
+        client.load_script(script)
+        client.load_script(script)
+        client.script_load.assert_called_once_with(script.script)
+
+    async def test_async_calls_are_queued_on_cluster_pipelines(self):
+        client = self.cluster_client(InstrumentedAsyncRedisCluster)
+        script = client.register_script(UPDATE_ARTICLE_INDEXES.encode())
+        pipe = client.pipeline()
+        for _ in range(2):
+            self.assertIs(await script(keys=['{article_index}'], args=[1, 2], client=pipe), pipe)
+        self.assertEqual(len(pipe), 2)
+        client.script_load.assert_awaited_once_with(script.script)
 
-# Create your tests here.
@@ -1,6 +1,16 @@
 from django.urls import path, include
-from . import views
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.gzip import gzip_page
+from . import views, async_views
 urlpatterns = [
     path('article/list/', views.ArticleListView.as_view(), name='artile_list'),
     path('article/<int:article_id>/rate/', views.RatingView.as_view(), name='artile_rate'),
+    path('article/rate/batch/', views.BatchRatingView.as_view(), name='artile_rate_batch'),
+    path('article/<int:article_id>/trend/', views.ArticleTrendView.as_view(), name='artile_trend'),
+    path('article/leaderboard/<str:board>/', views.LeaderboardView.as_view(), name='artile_leaderboard'),
+    # Compressed on the fly for clients that accept gzip
+    path('export/<str:dataset>/', gzip_page(views.ExportView.as_view()), name='export'),
+    path('async/article/list/', async_views.AsyncArticleListView.as_view(), name='artile_list_async'),
+    path('async/article/<int:article_id>/rate/', csrf_exempt(async_views.AsyncRatingView.as_view()),
+         name='artile_rate_async'),
 ]
\ No newline at end of file
@@ -0,0 +1,20 @@
+from datetime import datetime, timezone as dt_timezone
+
+
+def parse_rating_time(value):
+    """
+    Convert a cached ``last_rating_time`` into an aware datetime.
+
+    Accepts epoch seconds (current format), ISO-8601 strings (legacy format),
+    datetimes, and ``None``/``"None"`` for articles that were never rated.
+    """
+    if isinstance(value, bytes):
+        value = value.decode()
+    if value is None or value == "None":
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromtimestamp(float(value), tz=dt_timezone.utc)
+    except ValueError:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
@@ -1,40 +1,75 @@
-import json
-from datetime import datetime
+import math
+import random
+import time
+from functools import partial
+from datetime import datetime, timedelta, timezone as dt_timezone
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from django.core.cache import cache
-from .models import Article, Rating
-from django.db.models import Avg, Count
+from rest_framework.exceptions import Throttled
+from .models import Article, Rating, SCORES, SCORE_COUNT_FIELDS
+from django.core.handlers.asgi import ASGIRequest
 from django.db import transaction
-import redis
+from django.http import JsonResponse, StreamingHttpResponse
 from django.utils import timezone
-from .classes import ArticlePagination
-from BitPin.settings import REDIS_HOST, REDIS_PORT
+from django.views import View
+from . import metrics
+from .classes import ArticlePagination, ArticleCursorPagination, CachedArticleList, LeaderboardPagination, \
+    Leaderboard, LEADERBOARDS, TRENDING_RATE, page_articles
+from .etags import list_version, membership_version, page_version, list_etag, etag_matches
+from .export import EXPORT_DATASETS, EXPORT_FORMATS, export_chunks, aexport_chunks
+from .redis_client import r, article_key, article_shard, dirty_articles_key, user_ratings_key, \
+    user_ratings_lock_key, rate_limit_user_key, rate_limit_article_key, recent_rating_key, replica_pin_key, \
+    article_version_key
+from .rollups import ROLLUPS, ROLLUP_BUCKET_SECONDS, bucket_start
+from .routers import REPLICAS, replica_reads
+from .scripts import UPDATE_ARTICLE_EMA, APPLY_ARTICLE_RATINGS, UPDATE_ARTICLE_INDEXES, LIMIT_RATING
+from .tasks import upsert_ratings
+from .utils import parse_rating_time
+from BitPin.settings import RATING_WRITE_MODE, RATING_STREAM_KEY, RATING_LOG_KEY, ARTICLE_INDEX_KEY, \
+    ARTICLE_RATING_INDEX_KEY, ARTICLE_COUNT_INDEX_KEY, ARTICLE_TOP_RATED_KEY, ARTICLE_TRENDING_KEY, \
+    ARTICLE_LIST_VERSION_KEY, ARTICLE_MEMBERSHIP_VERSION_KEY, NUM_RATING_THRESHOLD, RATING_LIMIT_USER_BURST, \
+    RATING_LIMIT_USER_PER_SECOND, RATING_LIMIT_ARTICLE_BURST, RATING_LIMIT_ARTICLE_PER_SECOND, RATING_COALESCE_WINDOW, \
+    REDIS_CLUSTER, DATABASE_REPLICA_PIN_SECONDS
 
 USER_RATING_CACHE_TTL = 60 * 60  # 1 hour
+# Marks a user_ratings_{id} hash as fully loaded from the database, so users
+# without ratings are cached too (the hash then holds only this field). Its
+# value is how long the load took, in seconds.
+USER_RATINGS_LOADED_FIELD = 'loaded'
+# Taken by the request that loads a user's ratings and left to expire, so
+# requests that missed at the same time never load them a second time
+USER_RATINGS_LOAD_LOCK_TTL = 30  # seconds
+# Probabilistic early refresh: a hash is reloaded ahead of its expiry with a
+# chance that grows as the expiry nears and with how long a load takes
+# (Vattani et al., "Optimal Probabilistic Cache Stampede Prevention")
+USER_RATINGS_EARLY_REFRESH_BETA = 1.0
 ARTICLE_CACHE_TTL = 10 * 60  # 10 minutes
 CACHE_TTL = 60 * 15  # 15 minutes cache TTL
 OUTLIER_THRESHOLD = 2
-NUM_RATING_THRESHOLD = 50
+BATCH_RATING_MAX_SIZE = 5000
+# Trend queries cover at most TREND_MAX_BUCKETS buckets, the last
+# TREND_DEFAULT_BUCKETS of the interval by default
+TREND_MAX_BUCKETS = 1000
+TREND_DEFAULT_BUCKETS = {'hour': 48, 'day': 30}
 
 MIN_TIME_WINDOW_SECOND = 5
+EMA_K = 86400  # 1 day
 
-# Initialize Redis
-r = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+update_article_ema = r.register_script(UPDATE_ARTICLE_EMA)
+apply_article_ratings = r.register_script(APPLY_ARTICLE_RATINGS)
+update_article_indexes = r.register_script(UPDATE_ARTICLE_INDEXES)
+limit_rating = r.register_script(LIMIT_RATING)
 
 
 class RatingView(APIView):
 
     def calculate_dynamic_alpha(self, old_ema, score, last_score, last_rating_time, _time,
-                                K=86400):  # Default K = 86400 seconds (1 day)
+                                K=EMA_K):  # Default K = 86400 seconds (1 day)
 
-        if isinstance(last_rating_time, str):
-            last_rating_time = datetime.fromisoformat(last_rating_time.replace('Z', '+00:00'))
-
-        if isinstance(_time, str):
-            _time = datetime.fromisoformat(_time.replace('Z', '+00:00'))
+        last_rating_time = parse_rating_time(last_rating_time)
+        _time = parse_rating_time(_time)
 
         if last_rating_time:
             time_diff = _time - last_rating_time
@@ -52,116 +87,770 @@ class RatingView(APIView):
 
     def get_article_from_cache(self, article_id):
 
-        cache_key = f"article_{article_id}"
-        cached_article = r.hgetall(cache_key)
+        cache_key = article_key(article_id)
+        num_ratings, avg_rating, last_score, last_rating_time = r.hmget(
+            cache_key, 'num_ratings', 'avg_rating', 'last_score', 'last_rating_time'
+        )
+
+        if num_ratings is None or avg_rating is None:
+            # The database has the EMA state of the last sync
+            if not CachedArticleList(r).load_from_database([article_id]):
+                return None
+            num_ratings, avg_rating, last_score, last_rating_time = r.hmget(
+                cache_key, 'num_ratings', 'avg_rating', 'last_score', 'last_rating_time'
+            )
 
-        if cached_article:
-            article_data = {k.decode(): v.decode() for k, v in cached_article.items()}
-            article_data['num_ratings'] = int(article_data['num_ratings'])
-            article_data['avg_rating'] = float(article_data['avg_rating'])
-            article_data['last_score'] = int(article_data['last_score'])
-            article_data['last_rating_time'] = None if article_data['last_rating_time'] == "None" else article_data[
-                'last_rating_time']
-            return article_data
+        # Articles that were never rated have no last_score or last_rating_time
+        return {
+            'id': article_id,
+            'num_ratings': int(num_ratings),
+            'avg_rating': float(avg_rating),
+            'last_score': -1 if last_score is None else int(last_score),
+            'last_rating_time': parse_rating_time(last_rating_time),
+        }
 
-        try:
-            article = Article.objects.get(id=article_id)
-        except Article.DoesNotExist:
-            return None
+    @staticmethod
+    def save_rating(article_id, user_id, score):
+        """
+        Create or update the user's rating. Returns the score it replaced, or
+        -1 for a new rating. The row is locked while it is read, so concurrent
+        re-rates of the same pair each see the score they replace.
+        """
+        with transaction.atomic():
+            rating, created = Rating.objects.select_for_update().get_or_create(
+                article_id=article_id, user_id=user_id,
+                defaults={'score': score}
+            )
+            if created:
+                return -1
+            previous_score = rating.score
+            rating.score = score
+            rating.save(update_fields=['score', 'updated_at'])
+            return previous_score
+
+    def apply_rating(self, article_id, score, created, _time=None, previous_score=''):
+        """
+        Fold a rating into the article's EMA atomically inside Redis.
+
+        The alpha calculation, EMA update, num_ratings increment and score
+        counts run in one EVALSHA call, so concurrent raters never overwrite
+        each other's update.
+        """
+        _time = _time or timezone.now()
+        keys, args = self.ema_script_input(article_id, score, created, _time, previous_score)
+
+        result = update_article_ema(keys=keys, args=args + [0])
+        if result is None:
+            # Cold cache: load the hash from the database, which has the EMA
+            # state of the last sync, then fold the rating in
+            if not CachedArticleList(r).load_from_database([article_id]):
+                return None
+            result = update_article_ema(keys=keys, args=args + [1])
+
+        if REDIS_CLUSTER:
+            update_article_indexes(keys=CachedArticleList.index_update_keys,
+                                   args=CachedArticleList.index_update_args(article_id, *result, [_time.timestamp()]))
+        return self.decode_ema_result(article_id, result)
+
+    @staticmethod
+    def ema_script_keys(article_id):
+        """UPDATE_ARTICLE_EMA keys; the sorted sets are left out in cluster mode, where they are in another slot."""
+        keys = [article_key(article_id), dirty_articles_key(article_shard(article_id))]
+        if REDIS_CLUSTER:
+            return keys
+        return keys + [ARTICLE_RATING_INDEX_KEY, ARTICLE_COUNT_INDEX_KEY, ARTICLE_INDEX_KEY, ARTICLE_TOP_RATED_KEY,
+                       ARTICLE_TRENDING_KEY]
+
+    @staticmethod
+    def ema_script_input(article_id, score, created, _time, previous_score=''):
+        """
+        Keys and arguments of UPDATE_ARTICLE_EMA, without the seed flag.
+        ``previous_score`` is the replaced score or -1 for a new rating; leave
+        it empty when the score counts are updated by the stream drain instead.
+        """
+        args = [score, int(created), _time.timestamp(), EMA_K, MIN_TIME_WINDOW_SECOND, OUTLIER_THRESHOLD,
+                article_id, previous_score, NUM_RATING_THRESHOLD, TRENDING_RATE]
+        return RatingView.ema_script_keys(article_id), args
+
+    @staticmethod
+    def decode_ema_result(article_id, result):
+        avg_rating, num_ratings = result
+        return {
+            'id': article_id,
+            'avg_rating': float(avg_rating),
+            'num_ratings': int(num_ratings),
+        }
 
-        article_data = {
-            "id": article_id,
-            "num_ratings": 0,
-            "avg_rating": 0.0,
-            'last_score': -1,
-            "last_rating_time": "None"
+    @staticmethod
+    def limit_script_calls(article_id, user_id, score, coalesce=True):
+        """
+        (keys, args) of the LIMIT_RATING calls for a submission, to make in
+        order until one does not accept it. In cluster mode the article's
+        bucket is in another slot than the user's and gets a call of its own,
+        so a submission limited there still costs the user a token. Without
+        ``coalesce`` a repeated score is charged like any other.
+        """
+        now = time.time()
+        user_bucket = ['user', RATING_LIMIT_USER_BURST, RATING_LIMIT_USER_PER_SECOND]
+        article_bucket = ['article', RATING_LIMIT_ARTICLE_BURST, RATING_LIMIT_ARTICLE_PER_SECOND]
+        recent_keys = [recent_rating_key(user_id, article_id)] if coalesce else []
+        if REDIS_CLUSTER:
+            return [([rate_limit_user_key(user_id), *recent_keys], [score, now, *user_bucket]),
+                    ([rate_limit_article_key(article_id)], [score, now, *article_bucket])]
+        return [([rate_limit_user_key(user_id), rate_limit_article_key(article_id), *recent_keys],
+                 [score, now, *user_bucket, *article_bucket])]
+
+    @staticmethod
+    def decode_limit_result(result):
+        """Returns (outcome, seconds to wait before retrying)."""
+        outcome, retry_after = (value.decode() for value in result)
+        return outcome, float(retry_after)
+
+    def check_rate_limit(self, article_id, user_id, score):
+        """Returns (outcome, seconds to wait before retrying) and counts the outcome."""
+        outcome, retry_after = 'accepted', 0.0
+        for keys, args in self.limit_script_calls(article_id, user_id, score):
+            outcome, retry_after = self.decode_limit_result(limit_rating(keys=keys, args=args))
+            if outcome != 'accepted':
+                break
+        metrics.record_rating_limit(outcome)
+        return outcome, retry_after
+
+    @staticmethod
+    def queue_rating_writes(pipe, article_id, user_id, score, _time):
+        """Queue the cache writes that follow a rating on a (sync or async) pipeline."""
+        # Write-through, so the article list never has to query Rating for this user
+        user_rating_key = user_ratings_key(user_id)
+        pipe.hset(user_rating_key, article_id, score)
+        pipe.expire(user_rating_key, USER_RATING_CACHE_TTL)
+        if RATING_COALESCE_WINDOW:
+            # Lets LIMIT_RATING acknowledge a resubmission of this score without writing it again
+            pipe.set(recent_rating_key(user_id, article_id), score, ex=RATING_COALESCE_WINDOW)
+        if REPLICAS:
+            # Read-your-writes: the user's reads skip the replicas until they have caught up
+            pipe.set(replica_pin_key(user_id), 1, ex=DATABASE_REPLICA_PIN_SECONDS)
+        # Changes the ETags of the pages showing the article, and of those ordered by rating or count, see etags
+        pipe.incr(article_version_key(article_id))
+        pipe.incr(ARTICLE_LIST_VERSION_KEY)
+        if RATING_WRITE_MODE == 'write_behind':
+            pipe.xadd(RATING_STREAM_KEY, {
+                'article_id': article_id,
+                'user_id': user_id,
+                'score': score,
+                'timestamp': _time.timestamp(),
+            })
+
+    @staticmethod
+    def queue_rating_log(pipe, article_id, user_id, score, _time, avg_rating=None):
+        """Queue the rating log entry of an accepted rating, with the EMA it produced if known (see rollups)."""
+        fields = {
+            'article_id': article_id,
+            'user_id': user_id,
+            'score': score,
+            'timestamp': _time.timestamp(),
         }
+        if avg_rating is not None:
+            fields['avg_rating'] = avg_rating
+        pipe.xadd(RATING_LOG_KEY, fields)
 
-        r.hset(name=cache_key, mapping=article_data)
-        return article_data
+    @staticmethod
+    def valid_score(score):
+        """Whether ``score`` is an integer from 0 to 5; JSON booleans and strings are not."""
+        return isinstance(score, int) and not isinstance(score, bool) and 0 <= score <= 5
+
+    @staticmethod
+    def valid_user_id(user_id):
+        """Whether ``user_id`` is an integer, as the stream drain requires; JSON booleans and strings are not."""
+        return isinstance(user_id, int) and not isinstance(user_id, bool)
 
     def post(self, request, article_id):
 
         user_id = request.data.get('user_id')
         score = request.data.get('score')
 
-        if not (0 <= score <= 5):
+        # Both are checked before the rate limit and the EMA see the rating
+        if not self.valid_user_id(user_id):
+            return Response({'error': 'user_id must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        if not self.valid_score(score):
             return Response({'error': 'Score must be between 0 and 5'}, status=status.HTTP_400_BAD_REQUEST)
 
-        with transaction.atomic():
-            rating, created = Rating.objects.update_or_create(
-                article_id=article_id, user_id=user_id,
-                defaults={'score': score}
-            )
+        outcome, retry_after = self.check_rate_limit(article_id, user_id, score)
+        if outcome == 'duplicate':
+            return Response({'detail': 'Rating submitted successfully'}, status=status.HTTP_200_OK)
+        if outcome != 'accepted':
+            raise Throttled(wait=retry_after)
 
-        article_data = self.get_article_from_cache(article_id)
+        _time = timezone.now()
+
+        if RATING_WRITE_MODE == 'write_behind':
+            # The Rating row is upserted later by tasks.drain_rating_stream,
+            # which also adds new raters to num_ratings and the score counts
+            # once they are written.
+            created, previous_score = False, ''
+        else:
+            previous_score = self.save_rating(article_id, user_id, score)
+            created = previous_score == -1
+
+        article_data = self.apply_rating(article_id, score, created, _time, previous_score)
         if not article_data:
             return Response({'error': 'Article not found'}, status=status.HTTP_404_NOT_FOUND)
-        print(article_data)
-        _time = timezone.now()
-        alpha = self.calculate_dynamic_alpha(article_data['avg_rating'], score, article_data['last_score'],
-                                             article_data['last_rating_time'], _time)
-        new_ema = article_data['avg_rating'] * (1 - alpha) + score * alpha
-
-        cache_key = f"article_{article_id}"
-        r.hset(name=cache_key, mapping={
-            "id": article_id,
-            "last_score": score,
-            "num_ratings": article_data['num_ratings'] + 1 if created else article_data['num_ratings'],
-            "avg_rating": new_ema,
-            "last_rating_time": _time.isoformat()
-        })
+
+        pipe = r.pipeline(transaction=False)
+        self.queue_rating_writes(pipe, article_id, user_id, score, _time)
+        self.queue_rating_log(pipe, article_id, user_id, score, _time, article_data['avg_rating'])
+        pipe.execute()
 
         return Response({
             'detail': 'Rating submitted successfully',
         }, status=status.HTTP_200_OK)
 
 
+class BatchRatingView(APIView):
+    """
+    Submit many ratings in one request, e.g. imports or offline replays.
+
+    The body is ``{"ratings": [{"article_id", "user_id", "score",
+    "timestamp"?}, ...]}`` where ``timestamp`` is optional epoch seconds. All
+    ratings are upserted with one statement, and each article's EMA is updated
+    with a single script call that folds its ratings in timestamp order. The
+    response has one status per item, in request order.
+
+    Every valid item costs its user and its article a token, like a single
+    rating, and items over a limit get a ``limited_user`` or
+    ``limited_article`` status with ``retry_after`` seconds.
+    """
+    max_batch_size = BATCH_RATING_MAX_SIZE
+
+    @staticmethod
+    def parse_item(item, now):
+        """Validate one item; returns (article_id, user_id, score, rated_at) or raises ValueError."""
+        if not isinstance(item, dict):
+            raise ValueError('Item must be an object')
+
+        values = []
+        for field in ('article_id', 'user_id', 'score'):
+            value = item.get(field)
+            if not isinstance(value, int) or isinstance(value, bool):
+                raise ValueError(f'{field} must be an integer')
+            values.append(value)
+        article_id, user_id, score = values
+
+        if not RatingView.valid_score(score):
+            raise ValueError('Score must be between 0 and 5')
+
+        timestamp = item.get('timestamp')
+        if timestamp is None:
+            return article_id, user_id, score, now
+        if not isinstance(timestamp, (int, float)) or isinstance(timestamp, bool) or not math.isfinite(timestamp):
+            raise ValueError('timestamp must be epoch seconds')
+        try:
+            rated_at = datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+        except (OverflowError, OSError):
+            raise ValueError('timestamp is out of range')
+        if rated_at > now:
+            raise ValueError('timestamp is in the future')
+        return article_id, user_id, score, rated_at
+
+    def validate(self, items, now):
+        """Returns ({index: status}, [(index, article_id, user_id, score, rated_at)]) of valid items."""
+        results = {}
+        events = []
+        for index, item in enumerate(items):
+            try:
+                events.append((index, *self.parse_item(item, now)))
+            except ValueError as e:
+                results[index] = {'status': 'invalid', 'error': str(e)}
+
+        # One query for every article in the batch
+        existing_ids = set(Article.objects.filter(
+            id__in={event[1] for event in events}
+        ).values_list('id', flat=True))
+        valid = []
+        for event in events:
+            if event[1] in existing_ids:
+                valid.append(event)
+            else:
+                results[event[0]] = {'status': 'not_found', 'error': 'Article not found'}
+        return results, valid
+
+    @staticmethod
+    def check_rate_limits(events, results):
+        """
+        Charge each event a token with pipelined LIMIT_RATING calls, in
+        request order, and set the status of those over a limit. Returns the
+        events within the limits.
+        """
+        if not events or (RATING_LIMIT_USER_BURST <= 0 and RATING_LIMIT_ARTICLE_BURST <= 0):
+            return events
+
+        # Batch items are not resubmissions of a recent rating, so they are never coalesced
+        calls = [RatingView.limit_script_calls(*event[1:4], coalesce=False) for event in events]
+        outcomes = [('accepted', 0.0)] * len(events)
+        # In cluster mode an event makes its second call only if the first accepted it
+        for step in range(len(calls[0])):
+            pending = [i for i, outcome in enumerate(outcomes) if outcome[0] == 'accepted']
+            pipe = r.pipeline(transaction=False)
+            for i in pending:
+                keys, args = calls[i][step]
+                limit_rating(keys=keys, args=args, client=pipe)
+            for i, result in zip(pending, pipe.execute()):
+                outcomes[i] = RatingView.decode_limit_result(result)
+
+        allowed = []
+        for event, (outcome, retry_after) in zip(events, outcomes):
+            metrics.record_rating_limit(outcome)
+            if outcome == 'accepted':
+                allowed.append(event)
+            else:
+                results[event[0]] = {'status': outcome, 'retry_after': retry_after}
+        return allowed
+
+    @staticmethod
+    def latest_events(events):
+        """The newest event per (article, user), later items winning ties, as in tasks.upsert_ratings."""
+        latest = {}
+        for event in events:
+            key = (event[1], event[2])
+            if key not in latest or latest[key][4] <= event[4]:
+                latest[key] = event
+        return latest
+
+    def write_ratings(self, events, latest, results):
+        """
+        Upsert the ratings and set their statuses. Returns (event, created)
+        for the ratings to fold into the EMAs, oldest first, and the change of
+        the score counts as {article_id: [change per score]}.
+        """
+        ordered = sorted(events, key=lambda event: (event[4], event[0]))
+
+        if RATING_WRITE_MODE == 'write_behind':
+            # Persisted by tasks.drain_rating_stream, which also counts new
+            # raters and scores
+            for event in latest.values():
+                results[event[0]] = {'status': 'accepted'}
+            return [(event, False) for event in ordered], {}
+
+        with transaction.atomic():
+            written = upsert_ratings(
+                [event[1:] for event in latest.values()],
+                article_ids={event[1] for event in events}
+            )
+        inserted = {}
+        score_counts = {}
+        for article_id, user_id, score, created, previous_score in written:
+            inserted[(article_id, user_id)] = created
+            counts = score_counts.setdefault(article_id, [0] * len(SCORES))
+            counts[score] += 1
+            if previous_score is not None:
+                counts[previous_score] -= 1
+
+        folded = []
+        counted = set()
+        for event in ordered:
+            key = (event[1], event[2])
+            if key not in inserted:
+                # The stored rating is newer than this one
+                results[event[0]] = {'status': 'stale'}
+                continue
+            folded.append((event, inserted[key] and key not in counted))
+            counted.add(key)
+            if latest[key] is event:
+                results[event[0]] = {'status': 'created' if inserted[key] else 'updated'}
+        return folded, score_counts
+
+    @staticmethod
+    def queue_article_updates(pipe, folded, score_counts):
+        """
+        Queue one APPLY_ARTICLE_RATINGS call per article with all of its
+        ratings, which returns nil for articles whose hash is missing. Returns
+        {article_id: [score, created, epoch seconds, ...]} in the order of the
+        calls.
+        """
+        by_article = {}
+        for (index, article_id, user_id, score, rated_at), created in folded:
+            by_article.setdefault(article_id, []).extend([score, int(created), rated_at.timestamp()])
+
+        for article_id, ratings in by_article.items():
+            BatchRatingView.queue_article_ratings(pipe, article_id, ratings, score_counts, 0)
+        return by_article
+
+    @staticmethod
+    def queue_article_ratings(pipe, article_id, ratings, score_counts, seed):
+        apply_article_ratings(
+            keys=RatingView.ema_script_keys(article_id),
+            args=[EMA_K, MIN_TIME_WINDOW_SECOND, OUTLIER_THRESHOLD, article_id, seed, NUM_RATING_THRESHOLD,
+                  TRENDING_RATE, *score_counts.get(article_id, [0] * len(SCORES)), *ratings],
+            client=pipe
+        )
+
+    def apply_to_missing(self, by_article, score_counts, results):
+        """
+        Load the hashes the APPLY_ARTICLE_RATINGS calls found missing from the
+        database and apply their ratings again. Returns the results with
+        those filled in.
+        """
+        missing = [article_id for article_id, result in zip(by_article, results) if result is None]
+        if not missing:
+            return results
+
+        # The articles were checked to exist, so a hash deleted since is seeded
+        CachedArticleList(r).load_from_database(missing)
+        pipe = r.pipeline(transaction=False)
+        for article_id in missing:
+            self.queue_article_ratings(pipe, article_id, by_article[article_id], score_counts, 1)
+        retried = dict(zip(missing, pipe.execute()))
+        return [retried.get(article_id, result) for article_id, result in zip(by_article, results)]
+
+    @staticmethod
+    def queue_index_updates(pipe, by_article, results):
+        """Queue the sorted set updates for the APPLY_ARTICLE_RATINGS results, in cluster mode."""
+        CachedArticleList(r).queue_index_updates(pipe, [
+            (article_id, avg_rating, num_ratings, ratings[2::3])
+            for (article_id, ratings), (avg_rating, num_ratings) in zip(by_article.items(), results)
+        ])
+
+    @staticmethod
+    def queue_rating_log(pipe, folded, by_article, results, now):
+        """
+        Queue the rating log entries of the folded ratings. Each article's
+        last one carries its new EMA, unless it is backdated: the EMA is the
+        article's current one, not the one at that time.
+        """
+        last = {event[1]: event for event, created in folded}
+        avg_ratings = {article_id: result[0] for article_id, result in zip(by_article, results) if result}
+        for event, created in folded:
+            index, article_id, user_id, score, rated_at = event
+            avg_rating = avg_ratings.get(article_id) if last[article_id] is event and rated_at == now else None
+            RatingView.queue_rating_log(pipe, article_id, user_id, score, rated_at,
+                                        None if avg_rating is None else float(avg_rating))
+
+    def post(self, request):
+        items = request.data.get('ratings') if isinstance(request.data, dict) else None
+        if not isinstance(items, list) or not items:
+            return Response({'error': 'ratings must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > self.max_batch_size:
+            return Response({'error': f'At most {self.max_batch_size} ratings per request'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        now = timezone.now()
+        results, events = self.validate(items, now)
+        events = self.check_rate_limits(events, results)
+        latest = self.latest_events(events)
+        folded, score_counts = self.write_ratings(events, latest, results)
+
+        pipe = r.pipeline(transaction=False)
+        by_article = self.queue_article_updates(pipe, folded, score_counts)
+        for index, article_id, user_id, score, rated_at in latest.values():
+            if results[index]['status'] != 'stale':
+                RatingView.queue_rating_writes(pipe, article_id, user_id, score, rated_at)
+        applied = self.apply_to_missing(by_article, score_counts, pipe.execute()[:len(by_article)])
+
+        if folded:
+            # The log entries need the new EMAs, so they go in a second pipeline
+            pipe = r.pipeline(transaction=False)
+            self.queue_rating_log(pipe, folded, by_article, applied, now)
+            if REDIS_CLUSTER:
+                self.queue_index_updates(pipe, by_article, applied)
+            pipe.execute()
+
+        for event in events:
+            # Earlier ratings of an (article, user) pair that is rated again later in the batch
+            results.setdefault(event[0], {'status': 'superseded'})
+
+        return Response({
+            'results': [{'index': index, **results[index]} for index in range(len(items))],
+        }, status=status.HTTP_200_OK)
+
+
 class ArticleListView(APIView):
     pagination_class = ArticlePagination
+    cursor_pagination_class = ArticleCursorPagination
+
+    def get_user_ratings(self, user_id, article_ids):
+        """
+        Return the user's scores for the given articles as {article_id: score}.
+
+        Only the fields for the current page are read (HMGET). The hash is
+        loaded from the database once per TTL, and ratings are written through
+        by RatingView.post in between.
+
+        Only one request per USER_RATINGS_LOAD_LOCK_TTL loads a user's
+        ratings; concurrent misses read the page's ratings from the database.
+        Both read from a replica unless the user has just rated.
+        """
+        user_rating_key = user_ratings_key(user_id)
+        pipe = r.pipeline(transaction=False)
+        self.queue_user_ratings_reads(pipe, user_id, article_ids)
+        cached, ttl, pinned = pipe.execute()
+
+        with replica_reads(not pinned):
+            if cached[0] is None:
+                metrics.record_cache('user_ratings', misses=1)
+                if not r.set(user_ratings_lock_key(user_id), 1, nx=True, ex=USER_RATINGS_LOAD_LOCK_TTL):
+                    return dict(Rating.objects.filter(user_id=user_id, article_id__in=article_ids)
+                                .values_list('article_id', 'score'))
+                self.load_user_ratings(user_id)
+                cached = r.hmget(user_rating_key, USER_RATINGS_LOADED_FIELD, *article_ids)
+            else:
+                metrics.record_cache('user_ratings', hits=1)
+                if self.refresh_early(cached[0], ttl) and r.set(user_ratings_lock_key(user_id), 1, nx=True,
+                                                                ex=USER_RATINGS_LOAD_LOCK_TTL):
+                    self.load_user_ratings(user_id)
+
+        return self.decode_user_ratings(article_ids, cached)
+
+    @staticmethod
+    def queue_user_ratings_reads(pipe, user_id, article_ids):
+        """Queue the reads of the page's ratings, the hash's TTL and whether the user is pinned to the primary."""
+        user_rating_key = user_ratings_key(user_id)
+        pipe.hmget(user_rating_key, USER_RATINGS_LOADED_FIELD, *article_ids)
+        pipe.pttl(user_rating_key)
+        pipe.exists(replica_pin_key(user_id))
+
+    @staticmethod
+    def refresh_early(load_seconds, ttl_ms):
+        """Whether to reload a hash that took `load_seconds` to load and expires in `ttl_ms`."""
+        if ttl_ms < 0:
+            return False
+        # 1 - random() is in (0, 1], so the log is defined
+        head_start = -float(load_seconds) * USER_RATINGS_EARLY_REFRESH_BETA * math.log(1 - random.random())
+        return head_start * 1000 >= ttl_ms
+
+    @staticmethod
+    def decode_user_ratings(article_ids, cached):
+        return {
+            article_id: int(score)
+            for article_id, score in zip(article_ids, cached[1:])
+            if score is not None
+        }
+
+    def load_user_ratings(self, user_id):
+        """Load the user's ratings into their hash; the caller has taken the user's load lock."""
+        started = time.perf_counter()
+        ratings = list(Rating.objects.filter(user_id=user_id).values_list('article_id', 'score'))
+
+        pipe = r.pipeline()
+        self.queue_user_ratings_load(pipe, user_id, ratings, time.perf_counter() - started)
+        pipe.execute()
+
+    @staticmethod
+    def queue_user_ratings_load(pipe, user_id, ratings, load_seconds):
+        metrics.record_rebuild('user_ratings')
+        user_rating_key = user_ratings_key(user_id)
+        for article_id, score in ratings:
+            # Scores written through since the hash expired are newer than the DB
+            pipe.hsetnx(user_rating_key, article_id, score)
+        pipe.hset(user_rating_key, USER_RATINGS_LOADED_FIELD, load_seconds)
+        pipe.expire(user_rating_key, USER_RATING_CACHE_TTL)
+
+    @staticmethod
+    def use_cursor_pagination(query_params):
+        # Page-number pagination stays the default for existing clients
+        return query_params.get('pagination') == 'cursor' or 'cursor' in query_params
+
+    @staticmethod
+    def page_etag(request, version):
+        return list_etag(version, request.build_absolute_uri(), request.accepted_renderer.media_type)
+
+    def recent_page_version(self, request, fresh):
+        """
+        The ETag version of a page of the recent ordering, from the ids of its
+        articles in the index (see etags). None for other orderings and for
+        pages the index has no ids for, which use the list version.
+        """
+        membership = membership_version.cached(fresh)
+        pipe = r.pipeline(transaction=False)
+        if membership is None:
+            pipe.get(ARTICLE_MEMBERSHIP_VERSION_KEY)
+        paginator = None
+        if self.use_cursor_pagination(request.query_params):
+            paginator = self.cursor_pagination_class()
+            index_key, field, cursor, page_size = paginator.prepare(request)
+            if paginator.ordering != 'recent':
+                return None
+            page_articles(keys=[index_key], args=paginator.index_args(cursor, page_size), client=pipe)
+        else:
+            bounds = self.pagination_class().page_bounds(request)
+            if bounds is None:
+                return None
+            pipe.zrange(ARTICLE_INDEX_KEY, bounds[0], bounds[1] - 1)
+        *read, page = pipe.execute()
+        if read:
+            membership = membership_version.store(read[0])
+
+        article_ids = self.recent_page_ids(paginator, page)
+        if not article_ids:
+            return None
+        pipe = r.pipeline(transaction=False)
+        for article_id in article_ids:
+            pipe.get(article_version_key(article_id))
+        return page_version(membership, article_ids, pipe.execute())
+
+    @staticmethod
+    def recent_page_ids(cursor_paginator, page):
+        """The ids read by recent_page_version: a PAGE_ARTICLES result with cursor pagination, else index members."""
+        if cursor_paginator:
+            return cursor_paginator.page_ids(cursor_paginator.parse_index_result(page)[0])
+        return [int(article_id) for article_id in page]
+
+    def etag_version(self, request, fresh=True):
+        """The version in the ETag of the requested page, see etags."""
+        return self.recent_page_version(request, fresh) or list_version.get(r, fresh=fresh)
 
     def get(self, request):
         user_id = request.query_params.get('user_id')
 
-        cached_article_list = r.get('article_list')
+        # Polling clients revalidate with the ETag, which costs at most two pipelined reads
+        etag = self.page_etag(request, self.etag_version(request, fresh=bool(user_id)))
+        if etag_matches(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
 
-        if cached_article_list:
-            article_list = json.loads(
-                cached_article_list)
+        if self.use_cursor_pagination(request.query_params):
+            paginator = self.cursor_pagination_class()
+            paginated_articles = paginator.paginate_articles(r, request, partial(self.etag_version, request))
         else:
-            articles = Article.objects.all().values('id', 'title', 'num_ratings', 'avg_rating')
-
-            article_list = []
-            for article in articles:
-                article_data = {
-                    'id': article['id'],
-                    'title': article['title'],
-                    'num_ratings': article['num_ratings'],
-                    'avg_rating': article['avg_rating'],
-                    'user_rating': None
-                }
-                article_list.append(article_data)
-
-            r.set('article_list', json.dumps(article_list), ex=ARTICLE_CACHE_TTL)
+            paginator = self.pagination_class()
+            paginated_articles = paginator.paginate_queryset(
+                CachedArticleList(r, read_version=partial(self.etag_version, request)), request
+            )
 
         if user_id:
-            user_rating_key = f"user_ratings_{user_id}"
-            cached_user_ratings = r.hgetall(user_rating_key)
+            user_ratings = self.get_user_ratings(user_id, [article['id'] for article in paginated_articles])
+            for article_data in paginated_articles:
+                article_id = article_data['id']
+                article_data['user_rating'] = user_ratings.get(article_id, None)  # None if no user rating exists
 
-            if cached_user_ratings:
-                user_ratings = {int(k): int(v) for k, v in
-                                cached_user_ratings.items()}
-            else:
-                user_ratings = Rating.objects.filter(user_id=user_id).values_list('article_id', 'score')
-                user_ratings = {article_id: score for article_id, score in user_ratings}
+        # A rebuild scheduled by a miss may have bumped the version before the page was read
+        if paginator.rebuild_version is not None:
+            etag = self.page_etag(request, paginator.rebuild_version)
+        response = paginator.get_paginated_response(paginated_articles)
+        response['ETag'] = etag
+        return response
 
-                if user_ratings:
-                    r.set(user_rating_key, json.dumps(user_ratings), ex=USER_RATING_CACHE_TTL)
 
-            for article_data in article_list:
-                article_id = article_data['id']
-                article_data['user_rating'] = user_ratings.get(article_id, None)  # None if no user rating exists
+class LeaderboardView(ArticleListView):
+    """
+    Top articles of a leaderboard: ``top-rated`` (highest EMA among articles
+    with at least NUM_RATING_THRESHOLD ratings), ``most-rated`` or
+    ``trending``. Paginated with ``limit`` and ``offset``; every article
+    comes with its ``rank``, and trending ones with their ``trending_score``.
+    """
+    pagination_class = LeaderboardPagination
+
+    def get(self, request, board):
+        if board not in LEADERBOARDS:
+            return Response({'error': f"Unknown leaderboard, expected one of: {', '.join(LEADERBOARDS)}"},
+                            status=status.HTTP_404_NOT_FOUND)
 
+        user_id = request.query_params.get('user_id')
         paginator = self.pagination_class()
-        paginated_articles = paginator.paginate_queryset(article_list, request)
-        return paginator.get_paginated_response(paginated_articles)
+        articles = paginator.paginate_queryset(Leaderboard(r, board), request)
+
+        if user_id:
+            user_ratings = self.get_user_ratings(user_id, [article['id'] for article in articles])
+            for article_data in articles:
+                article_data['user_rating'] = user_ratings.get(article_data['id'], None)
+
+        return paginator.get_paginated_response(articles)
+
+
+class ArticleTrendView(APIView):
+    """
+    How an article's ratings moved, read from the hourly or daily rollups
+    (see rollups), so the cost grows with the number of buckets and not with
+    the number of ratings. ``interval`` is ``hour`` or ``day`` (default);
+    ``since`` and ``until`` are epoch seconds or ISO-8601 and default to the
+    last TREND_DEFAULT_BUCKETS buckets. Only buckets with ratings are listed,
+    oldest first, each with the EMA at its close.
+    """
+    max_buckets = TREND_MAX_BUCKETS
+
+    @staticmethod
+    def parse_time(value):
+        try:
+            moment = parse_rating_time(value)
+        except (ValueError, OverflowError, OSError):
+            raise ValueError('since and until must be epoch seconds or ISO-8601')
+        return moment if moment.tzinfo else moment.replace(tzinfo=dt_timezone.utc)
+
+    def get(self, request, article_id):
+        interval = request.query_params.get('interval', 'day')
+        if interval not in ROLLUPS:
+            return Response({'error': f"interval must be one of: {', '.join(ROLLUPS)}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        bucket_seconds = ROLLUP_BUCKET_SECONDS[interval]
+        since = request.query_params.get('since')
+        until = request.query_params.get('until')
+        try:
+            until = self.parse_time(until) if until else timezone.now()
+            if since:
+                since = self.parse_time(since)
+            else:
+                since = until - timedelta(seconds=bucket_seconds * TREND_DEFAULT_BUCKETS[interval])
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if since >= until:
+            return Response({'error': 'since must be before until'}, status=status.HTTP_400_BAD_REQUEST)
+        if (until - since).total_seconds() > bucket_seconds * self.max_buckets:
+            return Response({'error': f'At most {self.max_buckets} buckets per request'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # The rollups lag behind the ratings by the roll-up interval anyway
+        with replica_reads():
+            buckets = list(ROLLUPS[interval].objects.filter(
+                article_id=article_id, bucket__gte=bucket_start(since, interval), bucket__lt=until
+            ).order_by('bucket').values_list('bucket', 'num_ratings', 'score_sum', *SCORE_COUNT_FIELDS, 'avg_rating'))
+            if not buckets and not Article.objects.filter(id=article_id).exists():
+                return Response({'error': 'Article not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response({
+            'article_id': article_id,
+            'interval': interval,
+            'since': since,
+            'until': until,
+            'buckets': [
+                {
+                    'start': start,
+                    'num_ratings': num_ratings,
+                    'mean_score': score_sum / num_ratings,
+                    'score_counts': score_counts,
+                    'avg_rating': avg_rating,
+                }
+                for start, num_ratings, score_sum, *score_counts, avg_rating in buckets
+            ],
+        }, status=status.HTTP_200_OK)
+
+
+class ExportView(View):
+    """
+    Stream every article or every rating, for analytics, instead of paging
+    through the article list. ``format`` is ``ndjson`` (default) or ``csv``.
+    With ``user_id``, articles come with that user's ``user_rating`` and
+    ratings are limited to theirs. The response is built one chunk of rows
+    at a time (see export), and gzipped on the fly when the client accepts
+    it. Under ASGI the chunks come from an async generator, as Django
+    buffers the whole body of a sync streaming response there.
+    """
+
+    def get(self, request, dataset):
+        if dataset not in EXPORT_DATASETS:
+            return JsonResponse({'error': f"Unknown dataset, expected one of: {', '.join(EXPORT_DATASETS)}"},
+                                status=404)
+
+        export_format = request.GET.get('format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return JsonResponse({'error': f"format must be one of: {', '.join(EXPORT_FORMATS)}"}, status=400)
+
+        user_id = request.GET.get('user_id')
+        if user_id is not None:
+            try:
+                user_id = int(user_id)
+            except ValueError:
+                return JsonResponse({'error': 'user_id must be an integer'}, status=400)
+
+        chunks = aexport_chunks if isinstance(request, ASGIRequest) else export_chunks
+        response = StreamingHttpResponse(chunks(dataset, export_format, user_id),
+                                         content_type=EXPORT_FORMATS[export_format])
+        response['Content-Disposition'] = f'attachment; filename="{dataset}.{export_format}"'
+        return response
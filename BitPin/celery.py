@@ -15,12 +15,5 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
-# Configure the periodic task
-app.conf.beat_schedule = {
-    'sync-articles-every-5-minutes': {
-        'task': 'your_app.tasks.sync_articles_from_redis',
-        'schedule': 10.0,  # 5 minutes in seconds
-    },
-}
-
+# Periodic tasks come from CELERY_BEAT_SCHEDULE in settings
 app.conf.timezone = 'UTC'
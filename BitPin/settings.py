@@ -10,7 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 from pathlib import Path
-from decouple import config
+from decouple import config, Csv
 from celery.schedules import crontab
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -43,7 +43,15 @@ INSTALLED_APPS = [
     'django_celery_beat',
 ]
 
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'BitPin.apps.rating.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
 MIDDLEWARE = [
+    'BitPin.apps.rating.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -78,7 +86,8 @@ WSGI_APPLICATION = 'BitPin.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        # Postgres in production; the benchmark command can run against SQLite
+        'ENGINE': config('DATABASE_ENGINE', default='django.db.backends.postgresql_psycopg2'),
         'NAME': config('DATABASE_NAME'),
         'USER': config('DATABASE_USER'),
         'PASSWORD': config('DATABASE_PASSWORD'),
@@ -86,21 +95,127 @@ DATABASES = {
         'PORT': config('DATABASE_PORT'),
     }
 }
+# Streaming replicas of the primary as host:port, e.g. localhost:5433. Reads
+# that tolerate replication lag (cache rebuilds and misses, user rating
+# fallbacks, backfills) are sent to one of them, see
+# BitPin.apps.rating.routers. Tests mirror them to the primary.
+DATABASE_REPLICAS = config('DATABASE_REPLICAS', default='', cast=Csv())
+for index, replica in enumerate(DATABASE_REPLICAS):
+    replica_host, _, replica_port = replica.rpartition(':')
+    DATABASES[f'replica_{index}'] = {
+        **DATABASES['default'],
+        'HOST': replica_host,
+        'PORT': replica_port,
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['BitPin.apps.rating.routers.ReplicaRouter']
+# After rating, a user's reads stay on the primary this long, so they see
+# their own rating however far the replicas lag
+DATABASE_REPLICA_PIN_SECONDS = config('DATABASE_REPLICA_PIN_SECONDS', default=5, cast=int)
 
 REDIS_HOST = config('REDIS_HOST')
-REDIS_PORT = config('REDIS_PORT')
+REDIS_PORT = config('REDIS_PORT', cast=int)
+REDIS_DB = config('REDIS_DB', default=0, cast=int)
+# Connection pool shared by views, tasks and signals (BitPin.apps.rating.redis_client)
+REDIS_MAX_CONNECTIONS = config('REDIS_MAX_CONNECTIONS', default=100, cast=int)
+REDIS_SOCKET_TIMEOUT = config('REDIS_SOCKET_TIMEOUT', default=2.0, cast=float)
+REDIS_SOCKET_CONNECT_TIMEOUT = config('REDIS_SOCKET_CONNECT_TIMEOUT', default=2.0, cast=float)
+REDIS_HEALTH_CHECK_INTERVAL = config('REDIS_HEALTH_CHECK_INTERVAL', default=30, cast=int)
+# 3 switches to RESP3 (Redis 6+)
+REDIS_PROTOCOL = config('REDIS_PROTOCOL', default=2, cast=int)
+# Connect to a Redis Cluster through REDIS_HOST:REDIS_PORT, any of its nodes.
+# Keys that scripts use together then share a hash tag (see redis_client).
+REDIS_CLUSTER = config('REDIS_CLUSTER', default=False, cast=bool)
+# Article state is split by article_id % ARTICLE_SHARDS: in cluster mode each
+# shard is one slot, and every shard has its own dirty set, synced by its own
+# sync_articles_from_redis task. Sync every shard before changing it.
+ARTICLE_SHARDS = config('ARTICLE_SHARDS', default=1, cast=int)
 
 CACHES = {
     'default': {
         'BACKEND': 'django_redis.cache.RedisCache',
-        'LOCATION': f'redis://{REDIS_HOST}:{REDIS_PORT}/1',
+        # Redis database 1 does not exist on a cluster; point it at a standalone Redis there
+        'LOCATION': config('CACHE_LOCATION', default=f'redis://{REDIS_HOST}:{REDIS_PORT}/1'),
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'SOCKET_TIMEOUT': REDIS_SOCKET_TIMEOUT,
+            'SOCKET_CONNECT_TIMEOUT': REDIS_SOCKET_CONNECT_TIMEOUT,
+            'CONNECTION_POOL_KWARGS': {
+                'max_connections': REDIS_MAX_CONNECTIONS,
+                'health_check_interval': REDIS_HEALTH_CHECK_INTERVAL,
+            },
         }
     }
 }
-CELERY_BROKER_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
-CELERY_RESULT_BACKEND = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
+# Rating persistence: 'sync' writes the Rating row on the request path,
+# 'write_behind' appends it to a Redis Stream drained by a Celery task.
+RATING_WRITE_MODE = config('RATING_WRITE_MODE', default='sync')
+RATING_STREAM_KEY = 'rating_events'
+RATING_STREAM_GROUP = 'rating_writers'
+RATING_STREAM_BATCH_SIZE = config('RATING_STREAM_BATCH_SIZE', default=1000, cast=int)
+RATING_STREAM_CLAIM_IDLE_MS = 60 * 1000  # reclaim entries a crashed worker left pending for 1 minute
+
+# Every accepted rating, in both write modes, is also added to this stream and
+# moved into the RatingEvent log and the hourly and daily rollups by
+# tasks.roll_up_rating_events (see rollups)
+RATING_LOG_KEY = 'rating_log'
+RATING_LOG_GROUP = 'rating_rollups'
+RATING_LOG_BATCH_SIZE = config('RATING_LOG_BATCH_SIZE', default=1000, cast=int)
+
+# Token buckets in front of the rating endpoints: each user and each article
+# may submit BURST ratings at once, refilled at PER_SECOND; a batch costs a
+# token per item. A BURST of 0 turns a bucket off, and both are off unless
+# configured. Repeating the last accepted score of a (user, article) pair
+# within RATING_COALESCE_WINDOW seconds is acknowledged without any write.
+RATING_LIMIT_USER_BURST = config('RATING_LIMIT_USER_BURST', default=0, cast=int)
+RATING_LIMIT_USER_PER_SECOND = config('RATING_LIMIT_USER_PER_SECOND', default=1.0, cast=float)
+RATING_LIMIT_ARTICLE_BURST = config('RATING_LIMIT_ARTICLE_BURST', default=0, cast=int)
+RATING_LIMIT_ARTICLE_PER_SECOND = config('RATING_LIMIT_ARTICLE_PER_SECOND', default=200.0, cast=float)
+RATING_COALESCE_WINDOW = config('RATING_COALESCE_WINDOW', default=10, cast=int)
+
+# Articles whose Redis hash changed since the last sync_articles_from_redis
+# run; the name of the set of shard 0 when there is a single shard, see
+# redis_client.dirty_articles_key
+DIRTY_ARTICLES_KEY = 'dirty_articles'
+ARTICLE_SYNC_CHUNK_SIZE = config('ARTICLE_SYNC_CHUNK_SIZE', default=5000, cast=int)
+
+# Sorted sets of article ids backing the paginated article list, ordered by
+# id, avg_rating and num_ratings. In cluster mode they and the leaderboards
+# share the {article_index} hash tag, so scripts can update them together.
+ARTICLE_INDEX_KEY = '{article_index}' if REDIS_CLUSTER else 'article_index'
+ARTICLE_RATING_INDEX_KEY = f'{ARTICLE_INDEX_KEY}_rating'
+ARTICLE_COUNT_INDEX_KEY = f'{ARTICLE_INDEX_KEY}_count'
+
+# Leaderboards: "most rated" is ARTICLE_COUNT_INDEX_KEY, "top rated" ranks by
+# avg_rating the articles with at least NUM_RATING_THRESHOLD ratings, and
+# "trending" ranks by the number of ratings, each decayed with a half-life of
+# TRENDING_HALF_LIFE seconds
+ARTICLE_TOP_RATED_KEY = f'{ARTICLE_INDEX_KEY}_top_rated'
+ARTICLE_TRENDING_KEY = f'{ARTICLE_INDEX_KEY}_trending'
+NUM_RATING_THRESHOLD = config('NUM_RATING_THRESHOLD', default=50, cast=int)
+TRENDING_HALF_LIFE = config('TRENDING_HALF_LIFE', default=6 * 60 * 60, cast=int)
+
+# Incremented by every write that changes the article list, which makes the
+# ETags of pages ordered by rating or count; a process rereads it at most
+# every ETAG_VERSION_CACHE_SECONDS for requests without a user_id (see
+# rating.etags)
+ARTICLE_LIST_VERSION_KEY = f'{ARTICLE_INDEX_KEY}_version'
+# Incremented when articles are added, edited or removed, and by rebuilds:
+# with the per-article rating versions, the ETags of the recent ordering
+ARTICLE_MEMBERSHIP_VERSION_KEY = f'{ARTICLE_INDEX_KEY}_membership_version'
+ETAG_VERSION_CACHE_SECONDS = config('ETAG_VERSION_CACHE_SECONDS', default=1.0, cast=float)
+
+# Per-process cache of article titles, invalidated through ARTICLE_META_VERSION_KEY
+ARTICLE_META_VERSION_KEY = 'article_meta_version'
+ARTICLE_META_CACHE_SIZE = config('ARTICLE_META_CACHE_SIZE', default=10000, cast=int)
+ARTICLE_META_CACHE_TTL = config('ARTICLE_META_CACHE_TTL', default=5 * 60, cast=int)  # seconds
+
+# Rows per server-side cursor fetch and per chunk of a streamed export (see rating.export)
+EXPORT_CHUNK_SIZE = config('EXPORT_CHUNK_SIZE', default=2000, cast=int)
+
+# Celery cannot use a Redis Cluster, so point these at a standalone Redis in cluster mode
+CELERY_BROKER_URL = config('CELERY_BROKER_URL', default=f'redis://{REDIS_HOST}:{REDIS_PORT}/0')
+CELERY_RESULT_BACKEND = config('CELERY_RESULT_BACKEND', default=CELERY_BROKER_URL)
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
@@ -110,9 +225,26 @@ CELERY_IMPORTS = [
 ]
 # Celery beat for scheduled tasks
 CELERY_BEAT_SCHEDULE = {
-    'update-article-ratings-every-5-minutes': {
-        'task': 'Bitpin.apps.rating.tasks.sync_articles_from_redis',
-        'schedule': crontab(minute='*/1'),  # Every 5 minutes
+    'sync-article-ratings-every-minute': {
+        # Queues one sync_articles_from_redis per shard, for any free worker
+        'task': 'BitPin.apps.rating.tasks.sync_article_shards',
+        'schedule': crontab(minute='*/1'),  # Every minute
+    },
+    'drain-rating-stream': {
+        'task': 'BitPin.apps.rating.tasks.drain_rating_stream',
+        'schedule': 5.0,  # Every 5 seconds
+    },
+    'roll-up-rating-events': {
+        'task': 'BitPin.apps.rating.tasks.roll_up_rating_events',
+        'schedule': 10.0,  # Every 10 seconds
+    },
+    'create-rating-partitions': {
+        'task': 'BitPin.apps.rating.tasks.create_rating_partitions',
+        'schedule': crontab(minute=30, hour=0),  # Daily
+    },
+    'rebuild-trending-index': {
+        'task': 'BitPin.apps.rating.tasks.rebuild_trending_index',
+        'schedule': crontab(minute=0),  # Every hour
     },
 }
 # Password validation
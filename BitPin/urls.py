@@ -18,7 +18,9 @@ from django.contrib import admin
 from django.urls import path, include
 
 from BitPin.apps.rating import urls as rating_urls
+from BitPin.apps.rating.metrics import metrics_view
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('rating/', include(rating_urls)),
+    path('metrics', metrics_view, name='metrics'),
 ]